@@ -0,0 +1,228 @@
+import hashlib
+import json
+
+from flask import Blueprint, current_app, request, session
+
+from compression import etag_matches
+from db import get_db_connection
+from pagination import paginate
+from tag_catalog import get_tag_catalog
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# リソースごとに公開するフィールドとSQL式。一覧の既定フィールドには本文のような大きな列を含めない
+STUDENT_FIELDS = {
+    'id': 'u.id',
+    'username': 'u.username',
+    'name': 'u.name',
+    'student_number': 'u.student_number',
+    'grade': 'u.grade',
+    'graduation_year': 'u.graduation_year',
+    'bio': 'u.bio',
+    'portfolio_count': 's.portfolio_count',
+    'comment_count': 's.comment_count',
+    'rating_avg': 'CASE WHEN s.rating_count > 0 THEN s.rating_avg END',
+    'last_activity': "NULLIF(s.last_activity, '')",
+}
+STUDENT_DEFAULT = ('id', 'username', 'name', 'graduation_year')
+
+PORTFOLIO_FIELDS = {
+    'id': 'p.id',
+    'user_id': 'p.user_id',
+    'username': '(SELECT username FROM user WHERE id = p.user_id)',
+    'title': 'p.title',
+    'content': '(SELECT body_text(body) FROM portfolio_body WHERE portfolio_id = p.id)',
+    'created_at': 'p.created_at',
+    'version': 'p.version',
+    'tags': None,  # portfolio_tagsからまとめて引き、タグ名はキャッシュから付ける
+}
+PORTFOLIO_DEFAULT = ('id', 'user_id', 'title', 'created_at', 'version')
+
+COMMENT_FIELDS = {
+    'id': 'c.id',
+    'portfolio_id': 'c.portfolio_id',
+    'teacher_id': 'c.teacher_id',
+    'teacher': '(SELECT username FROM user WHERE id = c.teacher_id)',
+    'comment': 'c.comment',
+    'rating': 'c.rating',
+    'created_at': 'c.created_at',
+}
+COMMENT_DEFAULT = tuple(COMMENT_FIELDS)
+
+TAG_FIELDS = ('id', 'name')
+
+MAX_LIMIT = 100
+
+
+class APIError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def dumps(value):
+    # orjsonがあればそれを使い、なければ空白なしのjson.dumpsで書き出す
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def json_response(value, status=200):
+    return current_app.response_class(dumps(value), status=status, mimetype='application/json')
+
+
+@api.errorhandler(APIError)
+def handle_api_error(error):
+    return json_response({'error': error.message}, error.status)
+
+
+def require_login(teacher=False):
+    if 'user_id' not in session:
+        raise APIError(401, 'login required')
+    if teacher and session.get('role') != 'teacher':
+        raise APIError(403, 'teacher only')
+
+
+def select_fields(available, default):
+    # ?fields=id,title のように必要なフィールドだけを選ぶ
+    value = request.args.get('fields')
+    if not value:
+        return list(default)
+    names = list(dict.fromkeys(name.strip() for name in value.split(',') if name.strip()))
+    unknown = [name for name in names if name not in available]
+    if unknown or not names:
+        raise APIError(400, f"unknown fields: {', '.join(unknown) or value}")
+    return names
+
+
+def columns_for(fields, names):
+    # SQLで取る列。'tags'のように別に引くフィールドは除く。
+    # idはタグを付けるのに使うので、選ばれていなくても末尾に取っておく(serializeでは出力しない)
+    columns = [f'{fields[name]} AS {name}' for name in names if fields[name] is not None]
+    if 'id' not in names:
+        columns.append(f"{fields['id']} AS id")
+    return ', '.join(columns)
+
+
+def serialize(rows, names):
+    # sqlite3.Rowから直接辞書にする(選んだ列はSELECTの先頭から同じ順に並んでいる)
+    columns = [name for name in names if name != 'tags']
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def attach_tags(conn, items, rows):
+    # 一覧のタグは一回のクエリでまとめて取る
+    ids = [row['id'] for row in rows]
+    tag_ids = {portfolio_id: [] for portfolio_id in ids}
+    if ids:
+        placeholders = ', '.join('?' for _ in ids)
+        for portfolio_id, tag_id in conn.execute(
+                f'SELECT portfolio_id, tag_id FROM portfolio_tags WHERE portfolio_id IN ({placeholders}) '
+                'ORDER BY portfolio_id, tag_id', ids):
+            tag_ids[portfolio_id].append(tag_id)
+    catalog = get_tag_catalog()
+    for item, portfolio_id in zip(items, ids):
+        item['tags'] = [tag.name for tag in catalog.lookup(conn, tag_ids[portfolio_id])]
+
+
+def page_options():
+    limit = request.args.get('limit', current_app.config['PAGE_SIZE'], type=int)
+    return {'per_page': min(max(limit, 1), MAX_LIMIT),
+            'after': request.args.get('after'), 'before': request.args.get('before')}
+
+
+def page_response(page, items):
+    return json_response({'items': items, 'next': page.next_cursor, 'prev': page.prev_cursor})
+
+
+@api.route('/students')
+def students():
+    require_login(teacher=True)
+    conn = get_db_connection(readonly=True)
+    names = select_fields(STUDENT_FIELDS, STUDENT_DEFAULT)
+    from_where = 'FROM student_stats AS s JOIN user AS u ON u.id = s.user_id WHERE 1'
+    params = []
+    if request.args.get('year'):
+        from_where += ' AND s.graduation_year = ?'
+        params.append(request.args['year'])
+    page = paginate(conn, columns_for(STUDENT_FIELDS, names), from_where, params, keys=('s.user_id',),
+                    descending=False, **page_options())
+    return page_response(page, serialize(page.items, names))
+
+
+@api.route('/portfolios')
+def portfolios():
+    require_login()
+    conn = get_db_connection(readonly=True)
+    names = select_fields(PORTFOLIO_FIELDS, PORTFOLIO_DEFAULT)
+    from_where = 'FROM portfolio AS p WHERE 1'
+    params = []
+    # 生徒は自分のポートフォリオだけを一覧できる(HTMLの一覧と同じ)
+    student_id = request.args.get('student_id', type=int)
+    if session.get('role') != 'teacher':
+        student_id = session['user_id']
+    if student_id is not None:
+        from_where += ' AND p.user_id = ?'
+        params.append(student_id)
+    tag_id = request.args.get('tag_id', type=int)
+    if tag_id is not None:
+        from_where += ' AND p.id IN (SELECT portfolio_id FROM portfolio_tags WHERE tag_id = ?)'
+        params.append(tag_id)
+    page = paginate(conn, columns_for(PORTFOLIO_FIELDS, names), from_where, params, keys=('p.id',),
+                    **page_options())
+    items = serialize(page.items, names)
+    if 'tags' in names:
+        attach_tags(conn, items, page.items)
+    return page_response(page, items)
+
+
+@api.route('/portfolios/<int:portfolio_id>')
+def portfolio(portfolio_id):
+    require_login()
+    conn = get_db_connection(readonly=True)
+    names = select_fields(PORTFOLIO_FIELDS, tuple(PORTFOLIO_FIELDS))
+    version = conn.execute('SELECT version FROM portfolio WHERE id = ?', (portfolio_id,)).fetchone()
+    if version is None:
+        raise APIError(404, 'portfolio not found')
+    # versionは編集・タグ・コメントの変更で進むので、同じversionと同じフィールドなら内容も同じ
+    etag = hashlib.sha256(repr((portfolio_id, version[0], names)).encode()).hexdigest()[:32]
+    if etag_matches(etag):
+        response = current_app.response_class(status=304)
+    else:
+        rows = conn.execute(f'SELECT {columns_for(PORTFOLIO_FIELDS, names)} FROM portfolio AS p WHERE p.id = ?',
+                            (portfolio_id,)).fetchall()
+        items = serialize(rows, names)
+        if 'tags' in names:
+            attach_tags(conn, items, rows)
+        response = json_response(items[0])
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@api.route('/portfolios/<int:portfolio_id>/comments')
+def comments(portfolio_id):
+    require_login()
+    conn = get_db_connection(readonly=True)
+    names = select_fields(COMMENT_FIELDS, COMMENT_DEFAULT)
+    if conn.execute('SELECT 1 FROM portfolio WHERE id = ?', (portfolio_id,)).fetchone() is None:
+        raise APIError(404, 'portfolio not found')
+    page = paginate(conn, columns_for(COMMENT_FIELDS, names), 'FROM comments AS c WHERE c.portfolio_id = ?',
+                    (portfolio_id,), keys=('c.id',), descending=False, **page_options())
+    return page_response(page, serialize(page.items, names))
+
+
+@api.route('/tags')
+def tags():
+    require_login()
+    conn = get_db_connection(readonly=True)
+    names = select_fields(TAG_FIELDS, TAG_FIELDS)
+    return json_response({'items': [{name: getattr(tag, name) for name in names}
+                                    for tag in get_tag_catalog().all(conn)]})
@@ -0,0 +1,230 @@
+import os
+import re
+import time
+from contextlib import contextmanager
+from datetime import date
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+import db
+from migrations import split_statements
+
+
+archive_cli = AppGroup('archive', help='Move graduated cohorts into per-year archive databases.')
+
+_FILENAME = re.compile(r'cohort-(\d{4})\.db$')
+
+# 卒業年度ごとのアーカイブ(ATTACHしたデータベース)のスキーマ。ログインはできなくなるのでパスワードは持たず、
+# タグとコメントした教師は名前で持つ(後から本番のタグや教師が変わっても読めるように)。
+# 本文は portfolio_body と同じ形式(圧縮したものはそのまま)で持つ
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS archive.user (
+    id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL,
+    student_number TEXT,
+    name TEXT,
+    grade TEXT,
+    graduation_year TEXT,
+    bio TEXT,
+    archived_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS archive.portfolio (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS archive.idx_portfolio_user ON portfolio (user_id, id);
+CREATE TABLE IF NOT EXISTS archive.portfolio_body (
+    portfolio_id INTEGER PRIMARY KEY,
+    body NOT NULL
+);
+CREATE TABLE IF NOT EXISTS archive.portfolio_tags (
+    portfolio_id INTEGER NOT NULL,
+    tag TEXT NOT NULL,
+    PRIMARY KEY (portfolio_id, tag)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS archive.comments (
+    id INTEGER PRIMARY KEY,
+    portfolio_id INTEGER NOT NULL,
+    teacher TEXT,
+    comment TEXT,
+    rating INTEGER,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS archive.idx_comments_portfolio ON comments (portfolio_id, id);
+CREATE TABLE IF NOT EXISTS archive.attachments (
+    id INTEGER PRIMARY KEY,
+    portfolio_id INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mimetype TEXT NOT NULL,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS archive.idx_attachments_portfolio ON attachments (portfolio_id, id);
+'''
+
+# 1回のトランザクションで移す生徒(temp.archiving_users)と、そのポートフォリオ(temp.archiving_portfolios)。
+# アーカイブへはINSERT OR REPLACEで書くので、途中で止まってもやり直せば同じ結果になる
+_PORTFOLIOS = 'SELECT id FROM temp.archiving_portfolios'
+MOVE = [
+    'INSERT OR REPLACE INTO archive.user (id, username, student_number, name, grade, graduation_year, bio) '
+    'SELECT id, username, student_number, name, grade, graduation_year, bio FROM main.user '
+    'WHERE id IN (SELECT id FROM temp.archiving_users)',
+    'INSERT OR REPLACE INTO archive.portfolio (id, user_id, title, created_at) '
+    f'SELECT id, user_id, title, created_at FROM main.portfolio WHERE id IN ({_PORTFOLIOS})',
+    'INSERT OR REPLACE INTO archive.portfolio_body (portfolio_id, body) '
+    f'SELECT portfolio_id, body FROM main.portfolio_body WHERE portfolio_id IN ({_PORTFOLIOS})',
+    'INSERT OR REPLACE INTO archive.portfolio_tags (portfolio_id, tag) '
+    'SELECT pt.portfolio_id, t.name FROM main.portfolio_tags AS pt JOIN main.tags AS t ON t.id = pt.tag_id '
+    f'WHERE pt.portfolio_id IN ({_PORTFOLIOS})',
+    'INSERT OR REPLACE INTO archive.comments (id, portfolio_id, teacher, comment, rating, created_at) '
+    'SELECT c.id, c.portfolio_id, u.username, c.comment, c.rating, c.created_at '
+    'FROM main.comments AS c LEFT JOIN main.user AS u ON u.id = c.teacher_id '
+    f'WHERE c.portfolio_id IN ({_PORTFOLIOS})',
+    'INSERT OR REPLACE INTO archive.attachments (id, portfolio_id, sha256, filename, size, mimetype, created_at) '
+    'SELECT a.id, a.portfolio_id, a.sha256, a.filename, b.size, b.mimetype, a.created_at '
+    'FROM main.attachments AS a JOIN main.blobs AS b ON b.sha256 = a.sha256 '
+    f'WHERE a.portfolio_id IN ({_PORTFOLIOS})',
+    # 添付の実体はアーカイブからも配信するので、消した添付の分の参照数を足し戻して flask attachments gc から守る
+    'UPDATE main.blobs SET refcount = refcount + '
+    f'(SELECT count(*) FROM main.attachments AS a WHERE a.sha256 = blobs.sha256 AND a.portfolio_id IN ({_PORTFOLIOS})) '
+    f'WHERE sha256 IN (SELECT sha256 FROM main.attachments WHERE portfolio_id IN ({_PORTFOLIOS}))',
+    # 本文・全文検索・集計・タグインデックスの世代番号はトリガーが片付ける
+    f'DELETE FROM main.comments WHERE portfolio_id IN ({_PORTFOLIOS})',
+    f'DELETE FROM main.attachments WHERE portfolio_id IN ({_PORTFOLIOS})',
+    f'DELETE FROM main.portfolio_tags WHERE portfolio_id IN ({_PORTFOLIOS})',
+    f'DELETE FROM main.portfolio WHERE id IN ({_PORTFOLIOS})',
+    'DELETE FROM main.user WHERE id IN (SELECT id FROM temp.archiving_users)',
+    # 削除のトリガーが書いた分も含めて、卒業生の変更履歴はライブ更新に流さない
+    'DELETE FROM main.events WHERE user_id IN (SELECT id FROM temp.archiving_users)',
+]
+
+
+def folder(app):
+    return app.config['ARCHIVE_FOLDER']
+
+
+def archive_path(app, year):
+    return os.path.join(folder(app), f'cohort-{int(year)}.db')
+
+
+def years(app):
+    # アーカイブのある卒業年度(新しい順)
+    if not os.path.isdir(folder(app)):
+        return []
+    found = (_FILENAME.match(name) for name in os.listdir(folder(app)))
+    return sorted((int(match.group(1)) for match in found if match), reverse=True)
+
+
+def graduated(year, today=None):
+    # 年度は3月で終わるので、卒業年度の4月以降なら卒業済み
+    today = today or date.today()
+    return year < today.year or (year == today.year and today.month >= 4)
+
+
+@contextmanager
+def attached(conn, year):
+    # 教師が過去のデータを開いたときだけ、その年度のアーカイブを archive としてつなぐ。
+    # 読み込み用の接続は query_only なので、アーカイブにも書き込めない。プールに戻す前に必ず外す
+    path = archive_path(current_app, year)
+    if not os.path.exists(path):
+        raise LookupError(f'No archive for {year}')
+    conn.execute('ATTACH DATABASE ? AS archive', (path,))
+    try:
+        yield conn
+    finally:
+        conn.execute('DETACH DATABASE archive')
+
+
+def archive_cohort(conn, path, year, batch_size=200, progress=None):
+    # 卒業年度が year の生徒を、batch_size 人ずつのトランザクションでアーカイブに移す。
+    # 書き込みロックを持つのは1回分の移動の間だけなので、その間もサイトは動き続けられる
+    conn.isolation_level = None
+    conn.execute('ATTACH DATABASE ? AS archive', (path,))
+    moved = {'students': 0, 'portfolios': 0}
+    try:
+        for statement in split_statements(SCHEMA):
+            conn.execute(statement)
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS archiving_users (id INTEGER PRIMARY KEY)')
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS archiving_portfolios (id INTEGER PRIMARY KEY)')
+        while True:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('DELETE FROM temp.archiving_users')
+                conn.execute('DELETE FROM temp.archiving_portfolios')
+                students = conn.execute(
+                    "INSERT INTO temp.archiving_users (id) SELECT id FROM main.user "
+                    "WHERE role = 'student' AND graduation_year = ? ORDER BY id LIMIT ?",
+                    (str(year), batch_size)).rowcount
+                if not students:
+                    conn.execute('COMMIT')
+                    break
+                portfolios = conn.execute(
+                    'INSERT INTO temp.archiving_portfolios (id) SELECT id FROM main.portfolio '
+                    'WHERE user_id IN (SELECT id FROM temp.archiving_users)').rowcount
+                for statement in MOVE:
+                    conn.execute(statement)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            moved['students'] += students
+            moved['portfolios'] += portfolios
+            if progress:
+                progress(moved)
+        conn.execute('ANALYZE archive')
+    finally:
+        conn.execute('DETACH DATABASE archive')
+    return moved
+
+
+@archive_cli.command('run')
+@click.argument('cohorts', nargs=-1, type=int, required=True)
+@click.option('--batch-size', default=200, show_default=True, help='Students moved per transaction.')
+@click.option('--force', is_flag=True, help='Also archive cohorts that have not graduated yet.')
+@click.option('--vacuum', is_flag=True, help='Shrink the live database file afterwards.')
+def run_command(cohorts, batch_size, force, vacuum):
+    # 例: flask archive run 2024 2025
+    app = current_app._get_current_object()
+    pending = [year for year in cohorts if not graduated(year)]
+    if pending and not force:
+        raise click.ClickException(f"Not graduated yet: {', '.join(map(str, pending))} (use --force)")
+    os.makedirs(folder(app), exist_ok=True)
+    conn = db.open_connection(app)
+    try:
+        for year in cohorts:
+            started = time.perf_counter()
+            moved = archive_cohort(conn, archive_path(app, year), year, batch_size,
+                                   progress=lambda moved: click.echo(f"{moved['students']} students moved", err=True))
+            click.echo(f"{year}: archived {moved['students']} students and {moved['portfolios']} portfolios "
+                       f"in {time.perf_counter() - started:.1f}s")
+        conn.execute('PRAGMA optimize')
+        if vacuum:
+            # 空いたページをファイルから返す(データベース全体を書き直すので、利用の少ない時間に)
+            conn.execute('VACUUM')
+    finally:
+        conn.close()
+
+
+@archive_cli.command('list')
+def list_command():
+    app = current_app._get_current_object()
+    conn = db.open_connection(app, readonly=True)
+    try:
+        for year in years(app):
+            with attached(conn, year):
+                students = conn.execute('SELECT count(*) FROM archive.user').fetchone()[0]
+                portfolios = conn.execute('SELECT count(*) FROM archive.portfolio').fetchone()[0]
+            size = os.path.getsize(archive_path(app, year))
+            click.echo(f'{year}  {students:>6} students  {portfolios:>8} portfolios  {size / 1024 / 1024:>8.1f} MB')
+    finally:
+        conn.close()
+
+
+def init_app(app):
+    app.config.setdefault('ARCHIVE_FOLDER', os.path.join(app.instance_path, 'archive'))
+    app.cli.add_command(archive_cli)
@@ -0,0 +1,122 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+
+import click
+from flask import Blueprint, current_app, send_from_directory, url_for
+from flask.cli import AppGroup
+
+from compression import brotli, negotiate
+
+
+assets = Blueprint('assets', __name__, url_prefix='/assets')
+assets_cli = AppGroup('assets', help='Build fingerprinted, precompressed static assets.')
+
+MANIFEST = 'manifest.json'
+
+# ファイル名に内容のハッシュが入っているので、一度配信したURLの中身は変わらない
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def _output_folder(app):
+    return os.path.join(app.static_folder, app.config['ASSETS_FOLDER'])
+
+
+def _source_files(app):
+    output = os.path.abspath(_output_folder(app))
+    for root, dirs, files in os.walk(app.static_folder):
+        # ビルド結果の置き場所はもう一度ハッシュを付けないように除く
+        dirs[:] = sorted(name for name in dirs if os.path.abspath(os.path.join(root, name)) != output)
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            yield os.path.relpath(path, app.static_folder).replace(os.sep, '/'), path
+
+
+def build(app):
+    # static/以下の各ファイルを "名前.ハッシュ.拡張子" でコピーし、.gz(と.br)を作って対応表を書き出す
+    output = _output_folder(app)
+    os.makedirs(output, exist_ok=True)
+    manifest = {}
+    for filename, path in _source_files(app):
+        with open(path, 'rb') as f:
+            data = f.read()
+        stem, extension = os.path.splitext(filename)
+        hashed = f'{stem}.{hashlib.sha256(data).hexdigest()[:12]}{extension}'
+        target = os.path.join(output, hashed)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as f:
+            f.write(data)
+        # 事前圧縮は配信時ではなくビルド時に一度だけなので、最高圧縮率で作る
+        with open(target + '.gz', 'wb') as f:
+            f.write(gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            with open(target + '.br', 'wb') as f:
+                f.write(brotli.compress(data, quality=11))
+        manifest[filename] = hashed
+    # 対応表は最後に置き換えるので、ビルド中に起動したプロセスが書きかけの表を読むことはない
+    temporary = os.path.join(output, MANIFEST + '.tmp')
+    with open(temporary, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(temporary, os.path.join(output, MANIFEST))
+    return manifest
+
+
+def load_manifest(app):
+    try:
+        with open(os.path.join(_output_folder(app), MANIFEST), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def asset_url(filename):
+    # url_for('static', filename=...) の代わりに使う。ビルド済みならハッシュ付きのURLを返す
+    manifest = current_app.extensions['asset_manifest']
+    hashed = manifest.get(filename)
+    if hashed is None:
+        return url_for('static', filename=filename)
+    return url_for('assets.serve', filename=hashed)
+
+
+@assets.route('/<path:filename>')
+def serve(filename):
+    folder = _output_folder(current_app)
+    # 事前に圧縮したファイルがあれば、Accept-Encodingに合わせてそれを返す
+    encoding = negotiate(('br', 'gzip'))
+    if encoding == 'br' and not os.path.isfile(os.path.join(folder, filename + '.br')):
+        encoding = negotiate(('gzip',))
+    suffix = {'br': '.br', 'gzip': '.gz'}.get(encoding, '')
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    response = send_from_directory(folder, filename + suffix, mimetype=mimetype, conditional=True)
+    if suffix:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = IMMUTABLE
+    return response
+
+
+@assets_cli.command('build')
+def build_command():
+    app = current_app._get_current_object()
+    manifest = build(app)
+    for filename, hashed in manifest.items():
+        click.echo(f'{filename} -> {hashed}')
+    if brotli is None:
+        click.echo('brotli is not installed; only .gz variants were written.', err=True)
+
+
+@assets_cli.command('clean')
+def clean_command():
+    shutil.rmtree(_output_folder(current_app._get_current_object()), ignore_errors=True)
+
+
+def init_app(app):
+    app.config.setdefault('ASSETS_FOLDER', 'dist')
+    # 対応表はプロセスの起動時に一度だけ読む(ビルド後はアプリを再起動する)
+    app.extensions['asset_manifest'] = load_manifest(app)
+    app.jinja_env.globals['asset_url'] = asset_url
+    app.register_blueprint(assets)
+    app.cli.add_command(assets_cli)
@@ -0,0 +1,258 @@
+import hashlib
+import mimetypes
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+from flask import Request, abort, current_app, send_file
+from flask.cli import AppGroup
+from werkzeug.exceptions import RequestEntityTooLarge
+
+import db
+from jobs import enqueue, job
+
+try:
+    from PIL import Image
+except ImportError:  # Pillowがなければサムネイルは作らない(添付と配信はできる)
+    Image = None
+
+
+attachments_cli = AppGroup('attachments', help='Manage portfolio attachment storage.')
+
+# ブラウザでそのまま開いてよい種類。それ以外(HTMLやSVGなど)はページとして開かれないようにダウンロードさせる
+INLINE_TYPES = {'image/png', 'image/jpeg', 'image/gif', 'image/webp', 'application/pdf', 'video/mp4',
+                'video/webm', 'audio/mpeg', 'audio/ogg', 'text/plain'}
+THUMBNAIL_TYPES = {'image/png', 'image/jpeg', 'image/gif', 'image/webp', 'image/bmp', 'image/tiff'}
+
+# 実体はハッシュで決まるURLにしか出てこないので、一度取得したものは変わらない
+IMMUTABLE = 'private, max-age=31536000, immutable'
+
+_pool_lock = threading.Lock()
+
+
+def _folder(app, *parts):
+    return os.path.join(app.config['ATTACHMENTS_FOLDER'], *parts)
+
+
+def blob_path(app, sha256):
+    return _folder(app, 'blobs', sha256[:2], sha256)
+
+
+def thumbnail_path(app, sha256):
+    return _folder(app, 'thumbnails', sha256[:2], sha256 + '.jpg')
+
+
+class HashingFile:
+    # アップロードされたファイルを受け取りながらハッシュを計算し、添付ファイルと同じフォルダの一時ファイルに書く。
+    # メモリには一度に一つの塊しか載らない。保存するときは名前を変えるだけで済み、保存しなければ閉じたときに消える
+    def __init__(self, folder, max_size):
+        os.makedirs(folder, exist_ok=True)
+        self._file = tempfile.NamedTemporaryFile(dir=folder, prefix='upload-', delete=False)
+        self._hash = hashlib.sha256()
+        self._max_size = max_size
+        self.name = self._file.name
+        self.size = 0
+        self.stored = False
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self._max_size:
+            # 解析の途中で止まるとwerkzeugはこのファイルを閉じないので、ここで消しておく
+            self.close()
+            raise RequestEntityTooLarge()
+        self._hash.update(data)
+        return self._file.write(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def close(self):
+        self._file.close()
+        if not self.stored:
+            try:
+                os.unlink(self.name)
+            except FileNotFoundError:
+                pass
+
+    def __getattr__(self, name):
+        # seek・read・flushなど、FileStorageが使う残りの操作は一時ファイルに任せる
+        return getattr(self._file, name)
+
+
+class AttachmentRequest(Request):
+    # multipartのファイル部分を HashingFile で受け取る(werkzeugの既定はメモリか無名の一時ファイル)
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        app = current_app
+        return HashingFile(_folder(app, 'tmp'), app.config['ATTACHMENT_MAX_SIZE'])
+
+
+def display_name(filename):
+    # 表示とダウンロード時の名前に使う。パスの区切りや制御文字だけを除き、日本語の名前はそのまま残す
+    name = os.path.basename((filename or '').replace('\\', '/'))
+    name = ''.join(char for char in name if char.isprintable()).strip()
+    return name[:255] or 'attachment'
+
+
+def store(conn, portfolio_id, upload):
+    # 添付ファイルを保存してIDを返す。同じ内容の実体がすでにあれば、新しいファイルは捨てて実体を共有する
+    app = current_app._get_current_object()
+    stream = upload.stream
+    if not isinstance(stream, HashingFile):
+        # 別のRequestクラスで受け取ったときは、ここで塊ごとに書き写す
+        stream = HashingFile(_folder(app, 'tmp'), app.config['ATTACHMENT_MAX_SIZE'])
+        upload.stream.seek(0)
+        for chunk in iter(lambda: upload.stream.read(1024 * 1024), b''):
+            stream.write(chunk)
+    stream.flush()
+    os.fsync(stream.fileno())
+    sha256 = stream.hexdigest()
+    filename = display_name(upload.filename)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    thumbnail = mimetype in THUMBNAIL_TYPES
+    # 実体の有無の確認から行の追加までを書き込みロックの中で行い、flask attachments gc と入れ違わないようにする
+    conn.execute('BEGIN IMMEDIATE')
+    path = blob_path(app, sha256)
+    moved = False
+    try:
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(stream.name, path)
+            stream.stored = moved = True
+        created = conn.execute('INSERT OR IGNORE INTO blobs (sha256, size, mimetype, thumbnail) VALUES (?, ?, ?, ?)',
+                               (sha256, stream.size, mimetype, 0 if thumbnail else -1)).rowcount
+        attachment_id = conn.execute('INSERT INTO attachments (portfolio_id, sha256, filename) VALUES (?, ?, ?)',
+                                     (portfolio_id, sha256, filename)).lastrowid
+        # 画像のデコードは重いので、サムネイルはワーカーで作る(できるまでは詳細ページに名前だけが出る)
+        if created and thumbnail and Image is not None:
+            enqueue(conn, 'attachment_thumbnail', {'sha256': sha256}, dedupe_key=f'thumbnail:{sha256}')
+        conn.commit()
+    except Exception:
+        # この呼び出しで置いた実体は、blobsの行がないまま残らないよう書き込みロックを持っているうちに消す
+        if moved:
+            os.unlink(path)
+        conn.rollback()
+        raise
+    return attachment_id
+
+
+def send_attachment(row, thumbnail=False):
+    # rowは models.AttachmentFile
+    # send_fileはファイルをそのまま渡す(gunicornではsendfileで送られる)。Rangeと条件付きGETにも応じる
+    app = current_app._get_current_object()
+    if thumbnail:
+        path, mimetype, inline, etag = thumbnail_path(app, row.sha256), 'image/jpeg', True, row.sha256 + '-t'
+    else:
+        path, mimetype = blob_path(app, row.sha256), row.mimetype
+        inline, etag = mimetype in INLINE_TYPES, row.sha256
+    try:
+        response = send_file(path, mimetype=mimetype, as_attachment=not inline, download_name=row.filename,
+                             conditional=True, etag=etag)
+    except FileNotFoundError:
+        abort(404)
+    response.headers['Cache-Control'] = IMMUTABLE
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+
+def render_thumbnail(source, target, size):
+    # 子プロセスで実行する。JPEGは縮小しながら読み込むので、大きな写真でもデコードが軽く済む
+    with Image.open(source) as image:
+        image.draft('RGB', (size, size))
+        image.thumbnail((size, size))
+        temporary = f'{target}.{os.getpid()}.tmp'
+        image.convert('RGB').save(temporary, 'JPEG', quality=80, optimize=True)
+    os.replace(temporary, target)
+
+
+def _thumbnail_pool(app):
+    # プロセスごとに一つ作る。ジョブのワーカーをスレッドで動かしていても、デコードはGILの外で並列に進む
+    with _pool_lock:
+        state = app.extensions.get('thumbnail_pool')
+        if state is None or state[0] != os.getpid():
+            state = app.extensions['thumbnail_pool'] = (
+                os.getpid(), ProcessPoolExecutor(app.config['THUMBNAIL_WORKERS']))
+        return state[1]
+
+
+@job('attachment_thumbnail')
+def make_thumbnail(payload):
+    if Image is None:
+        raise RuntimeError('Pillow is not installed')
+    app = current_app._get_current_object()
+    sha256 = payload['sha256']
+    target = thumbnail_path(app, sha256)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    future = _thumbnail_pool(app).submit(render_thumbnail, blob_path(app, sha256), target,
+                                         app.config['THUMBNAIL_SIZE'])
+    try:
+        future.result()
+        state = 1
+    except (OSError, ValueError, Image.DecompressionBombError):
+        # 画像として読めないものは再試行しない(詳細ページにはファイル名だけを出す)
+        state = -1
+    conn = db.get_db_connection()
+    conn.execute('UPDATE blobs SET thumbnail = ? WHERE sha256 = ?', (state, sha256))
+    conn.commit()
+
+
+@attachments_cli.command('gc')
+@click.option('--tmp-age', default=86400, show_default=True,
+              help='Also remove interrupted uploads older than this many seconds.')
+def gc_command(tmp_age):
+    # どの添付からも参照されなくなった実体とサムネイルを消す
+    app = current_app._get_current_object()
+    conn = db.open_connection(app)
+    conn.isolation_level = None
+    removed = 0
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for row in conn.execute('SELECT sha256 FROM blobs WHERE refcount = 0').fetchall():
+                for path in (blob_path(app, row['sha256']), thumbnail_path(app, row['sha256'])):
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+                removed += 1
+            conn.execute('DELETE FROM blobs WHERE refcount = 0')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    finally:
+        conn.close()
+    folder = _folder(app, 'tmp')
+    if os.path.isdir(folder):
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if time.time() - os.path.getmtime(path) > tmp_age:
+                os.unlink(path)
+    click.echo(f'{removed} unreferenced blobs removed')
+
+
+@attachments_cli.command('thumbnails')
+def thumbnails_command():
+    # Pillowを後から入れたときなど、まだサムネイルのない画像の分のジョブを追加する
+    if Image is None:
+        raise click.ClickException('Pillow is not installed.')
+    conn = db.open_connection(current_app._get_current_object())
+    try:
+        rows = conn.execute('SELECT sha256 FROM blobs WHERE thumbnail = 0').fetchall()
+        for row in rows:
+            enqueue(conn, 'attachment_thumbnail', {'sha256': row['sha256']}, dedupe_key=f"thumbnail:{row['sha256']}")
+        conn.commit()
+    finally:
+        conn.close()
+    click.echo(f'{len(rows)} thumbnail jobs queued')
+
+
+def init_app(app):
+    app.config.setdefault('ATTACHMENTS_FOLDER', os.path.join(app.instance_path, 'attachments'))
+    app.config.setdefault('ATTACHMENT_MAX_SIZE', 100 * 1024 * 1024)
+    app.config.setdefault('THUMBNAIL_SIZE', 320)
+    app.config.setdefault('THUMBNAIL_WORKERS', os.cpu_count() or 1)
+    app.request_class = AttachmentRequest
+    app.cli.add_command(attachments_cli)
@@ -0,0 +1,255 @@
+import http.cookiejar
+import json
+import math
+import random
+import re
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask import current_app
+
+import db
+from seed import DEFAULT_PASSWORD
+
+
+# (名前, ログインする役割, URL)。URLの {portfolio} などはデータベースから選んだIDで埋める
+SCENARIOS = [
+    ('index', None, '/'),
+    ('login_page', None, '/login'),
+    ('portfolio', 'student', '/portfolio'),
+    ('profile', 'student', '/profile'),
+    ('portfolio_detail', 'teacher', '/portfolio/{portfolio}'),
+    ('students_list', 'teacher', '/students_list'),
+    ('students_list_rating', 'teacher', '/students_list?sort=rating&year={year}'),
+    ('view_portfolio', 'teacher', '/view_portfolio/{student}'),
+    ('teacher_dashboard_search', 'teacher', '/teacher_dashboard?search_query={word}'),
+    ('search_by_tag', 'teacher', '/search_by_tag?tag_id={tag}'),
+    ('search_by_tag_query', 'teacher', '/search_by_tag?q={tag_name}+OR+{other_tag_name}'),
+    ('api_portfolios', 'teacher', '/api/v1/portfolios?fields=id,title,tags'),
+    ('api_students', 'teacher', '/api/v1/students?fields=id,username,portfolio_count,rating_avg'),
+]
+
+SEARCH_WORDS = ['機械学習', '地域', '実験', '発表', 'データ']
+
+
+class _TestClient:
+    # Flaskのテストクライアントで同じプロセス内のアプリを呼ぶ(クエリ数も数えられる)
+    def __init__(self, app):
+        self._client = app.test_client()
+
+    def login(self, username, password):
+        return self._client.post('/login', data={'username': username, 'password': password}).status_code
+
+    def get(self, url):
+        response = self._client.get(url, headers={'Accept-Encoding': 'gzip'})
+        response.close()
+        return response.status_code
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # テストクライアントと同じくリダイレクトはたどらず、302をそのまま結果にする
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class _HTTPClient:
+    # 起動済みのサーバーにHTTPで接続する(flask runやgunicornで動かしているものを測る)
+    def __init__(self, base_url):
+        self._base_url = base_url.rstrip('/')
+        self._opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect)
+
+    def _open(self, url, data=None, encoding='gzip'):
+        request = urllib.request.Request(self._base_url + url, data=data, headers={'Accept-Encoding': encoding})
+        try:
+            with self._opener.open(request) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, b''
+
+    def login(self, username, password):
+        # サーバー側ではCSRFが有効なので、ログインページのトークンを添えて送る
+        page = self._open('/login', encoding='identity')[1].decode()
+        token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', page)
+        form = {'username': username, 'password': password, 'csrf_token': token.group(1) if token else ''}
+        return self._open('/login', urllib.parse.urlencode(form).encode())[0]
+
+    def get(self, url):
+        return self._open(url)[0]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    # 最近接順位法: 値の fraction 以上がこの値以下になる最小の値
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+def sample_parameters(conn, rng, count):
+    # 各リクエストで使うIDをデータベースから選んでおく(計測中にクエリを増やさないため)
+    def column(sql):
+        return [row[0] for row in conn.execute(sql)]
+
+    portfolios = column('SELECT id FROM portfolio ORDER BY random() LIMIT 1000')
+    students = column("SELECT id FROM user WHERE role = 'student' ORDER BY random() LIMIT 1000")
+    tags = conn.execute('SELECT id, name FROM tags ORDER BY random() LIMIT 100').fetchall()
+    years = column('SELECT DISTINCT graduation_year FROM student_stats WHERE graduation_year IS NOT NULL')
+    if not portfolios or not students or not tags:
+        raise click.ClickException('The database has no portfolios, students or tags; run "flask seed" first.')
+    return [{'portfolio': rng.choice(portfolios), 'student': rng.choice(students), 'year': rng.choice(years or ['']),
+             'word': urllib.parse.quote(rng.choice(SEARCH_WORDS)), 'tag': rng.choice(tags)[0],
+             'tag_name': urllib.parse.quote(rng.choice(tags)[1]), 'other_tag_name': urllib.parse.quote(rng.choice(tags)[1])}
+            for _ in range(count)]
+
+
+def run_scenario(make_client, credentials, role, url, parameters, concurrency, warmup, query_counter):
+    # スレッドごとにクライアント(セッション)を一つ作り、同時にconcurrency本のリクエストを流し続ける
+    local = threading.local()
+
+    def client():
+        if not hasattr(local, 'client'):
+            local.client = make_client()
+            # ログインに成功するとリダイレクト(302)が返る
+            if role is not None and local.client.login(*credentials[role]) != 302:
+                raise click.ClickException(f'Could not log in as {credentials[role][0]}.')
+        return local.client
+
+    def one(values):
+        target = url.format(**values)
+        session = client()
+        query_counter.reset()
+        started = time.perf_counter()
+        status = session.get(target)
+        elapsed = time.perf_counter() - started
+        return elapsed, status, query_counter.count()
+
+    # 先頭のwarmup * concurrency件は計測しない(ログインやキャッシュの読み込みを済ませる)
+    skipped = warmup * concurrency
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, parameters[:skipped]))
+        started = time.perf_counter()
+        results = list(pool.map(one, parameters[skipped:]))
+        wall = time.perf_counter() - started
+
+    latencies = sorted(result[0] * 1000 for result in results)
+    queries = [result[2] for result in results if result[2] is not None]
+    errors = sum(1 for result in results if result[1] >= 400)
+    return {
+        'requests': len(results),
+        'errors': errors,
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'throughput_rps': len(results) / wall if wall else None,
+        'queries_per_request': statistics.mean(queries) if queries else None,
+    }
+
+
+class _QueryCounter:
+    # トレースコールバックはSQLを実行したスレッドで呼ばれるので、スレッドごとに数える
+    def __init__(self):
+        self._local = threading.local()
+        self.enabled = False
+
+    def __call__(self, statement):
+        # トリガーの中の文は "-- TRIGGER ..." として届くので数えない
+        if not statement.startswith('--'):
+            self._local.count = getattr(self._local, 'count', 0) + 1
+
+    def reset(self):
+        self._local.count = 0
+
+    def count(self):
+        return self._local.count if self.enabled else None
+
+
+def compare(results, baseline, threshold):
+    # p95とクエリ数がベースラインより悪化したシナリオを返す
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        if previous.get('p95_ms') and result['p95_ms'] > previous['p95_ms'] * (1 + threshold):
+            regressions.append(f"{name}: p95 {previous['p95_ms']:.1f}ms -> {result['p95_ms']:.1f}ms")
+        if (previous.get('queries_per_request') is not None and result['queries_per_request'] is not None
+                and result['queries_per_request'] > previous['queries_per_request'] + 0.5):
+            regressions.append(f"{name}: queries/request {previous['queries_per_request']:.1f} -> "
+                               f"{result['queries_per_request']:.1f}")
+    return regressions
+
+
+@click.command('bench')
+@click.option('--requests', 'count', default=200, show_default=True, help='Measured requests per route.')
+@click.option('--concurrency', default=4, show_default=True)
+@click.option('--warmup', default=2, show_default=True, help='Unmeasured requests per thread before measuring.')
+@click.option('--route', 'routes', multiple=True, type=click.Choice([scenario[0] for scenario in SCENARIOS]),
+              help='Only run these routes (repeatable).')
+@click.option('--server', default=None, help='Benchmark a running server (e.g. http://127.0.0.1:5003) '
+                                              'instead of the in-process test client.')
+@click.option('--teacher', default=None, help='Teacher username (defaults to the first teacher).')
+@click.option('--student', default=None, help='Student username (defaults to the first student with portfolios).')
+@click.option('--password', default=DEFAULT_PASSWORD, show_default=True)
+@click.option('--output', type=click.Path(dir_okay=False), default=None, help='Write results as JSON.')
+@click.option('--baseline', type=click.Path(dir_okay=False), default=None,
+              help='Compare with results written earlier by --output.')
+@click.option('--threshold', default=0.2, show_default=True, help='Allowed p95 slowdown against the baseline.')
+@click.option('--seed', 'random_seed', default=0, show_default=True)
+def bench_command(count, concurrency, warmup, routes, server, teacher, student, password, output, baseline,
+                  threshold, random_seed):
+    app = current_app._get_current_object()
+    conn = db.open_connection(app, readonly=True)
+    try:
+        teacher = teacher or conn.execute("SELECT username FROM user WHERE role = 'teacher' ORDER BY id").fetchone()
+        student = student or conn.execute('SELECT username FROM user WHERE id = (SELECT user_id FROM portfolio '
+                                          'ORDER BY id LIMIT 1)').fetchone()
+        if teacher is None or student is None:
+            raise click.ClickException('No teacher or student to log in as; run "flask seed" first.')
+        credentials = {'teacher': (teacher if isinstance(teacher, str) else teacher[0], password),
+                       'student': (student if isinstance(student, str) else student[0], password)}
+        parameters = sample_parameters(conn, random.Random(random_seed), count + warmup * concurrency)
+    finally:
+        conn.close()
+
+    counter = _QueryCounter()
+    if server:
+        def make_client():
+            return _HTTPClient(server)
+    else:
+        # テストクライアントからのPOSTではCSRFトークンを送れないので、計測中だけ無効にする
+        app.config['WTF_CSRF_ENABLED'] = False
+        db.add_trace_hook(app, counter)
+        counter.enabled = True
+
+        def make_client():
+            return _TestClient(app)
+
+    results = {}
+    click.echo(f"{'route':<28}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'req/s':>9}{'queries':>9}{'errors':>8}")
+    for name, role, url in SCENARIOS:
+        if routes and name not in routes:
+            continue
+        result = run_scenario(make_client, credentials, role, url, parameters, concurrency, warmup, counter)
+        results[name] = result
+        queries = result['queries_per_request']
+        click.echo(f"{name:<28}{result['p50_ms']:>9.1f}{result['p95_ms']:>9.1f}{result['p99_ms']:>9.1f}"
+                   f"{result['throughput_rps']:>9.1f}{'-' if queries is None else f'{queries:.1f}':>9}"
+                   f"{result['errors']:>8}")
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump({'concurrency': concurrency, 'results': results}, f, indent=2)
+    if baseline:
+        with open(baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f)['results'], threshold)
+        if regressions:
+            for line in regressions:
+                click.echo(f'REGRESSION {line}', err=True)
+            raise SystemExit(1)
+        click.echo('No regressions against the baseline.')
@@ -0,0 +1,22 @@
+import zlib
+
+
+# ポートフォリオの本文の保存形式(portfolio_body.body)。長い本文はzlibで圧縮してBLOBで持ち、
+# 短いもの・縮まないものはTEXTのまま持つ。どちらかは値の型で見分けるので、形式を表す列はいらない
+COMPRESS_MIN = 512  # これより短い本文(UTF-8のバイト数)は圧縮しない
+LEVEL = 6
+
+
+def pack(text):
+    data = text.encode('utf-8')
+    if len(data) < COMPRESS_MIN:
+        return text
+    packed = zlib.compress(data, LEVEL)
+    return packed if len(packed) < len(data) else text
+
+
+def unpack(body):
+    # SQLからは body_text() として呼べる(db.connect()で登録する)
+    if isinstance(body, bytes):
+        return zlib.decompress(body).decode('utf-8')
+    return body
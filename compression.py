@@ -0,0 +1,74 @@
+import gzip
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# これより小さいレスポンスは圧縮してもヘッダーの分だけ得にならない
+MIN_SIZE = 500
+
+COMPRESSIBLE_TYPES = ('text/html', 'text/css', 'text/plain', 'text/csv', 'application/json',
+                      'application/javascript', 'application/x-ndjson', 'image/svg+xml')
+
+
+ENCODINGS = ('br', 'gzip')
+
+
+def available_encodings():
+    # サーバーが出せる符号化方式を優先順に返す(brotliはライブラリがあるときだけ)
+    return ENCODINGS if brotli is not None else ('gzip',)
+
+
+def etag_matches(etag):
+    # 圧縮したレスポンスのETagには符号化方式を付けるので(compress_response)、If-None-Matchではどの形も同じ内容とみなす
+    return any(request.if_none_match.contains(tag) for tag in (etag, *(f'{etag}-{encoding}' for encoding in ENCODINGS)))
+
+
+def negotiate(encodings=None):
+    # Accept-Encodingのq値を見て、使える方式のうち最も好まれるものを選ぶ。なければNone
+    best = None
+    best_quality = 0
+    for encoding in encodings or available_encodings():
+        quality = request.accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(data, encoding, brotli_quality=5, gzip_level=6):
+    if encoding == 'br':
+        return brotli.compress(data, quality=brotli_quality)
+    return gzip.compress(data, compresslevel=gzip_level, mtime=0)
+
+
+def compress_response(response):
+    # after_requestから呼ぶ。ストリーミング中のレスポンスや圧縮済みのもの、本文のないものはそのまま返す
+    if response.mimetype not in COMPRESSIBLE_TYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    etag, weak = response.get_etag()
+    if response.status_code == 304 and etag:
+        # 304には、クライアントが持っている(圧縮した)方のETagをそのまま返す
+        for encoding in ENCODINGS:
+            if request.if_none_match.contains(f'{etag}-{encoding}'):
+                response.set_etag(f'{etag}-{encoding}', weak)
+                break
+    if (response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers
+            or response.status_code in (204, 304)):
+        return response
+    encoding = negotiate()
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if len(data) < MIN_SIZE:
+        return response
+    response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    if etag:
+        # 強いETagは同じバイト列を表すので、圧縮したものには符号化方式ごとに別のETagを付ける
+        response.set_etag(f'{etag}-{encoding}', weak)
+    return response
@@ -2,4 +2,6 @@ import os
 
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
-    WTF_CSRF_ENABLED = True
\ No newline at end of file
+    WTF_CSRF_ENABLED = True
+    DATABASE = os.environ.get('DATABASE') or 'eportfolio.db'
+    PAGE_SIZE = 20  # 一覧ページの1ページあたりの件数
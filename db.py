@@ -0,0 +1,269 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g
+
+from bodies import unpack as unpack_body
+from search import to_bigrams
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class Cursor(sqlite3.Cursor):
+    # 接続にobserverが設定されているときに使うカーソル。executeにかかった時間を observer(conn, sql, params, 秒) で知らせる
+    # (行の読み出しはCの実装のまま。遅いクエリの検出には実行の時間で足りる)
+    def execute(self, sql, parameters=()):
+        observer = self.connection.observer
+        if observer is None:
+            return super().execute(sql, parameters)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            observer(self.connection, sql, parameters, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        observer = self.connection.observer
+        if observer is None:
+            return super().executemany(sql, seq_of_parameters)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            observer(self.connection, sql, None, time.perf_counter() - started)
+
+
+class Connection(sqlite3.Connection):
+    # observerがないとき(計測しないリクエスト)は標準のカーソルを使い、Pythonの処理を挟まない
+    observer = None
+
+    def cursor(self, factory=None):
+        if factory is None:
+            factory = sqlite3.Cursor if self.observer is None else Cursor
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        if self.observer is None:
+            return super().execute(sql, parameters)
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        if self.observer is None:
+            return super().executemany(sql, seq_of_parameters)
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connect(database, readonly=False, busy_timeout=5000, synchronous='NORMAL',
+            cache_size=-16000, mmap_size=268435456, cached_statements=256):
+    # sqlite3はSQL文字列ごとに準備済みの文を接続内にキャッシュする(repository.pyの定数を使えば同じ文字列になる)
+    conn = sqlite3.connect(database, timeout=busy_timeout / 1000, check_same_thread=False, factory=Connection,
+                           cached_statements=cached_statements)
+    conn.row_factory = sqlite3.Row
+    # 全文検索インデックスを更新するトリガーから呼ばれる
+    conn.create_function('bigrams', 1, to_bigrams, deterministic=True)
+    # 圧縮して保存したポートフォリオの本文を戻す(全文検索のトリガーやエクスポートから使う)
+    conn.create_function('body_text', 1, unpack_body, deterministic=True)
+    # WALはデータベースファイルに記録されるので書き込み側で一度設定すれば読み込み側にも効く
+    if not readonly:
+        conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute(f'PRAGMA busy_timeout = {int(busy_timeout)}')
+    conn.execute(f'PRAGMA synchronous = {synchronous}')
+    conn.execute(f'PRAGMA cache_size = {int(cache_size)}')
+    conn.execute(f'PRAGMA mmap_size = {int(mmap_size)}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    if readonly:
+        conn.execute('PRAGMA query_only = 1')
+    return conn
+
+
+class ConnectionPool:
+    def __init__(self, factory, size, timeout):
+        self._factory = factory
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._timeout = timeout
+
+    def acquire(self):
+        if not self._slots.acquire(timeout=self._timeout):
+            raise PoolTimeout('No database connection became available in time')
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self._factory()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # 壊れた接続はプールに戻さない
+            conn.close()
+        else:
+            self._idle.put(conn)
+        self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def read_generation(conn, name):
+    # プロセス内キャッシュの世代番号(cache_generationテーブルをトリガーが更新する)
+    row = conn.execute('SELECT value FROM cache_generation WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else 0
+
+
+def _connection_options(app):
+    return {
+        'busy_timeout': app.config['DB_BUSY_TIMEOUT'],
+        'synchronous': app.config['DB_SYNCHRONOUS'],
+        'cache_size': app.config['DB_CACHE_SIZE'],
+        'mmap_size': app.config['DB_MMAP_SIZE'],
+        'cached_statements': app.config['DB_STATEMENT_CACHE'],
+    }
+
+
+def open_connection(app, readonly=False):
+    return connect(app.config['DATABASE'], readonly=readonly, **_connection_options(app))
+
+
+def _get_pools(app):
+    # フォーク後の子プロセスは親の接続を引き継がず、自分のプールを作り直す
+    state = app.extensions.get('db_pools')
+    if state is None or state[0] != os.getpid():
+        timeout = app.config['DB_POOL_TIMEOUT']
+        pools = {
+            True: ConnectionPool(lambda: open_connection(app, readonly=True),
+                                 app.config['DB_READ_POOL_SIZE'], timeout),
+            False: ConnectionPool(lambda: open_connection(app),
+                                  app.config['DB_WRITE_POOL_SIZE'], timeout),
+        }
+        state = app.extensions['db_pools'] = (os.getpid(), pools)
+    return state[1]
+
+
+def add_trace_hook(app, hook, when=None):
+    # 実行されるSQL文ごとにhook(statement)を呼ぶ(ベンチマークのクエリ数の計測など)。
+    # プールの接続を貸し出すときに設定するので、登録前に作られた接続にも効く。
+    # when()を渡すと、貸し出す時点でそれが真のときだけ設定する(トレース中はSQLの展開に手間がかかるため)
+    app.extensions.setdefault('db_trace_hooks', []).append((hook, when))
+
+
+def add_timing_hook(app, hook, when=None):
+    # 実行時間を測るSQL文ごとに hook(conn, sql, params, 秒) を呼ぶ(遅いクエリの記録など)。whenはadd_trace_hookと同じ
+    app.extensions.setdefault('db_timing_hooks', []).append((hook, when))
+
+
+def remove_timing_hook(app, hook):
+    # add_timing_hookで登録したhookを外す。貸し出し中の接続には、次に貸し出すときから効く
+    hooks = app.extensions.get('db_timing_hooks', [])
+    hooks[:] = [entry for entry in hooks if entry[0] is not hook]
+
+
+def _trace_callback(app):
+    hooks = [hook for hook, when in app.extensions.get('db_trace_hooks', ()) if when is None or when()]
+    if not hooks:
+        return None
+
+    def trace(statement):
+        for hook in hooks:
+            hook(statement)
+    return trace
+
+
+def _observer(app):
+    hooks = [hook for hook, when in app.extensions.get('db_timing_hooks', ()) if when is None or when()]
+    if not hooks:
+        return None
+
+    def observe(conn, sql, parameters, seconds):
+        for hook in hooks:
+            hook(conn, sql, parameters, seconds)
+    return observe
+
+
+def _instrument(app, conn):
+    conn.set_trace_callback(_trace_callback(app))
+    conn.observer = _observer(app)
+
+
+@contextmanager
+def pooled_connection(app, readonly=False):
+    # リクエストの外(ストリーミングレスポンスの生成中など)でプールの接続を使う
+    pool = _get_pools(app)[readonly]
+    conn = pool.acquire()
+    _instrument(app, conn)
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+def warm_pool(app, readonly=False, statements=()):
+    # プールの接続をすべて開き、よく使うSQLを一度ずつ実行して接続ごとの文のキャッシュに載せておく
+    pool = _get_pools(app)[readonly]
+    conns = []
+    try:
+        for _ in range(pool.size):
+            conns.append(pool.acquire())
+            _instrument(app, conns[-1])
+        for conn in conns:
+            for sql, parameters in statements:
+                try:
+                    conn.execute(sql, parameters).fetchone()
+                except sqlite3.Error:
+                    pass
+    finally:
+        for conn in conns:
+            pool.release(conn)
+    return len(conns)
+
+
+def get_db_connection(readonly=False):
+    # リクエスト(アプリコンテキスト)ごとに読み込み用・書き込み用の接続を一つずつ借りる
+    key = '_db_read' if readonly else '_db_write'
+    conn = g.get(key)
+    if conn is None:
+        app = current_app._get_current_object()
+        conn = _get_pools(app)[readonly].acquire()
+        _instrument(app, conn)
+        setattr(g, key, conn)
+    return conn
+
+
+def close_db(exception=None):
+    pools = None
+    for readonly, key in ((True, '_db_read'), (False, '_db_write')):
+        conn = g.pop(key, None)
+        if conn is not None:
+            if pools is None:
+                pools = _get_pools(current_app._get_current_object())
+            pools[readonly].release(conn)
+
+
+def init_app(app):
+    app.config.setdefault('DATABASE', 'eportfolio.db')
+    app.config.setdefault('DB_READ_POOL_SIZE', 8)
+    app.config.setdefault('DB_WRITE_POOL_SIZE', 2)
+    app.config.setdefault('DB_POOL_TIMEOUT', 10)
+    app.config.setdefault('DB_BUSY_TIMEOUT', 5000)
+    app.config.setdefault('DB_SYNCHRONOUS', 'NORMAL')
+    app.config.setdefault('DB_CACHE_SIZE', -16000)
+    app.config.setdefault('DB_MMAP_SIZE', 268435456)
+    app.config.setdefault('DB_STATEMENT_CACHE', 256)
+    app.teardown_appcontext(close_db)
@@ -0,0 +1,241 @@
+import hashlib
+import operator
+import os
+import random
+import struct
+import sys
+import time
+import unicodedata
+import zlib
+from array import array
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+import bodies
+import db
+import repository
+
+try:
+    import numpy as np
+except ImportError:  # NumPyがなければ同じ計算をPythonで行う(遅いが結果は同じ)
+    np = None
+
+
+duplicates_cli = AppGroup('duplicates', help='Find near-duplicate portfolios with MinHash signatures.')
+
+SHINGLE = 5  # 本文を何文字ずつの重なりで比べるか
+NUM_PERM = 128  # 署名の長さ(ハッシュ関数の数)
+# LSHのバンド。4つずつ32組に分け、どれか1組が全て一致した組を候補にする。
+# 重なりの割合(Jaccard係数)が0.4あたりから候補に入り始め、0.6なら9割以上が候補に入る
+BANDS = 32
+ROWS = NUM_PERM // BANDS
+
+_PRIME = (1 << 61) - 1
+_MASK = (1 << 64) - 1
+_MAX_HASH = (1 << 32) - 1
+# ハッシュ関数 h(x) = ((a * x + b) mod 2^64) mod p の係数。署名を比べられるよう、全プロセスで同じ値にする
+_random = random.Random(20240401)
+_PERMUTATIONS = [(_random.randrange(1, _PRIME), _random.randrange(0, _PRIME)) for _ in range(NUM_PERM)]
+if np is not None:
+    _A = np.array([a for a, _ in _PERMUTATIONS], dtype=np.uint64)
+    _B = np.array([b for _, b in _PERMUTATIONS], dtype=np.uint64)
+
+# 重複の候補の1組(first と second は models.PortfolioOwner)
+Duplicate = namedtuple('Duplicate', ['similarity', 'first', 'second'])
+
+
+def _shingles(text):
+    # 空白や改行の違い、全角・半角の違いでは変わらないように、そろえてから空白を除いて区切る
+    text = ''.join(unicodedata.normalize('NFKC', text or '').lower().split())
+    return {zlib.crc32(text[i:i + SHINGLE].encode('utf-8')) for i in range(len(text) - SHINGLE + 1)}
+
+
+def signature(text):
+    # MinHash署名(32ビット整数 NUM_PERM 個)と、区切った断片の数を返す。
+    # 二つの署名で一致する要素の割合が、断片の集合の重なりの割合の推定になる
+    shingles = _shingles(text)
+    if not shingles:
+        return [_MAX_HASH] * NUM_PERM, 0
+    if np is not None:
+        values = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))
+        # uint64の掛け算・足し算のあふれは mod 2^64 と同じ
+        hashes = (np.outer(values, _A) + _B) % np.uint64(_PRIME) & np.uint64(_MAX_HASH)
+        return hashes.min(axis=0).tolist(), len(shingles)
+    return [min((((a * value + b) & _MASK) % _PRIME) & _MAX_HASH for value in shingles)
+            for a, b in _PERMUTATIONS], len(shingles)
+
+
+def pack_signature(values):
+    # 4バイトずつの配列のBLOB(1件512バイト)。どの環境で作っても同じになるようにリトルエンディアンにそろえる
+    packed = array('I', values)
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_signature(blob):
+    values = array('I')
+    values.frombytes(blob)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+def buckets(values):
+    # バンドごとのハッシュ(SQLiteの整数に収まる64ビット)
+    return [int.from_bytes(hashlib.blake2b(struct.pack(f'<{ROWS}I', *values[band * ROWS:(band + 1) * ROWS]),
+                                           digest_size=8).digest(), 'little', signed=True)
+            for band in range(BANDS)]
+
+
+def similarity(first, second):
+    # 署名(unpack_signature したもの)の要素が一致する割合
+    return sum(map(operator.eq, first, second)) / NUM_PERM
+
+
+def compute(content):
+    # 保存する署名・断片の数・バケットを計算する。NumPyがないと長い本文では1秒を超えるので、
+    # 作成・編集では書き込みトランザクションを始める前に呼び、結果を record() に渡す
+    values, count = signature(content)
+    return pack_signature(values), count, buckets(values)
+
+
+def _compute(body):
+    # 一括計算のプロセスプールで実行する(展開も子プロセスで行う)
+    return compute(bodies.unpack(body))
+
+
+def _store(conn, portfolio_id, computed, min_shingles, body=None, check=False):
+    blob, count, hashes = computed
+    if check:
+        # 読んでから書くまでの間に本文が書き換えられていたら保存しない(編集した側が計算し直している)
+        stored = conn.execute(
+            'INSERT OR IGNORE INTO portfolio_minhash (portfolio_id, shingles, signature) SELECT ?, ?, ? '
+            'WHERE (SELECT body FROM portfolio_body WHERE portfolio_id = ?) IS ?',
+            (portfolio_id, count, blob, portfolio_id, body)).rowcount
+        if not stored:
+            return False
+    else:
+        conn.execute('INSERT OR REPLACE INTO portfolio_minhash (portfolio_id, shingles, signature) VALUES (?, ?, ?)',
+                     (portfolio_id, count, blob))
+    conn.execute('DELETE FROM portfolio_lsh WHERE portfolio_id = ?', (portfolio_id,))
+    # 短すぎる本文はありふれた言い回しだけで一致するので、候補探しには使わない
+    if count >= min_shingles:
+        conn.executemany('INSERT OR IGNORE INTO portfolio_lsh (band, bucket, portfolio_id) VALUES (?, ?, ?)',
+                         [(band, bucket, portfolio_id) for band, bucket in enumerate(hashes)])
+    return True
+
+
+def record(conn, portfolio_id, computed):
+    # ポートフォリオの作成・編集の書き込みトランザクションの中で、compute() の結果を保存する。
+    # 本文が変わると portfolio_body のトリガーが古い署名を消すので、署名がないときだけ保存する
+    if repository.has_minhash(conn, portfolio_id):
+        return
+    _store(conn, portfolio_id, computed, current_app.config['DUPLICATES_MIN_SHINGLES'])
+
+
+def _scores(signatures, pairs):
+    # 候補の組ごとの署名の一致率。NumPyがあれば全ての組をまとめて比べる
+    if np is not None:
+        index = {portfolio_id: i for i, portfolio_id in enumerate(signatures)}
+        matrix = np.frombuffer(b''.join(signatures.values()), dtype='<u4').reshape(-1, NUM_PERM)
+        first = np.fromiter((index[first_id] for first_id, _ in pairs), dtype=np.int64, count=len(pairs))
+        second = np.fromiter((index[second_id] for _, second_id in pairs), dtype=np.int64, count=len(pairs))
+        return ((matrix[first] == matrix[second]).sum(axis=1) / NUM_PERM).tolist()
+    unpacked = {portfolio_id: unpack_signature(blob) for portfolio_id, blob in signatures.items()}
+    return [similarity(unpacked[first_id], unpacked[second_id]) for first_id, second_id in pairs]
+
+
+def find(conn, app, student_id=None):
+    # 同じバケットに入った別の生徒のポートフォリオの組を候補にし、署名の一致率が
+    # DUPLICATES_THRESHOLD 以上のものを高い順に返す。全件どうしは比べないので、件数にほぼ比例する時間で済む
+    threshold = app.config['DUPLICATES_THRESHOLD']
+    signatures = {}
+    pairs = []
+    for first_id, second_id, first, second in repository.duplicate_candidates(
+            conn, app.config['DUPLICATES_MAX_BUCKET'], student_id):
+        # 同じポートフォリオが多くの組に出てくるので、署名はIDごとに一つだけ持つ
+        signatures.setdefault(first_id, first)
+        signatures.setdefault(second_id, second)
+        pairs.append((first_id, second_id))
+    found = [(score, first_id, second_id) for score, (first_id, second_id) in zip(_scores(signatures, pairs), pairs)
+             if score >= threshold]
+    found.sort(key=lambda item: (-item[0], item[1], item[2]))
+    found = found[:app.config['DUPLICATES_REPORT_LIMIT']]
+    owners = {row.id: row for row in repository.portfolio_owners(
+        conn, sorted({portfolio_id for _, first_id, second_id in found for portfolio_id in (first_id, second_id)}))}
+    return [Duplicate(score, owners[first_id], owners[second_id]) for score, first_id, second_id in found]
+
+
+@duplicates_cli.command('backfill')
+@click.option('--processes', default=None, type=int, help='Worker processes (default: CPU count).')
+@click.option('--batch-size', default=500, show_default=True, help='Portfolios per transaction.')
+@click.option('--all', 'everything', is_flag=True, help='Recompute every signature, not only missing ones.')
+def backfill_command(processes, batch_size, everything):
+    # 署名のないポートフォリオ(一括登録したもの、この機能より前からあるもの)の署名を計算する。
+    # 計算はプロセスプールに分散し、書き込みは batch_size 件ごとのトランザクションで行う
+    app = current_app._get_current_object()
+    min_shingles = app.config['DUPLICATES_MIN_SHINGLES']
+    conn = db.open_connection(app)
+    conn.isolation_level = None
+    stored = 0
+    started = time.perf_counter()
+    try:
+        if everything:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM portfolio_lsh')
+            conn.execute('DELETE FROM portfolio_minhash')
+            conn.execute('COMMIT')
+        processes = processes or os.cpu_count()
+        with ProcessPoolExecutor(processes) as pool:
+            after = 0
+            while True:
+                rows = repository.missing_minhash(conn, after, batch_size)
+                if not rows:
+                    break
+                after = rows[-1][0]
+                # 計算が全て終わってから書き込みロックを取る
+                computed = list(pool.map(_compute, [body for _, body in rows],
+                                         chunksize=max(1, len(rows) // (processes * 4))))
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    for (portfolio_id, body), result in zip(rows, computed):
+                        stored += _store(conn, portfolio_id, result, min_shingles, body, check=True)
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+                click.echo(f'{stored} signatures', err=True)
+        conn.execute('PRAGMA optimize')
+    finally:
+        conn.close()
+    click.echo(f"{stored} signatures computed in {time.perf_counter() - started:.1f}s "
+               f"({'NumPy' if np is not None else 'pure Python'})")
+
+
+@duplicates_cli.command('report')
+@click.option('--student', type=int, help='Only pairs involving this student id.')
+def report_command(student):
+    app = current_app._get_current_object()
+    conn = db.open_connection(app, readonly=True)
+    try:
+        for duplicate in find(conn, app, student):
+            click.echo(f'{duplicate.similarity:.2f}  {duplicate.first.id} ({duplicate.first.username})  '
+                       f'{duplicate.second.id} ({duplicate.second.username})')
+    finally:
+        conn.close()
+
+
+def init_app(app):
+    # 重複とみなす署名の一致率(Jaccard係数の推定値)と、レポートに出す組の数
+    app.config.setdefault('DUPLICATES_THRESHOLD', 0.5)
+    app.config.setdefault('DUPLICATES_REPORT_LIMIT', 200)
+    # 候補探しに使う本文の断片の数の下限と、候補の組を作るバケットの大きさの上限
+    # (定型文をそのまま使ったものが大量に入ったバケットで、組の数が2乗に増えないように)
+    app.config.setdefault('DUPLICATES_MIN_SHINGLES', 20)
+    app.config.setdefault('DUPLICATES_MAX_BUCKET', 50)
+    app.cli.add_command(duplicates_cli)
@@ -0,0 +1,214 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+import click
+from flask import Blueprint, Response, abort, current_app, request, session, stream_with_context, url_for
+from flask.cli import AppGroup
+
+import db
+import repository
+
+
+events = Blueprint('events', __name__)
+events_cli = AppGroup('events', help='Manage the activity log behind the live teacher feed.')
+
+# 一度に読む・送る変更履歴の件数
+BATCH = 100
+
+_feed_lock = threading.Lock()
+
+
+class EventFeed:
+    # プロセスに一つ。接続中のストリームがある間だけ、1本のスレッドが EVENTS_POLL_INTERVAL 秒ごとに
+    # events の末尾を読んで手元に貯め、待っているストリームを起こす。
+    # 教師が何人つないでいても、DBへの問い合わせはプロセスごとに1本で済む
+    def __init__(self, app):
+        self._app = app
+        self._condition = threading.Condition()
+        self._events = deque()
+        # これより後のイベントは全て self._events にある
+        self._floor = None
+        self._listeners = 0
+        threading.Thread(target=self._run, name='event-feed', daemon=True).start()
+
+    def _run(self):
+        app = self._app
+        interval = app.config['EVENTS_POLL_INTERVAL']
+        size = app.config['EVENTS_BUFFER']
+        while True:
+            with self._condition:
+                while not self._listeners:
+                    # 誰も待っていない間は読まない。再開したときは取りこぼしがあり得るので読み直す
+                    self._events.clear()
+                    self._floor = None
+                    self._condition.wait()
+            try:
+                with db.pooled_connection(app, readonly=True) as conn:
+                    floor = self._floor
+                    if floor is None:
+                        floor = repository.latest_event_id(conn)
+                    last = self._events[-1].id if self._events else floor
+                    rows = repository.events_after(conn, last, BATCH)
+            except Exception:
+                app.logger.exception('Could not read the activity log')
+                rows = []
+            with self._condition:
+                started = self._floor is None
+                if started:
+                    self._floor = floor
+                self._events.extend(rows)
+                while len(self._events) > size:
+                    self._floor = self._events.popleft().id
+                if started or rows:
+                    self._condition.notify_all()
+            # 1回で読み切れなかったときは待たずに続きを読む
+            if len(rows) < BATCH:
+                time.sleep(interval)
+
+    @property
+    def floor(self):
+        return self._floor
+
+    def subscribe(self, limit):
+        # 同時に開いておくストリームの数を limit までに抑える(一つのストリームがスレッドを一つ占有するため)
+        with self._condition:
+            if self._listeners >= limit:
+                return False
+            self._listeners += 1
+            self._condition.notify_all()
+            return True
+
+    def unsubscribe(self):
+        with self._condition:
+            self._listeners -= 1
+
+    def wait(self, after, timeout):
+        # after より後のイベントを返す(なければ timeout 秒まで待つ)。
+        # 手元にない古いところから読む必要があるときは None を返す(呼び出し側がDBから読む)
+        with self._condition:
+            if self._floor is None or not self._events or self._events[-1].id <= after:
+                self._condition.wait(timeout)
+            if self._floor is None:
+                return []
+            if after < self._floor:
+                return None
+            return [event for event in self._events if event.id > after]
+
+
+def get_feed(app):
+    # フォーク後の子プロセスは自分のスレッドを作り直す
+    with _feed_lock:
+        state = app.extensions.get('event_feed')
+        if state is None or state[0] != os.getpid():
+            state = app.extensions['event_feed'] = (os.getpid(), EventFeed(app))
+        return state[1]
+
+
+def format_event(event, url):
+    data = {'id': event.id, 'kind': event.kind, 'portfolio_id': event.portfolio_id, 'student_id': event.user_id,
+            'username': event.username, 'title': event.title, 'created_at': event.created_at, 'url': url}
+    return f'id: {event.id}\nevent: {event.kind}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+
+@events.route('/events') # 教師用のライブ更新(Server-Sent Events)
+def stream():
+    if session.get('role') != 'teacher':
+        abort(403)
+    app = current_app._get_current_object()
+    teacher_id = session['user_id']
+    student_id = request.args.get('student', type=int)
+    portfolio_id = request.args.get('portfolio', type=int)
+    # 再接続のときはブラウザが最後に受け取ったIDを Last-Event-ID で送ってくる。初回は今より後だけを送る
+    after = request.headers.get('Last-Event-ID', type=int)
+    if after is None:
+        after = request.args.get('after', type=int)
+    if after is None:
+        with db.pooled_connection(app, readonly=True) as conn:
+            after = repository.latest_event_id(conn)
+    feed = get_feed(app)
+    heartbeat = app.config['EVENTS_HEARTBEAT']
+
+    def wanted(event):
+        # 自分の操作と、見ている生徒・ポートフォリオ以外のものは送らない
+        return (event.actor_id != teacher_id
+                and (student_id is None or event.user_id == student_id)
+                and (portfolio_id is None or event.portfolio_id == portfolio_id))
+
+    def generate():
+        nonlocal after
+        # ストリームはスレッドを一つ占有するので、EVENTS_STREAM_TIMEOUT 秒で閉じてブラウザに再接続させる。
+        # 閉じたあとはEventSourceが retry ミリ秒後に Last-Event-ID を付けてつなぎ直すので、取りこぼしはない
+        if not feed.subscribe(app.config['EVENTS_MAX_STREAMS']):
+            # 空きがなければすぐに閉じて、しばらくしてからつなぎ直してもらう
+            yield f"retry: {app.config['EVENTS_BUSY_RETRY']}\n\n"
+            return
+        deadline = time.monotonic() + app.config['EVENTS_STREAM_TIMEOUT']
+        yield f"retry: {app.config['EVENTS_RETRY']}\n\n"
+        sent = time.monotonic()
+        try:
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                batch = feed.wait(after, min(heartbeat, deadline - now))
+                if batch is None:
+                    with db.pooled_connection(app, readonly=True) as conn:
+                        batch = repository.events_after(conn, after, BATCH)
+                    if not batch:
+                        # 間の分が flask events prune で消えていた
+                        after = feed.floor or after
+                chunks = []
+                for event in batch:
+                    after = event.id
+                    if wanted(event):
+                        url = url_for('main.show_portfolio_with_comment', portfolio_id=event.portfolio_id)
+                        chunks.append(format_event(event, None if event.kind == 'portfolio_deleted' else url))
+                if chunks:
+                    yield ''.join(chunks)
+                    sent = time.monotonic()
+                elif time.monotonic() - sent >= heartbeat:
+                    # 途中のプロキシに切られないように、コメント行だけを送る
+                    yield ': keepalive\n\n'
+                    sent = time.monotonic()
+        finally:
+            feed.unsubscribe()
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # nginxなどがバッファに溜めずにそのまま流すように
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@events_cli.command('prune')
+@click.option('--days', default=7, show_default=True, help='Keep this many days of activity.')
+def prune_command(days):
+    # ライブ更新に使うのは直近の分だけなので、古い変更履歴を消す
+    conn = db.open_connection(current_app._get_current_object())
+    try:
+        count = conn.execute("DELETE FROM events WHERE created_at < datetime('now', ?)",
+                             (f'-{days} days',)).rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    click.echo(f'{count} events removed')
+
+
+def init_app(app):
+    # 変更履歴を読む間隔(秒)と、何も送らないときにコメント行を送る間隔(秒)
+    app.config.setdefault('EVENTS_POLL_INTERVAL', 1.0)
+    app.config.setdefault('EVENTS_HEARTBEAT', 15)
+    # 一つのストリームを開いておく長さ(秒)と、閉じたあとにブラウザがつなぎ直すまでの間隔(ミリ秒)
+    app.config.setdefault('EVENTS_STREAM_TIMEOUT', 60)
+    app.config.setdefault('EVENTS_RETRY', 1000)
+    # プロセスごとに同時に開いておくストリームの数(gunicornのスレッド数より少なくする)と、
+    # それを超えたときにつなぎ直してもらうまでの間隔(ミリ秒)
+    app.config.setdefault('EVENTS_MAX_STREAMS', 2)
+    app.config.setdefault('EVENTS_BUSY_RETRY', 15000)
+    # プロセスごとに手元に置いておく件数。これより古い分から再開するストリームはDBから読む
+    app.config.setdefault('EVENTS_BUFFER', 1000)
+    app.register_blueprint(events)
+    app.cli.add_command(events_cli)
@@ -0,0 +1,133 @@
+import csv
+import io
+import json
+
+import click
+from flask import current_app
+
+import db
+
+
+FORMATS = ('csv', 'jsonl')
+
+# 種類ごとのSQL。列名はflask importの入力形式に合わせてあるので、そのまま取り込み直せる
+_QUERIES = {
+    'students': '''
+        SELECT u.id, u.username, u.student_number, u.name, u.grade, u.graduation_year, u.bio
+        FROM user AS u
+        WHERE u.role = 'student' {filters}
+        ORDER BY u.id
+    ''',
+    'portfolios': '''
+        SELECT p.id, u.username, p.title,
+               (SELECT body_text(body) FROM portfolio_body WHERE portfolio_id = p.id) AS content, p.created_at,
+               (SELECT group_concat(t.name, ';') FROM portfolio_tags AS pt JOIN tags AS t ON t.id = pt.tag_id
+                WHERE pt.portfolio_id = p.id) AS tags
+        FROM portfolio AS p JOIN user AS u ON u.id = p.user_id
+        WHERE 1 {filters}
+        ORDER BY p.id
+    ''',
+    'tags': '''
+        SELECT t.id, t.name FROM tags AS t
+        WHERE 1 {filters}
+        ORDER BY t.id
+    ''',
+    'portfolio-tags': '''
+        SELECT pt.portfolio_id, t.name AS tag
+        FROM portfolio_tags AS pt
+        JOIN tags AS t ON t.id = pt.tag_id
+        JOIN portfolio AS p ON p.id = pt.portfolio_id
+        JOIN user AS u ON u.id = p.user_id
+        WHERE 1 {filters}
+        ORDER BY pt.portfolio_id, pt.tag_id
+    ''',
+    'comments': '''
+        SELECT c.id, c.portfolio_id, u.username AS student, teacher.username AS teacher,
+               c.comment, c.rating, c.created_at
+        FROM comments AS c
+        JOIN portfolio AS p ON p.id = c.portfolio_id
+        JOIN user AS u ON u.id = p.user_id
+        LEFT JOIN user AS teacher ON teacher.id = c.teacher_id
+        WHERE 1 {filters}
+        ORDER BY c.id
+    ''',
+}
+
+KINDS = tuple(_QUERIES)
+
+_TAGGED = 'SELECT pt.portfolio_id FROM portfolio_tags AS pt JOIN tags AS tg ON tg.id = pt.tag_id WHERE tg.name = ?'
+
+
+def _filters(kind, graduation_year, tag):
+    clauses = []
+    params = []
+    if graduation_year:
+        if kind == 'tags':
+            clauses.append('''t.id IN (SELECT pt.tag_id FROM portfolio_tags AS pt
+                                       JOIN portfolio AS p ON p.id = pt.portfolio_id
+                                       JOIN user AS u ON u.id = p.user_id WHERE u.graduation_year = ?)''')
+        else:
+            clauses.append('u.graduation_year = ?')
+        params.append(graduation_year)
+    if tag:
+        if kind == 'students':
+            clauses.append(f'u.id IN (SELECT user_id FROM portfolio WHERE id IN ({_TAGGED}))')
+        elif kind == 'tags':
+            clauses.append('t.name = ?')
+        else:
+            clauses.append(f'p.id IN ({_TAGGED})')
+        params.append(tag)
+    return ''.join(f' AND {clause}' for clause in clauses), params
+
+
+def export_chunks(conn, kind, fmt, graduation_year=None, tag=None, batch_size=500):
+    # カーソルからfetchmanyで少しずつ読み、読んだ分だけ文字列にして返す(全件をメモリに載せない)
+    filters, params = _filters(kind, graduation_year, tag)
+    cursor = conn.execute(_QUERIES[kind].format(filters=filters), params)
+    columns = [description[0] for description in cursor.description]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == 'csv':
+        # Excelで文字化けしないようにBOMを付ける(flask importはBOM付きでも読める)
+        buffer.write('\ufeff')
+        writer.writerow(columns)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        if fmt == 'csv':
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                buffer.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+                buffer.write('\n')
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def content_type(fmt):
+    return 'text/csv; charset=utf-8' if fmt == 'csv' else 'application/x-ndjson; charset=utf-8'
+
+
+def stream_export(app, kind, fmt, graduation_year=None, tag=None):
+    # レスポンスを返し終わるまで読み込み用の接続をプールから借り続ける
+    with db.pooled_connection(app, readonly=True) as conn:
+        yield from export_chunks(conn, kind, fmt, graduation_year, tag)
+
+
+@click.command('export')
+@click.argument('kind', type=click.Choice(KINDS))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default='csv', show_default=True)
+@click.option('--graduation-year', default=None, help='Only students graduating in this year.')
+@click.option('--tag', default=None, help='Only portfolios carrying this tag name.')
+@click.option('-o', '--output', type=click.File('w', encoding='utf-8'), default='-', help='Output file.')
+def export_command(kind, fmt, graduation_year, tag, output):
+    conn = db.open_connection(current_app._get_current_object(), readonly=True)
+    try:
+        for chunk in export_chunks(conn, kind, fmt, graduation_year, tag):
+            output.write(chunk)
+    finally:
+        conn.close()
@@ -1,7 +1,11 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField, TextAreaField, SelectField, SelectMultipleField
+from flask_wtf.file import FileField, FileRequired
 from wtforms.validators import DataRequired, Length
 
+# ポートフォリオの本文の上限(文字数)。保存時の重複チェックの署名の計算がこれに比例する
+PORTFOLIO_CONTENT_MAX = 20000
+
 class RegistrationForm(FlaskForm):
     username = StringField('Username', validators=[DataRequired(), Length(max=64)])
     password = PasswordField('Password', validators=[DataRequired()])
@@ -15,7 +19,7 @@ class LoginForm(FlaskForm):
 
 class PortfolioForm(FlaskForm):
     title = StringField('タイトル', validators=[DataRequired(), Length(max=128)])
-    content = TextAreaField('概要', validators=[DataRequired()])
+    content = TextAreaField('概要', validators=[DataRequired(), Length(max=PORTFOLIO_CONTENT_MAX)])
     tags = SelectMultipleField('タグ', coerce=int)
     submit = SubmitField('保存')
 
@@ -28,11 +32,15 @@ class ProfileEditForm(FlaskForm):
     submit = SubmitField('Save Changes')
 
 class SearchForm(FlaskForm):
-    search_query = StringField('username', validators=[DataRequired()])
+    search_query = StringField('キーワード', validators=[DataRequired()])
     tags = SelectMultipleField('Tags', coerce=int)
     submit = SubmitField('検索')
 
 class CommentForm(FlaskForm):
     comment = TextAreaField('コメント', validators=[DataRequired()])
-    rating = SelectField('評価', choices=[('★☆☆☆☆', '1'), ('★★☆☆☆', '2'), ('★★★☆☆', '3'), ('★★★★☆', '4'), ('★★★★★', '5')], validators=[DataRequired()])
-    submit = SubmitField('送信')
\ No newline at end of file
+    rating = SelectField('評価', choices=[(1, '★☆☆☆☆'), (2, '★★☆☆☆'), (3, '★★★☆☆'), (4, '★★★★☆'), (5, '★★★★★')], coerce=int, validators=[DataRequired()])
+    submit = SubmitField('送信')
+
+class AttachmentForm(FlaskForm):
+    file = FileField('添付ファイル', validators=[FileRequired()])
+    submit = SubmitField('添付する')
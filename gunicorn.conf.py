@@ -0,0 +1,40 @@
+# 本番用の設定: gunicorn -c gunicorn.conf.py wsgi:app
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5003')
+
+# プロセスを先にフォークしておき、各ワーカーは数本のスレッドでリクエストを処理する。
+# ワーカー数は環境変数 WEB_CONCURRENCY、スレッド数は THREADS で変えられる
+# (スレッド数は DB_READ_POOL_SIZE 以下にすること。教師用のライブ更新は開いている間スレッドを一つ使うので、
+# EVENTS_MAX_STREAMS はスレッド数より少なくすること)
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('THREADS', 4))
+
+# マスターでアプリを読み込んでからフォークするので、ワーカーの起動が速くメモリも共有される。
+# DB接続やスレッドはプロセスごとに作り直すので、マスターで開いたものを子が使うことはない
+preload_app = True
+
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+# メモリの断片化を防ぐため、一定数のリクエストを処理したワーカーを入れ替える(一斉に入れ替わらないようにずらす)
+max_requests = 10000
+max_requests_jitter = 1000
+
+
+def on_starting(server):
+    # スキーマの更新はワーカーを起動する前にマスターで一度だけ行う
+    from migrations import migrate_app
+    from wsgi import app
+    migrate_app(app)
+
+
+def post_worker_init(worker):
+    # 各ワーカーがリクエストを受け付ける前に、接続・キャッシュ・テンプレートを準備する
+    from warmup import warmup
+    from wsgi import app
+    result = warmup(app)
+    worker.log.info('Warmed up in %.0f ms (%d pages, %d statements, %d connections)', result['seconds'] * 1000,
+                    result['pages'], result['statements'], result['connections'])
@@ -0,0 +1,255 @@
+import csv
+import functools
+import io
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from werkzeug.security import generate_password_hash
+
+import db
+from bodies import pack as pack_body
+from db import read_generation
+
+
+import_cli = AppGroup('import', help='Bulk-load users, tags and portfolios from CSV or JSONL files.')
+
+# SQLiteのバインド変数の上限(古いビルドでは999)を超えないようにIN句を分割する
+_MAX_VARIABLES = 900
+
+
+def read_records(stream, name):
+    # 拡張子で形式を判定し、1行ずつ辞書として返す(ファイル全体は読み込まない)
+    if name.endswith(('.jsonl', '.ndjson')):
+        for line_number, line in enumerate(stream, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise click.ClickException(f'{name}:{line_number}: {e}')
+            if not isinstance(record, dict):
+                raise click.ClickException(f'{name}:{line_number}: expected a JSON object')
+            yield record
+    else:
+        yield from csv.DictReader(stream)
+
+
+def batches(records, size):
+    records = iter(records)
+    while True:
+        batch = list(itertools.islice(records, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _text(record, key):
+    value = record.get(key)
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def _tag_names(value):
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(';')
+    return [name for name in (str(item).strip() for item in value) if name]
+
+
+def _lookup(conn, sql, keys):
+    # "SELECT key, id FROM ... WHERE key IN ({})" を分割して実行し、key -> id の辞書を返す
+    found = {}
+    keys = list(keys)
+    for start in range(0, len(keys), _MAX_VARIABLES):
+        chunk = keys[start:start + _MAX_VARIABLES]
+        found.update(conn.execute(sql.format(', '.join('?' for _ in chunk)), chunk).fetchall())
+    return found
+
+
+def resolve_tags(conn, names):
+    # 存在しないタグはまとめて作成してから、名前 -> ID を一度に引く
+    # (INSERT OR IGNOREでも無視された行がAUTOINCREMENTの番号を消費するので、既存のタグは先に除く)
+    names = sorted(set(names))
+    found = _lookup(conn, 'SELECT name, id FROM tags WHERE name IN ({})', names)
+    missing = [name for name in names if name not in found]
+    if missing:
+        conn.executemany('INSERT OR IGNORE INTO tags (name) VALUES (?)', [(name,) for name in missing])
+        found.update(_lookup(conn, 'SELECT name, id FROM tags WHERE name IN ({})', missing))
+    return found
+
+
+def next_id(conn, table):
+    # executemanyではlastrowidが取れないので、書き込みロックを持ったままIDを先に割り当てる
+    # (AUTOINCREMENTのテーブルは削除済みの番号を再利用しないよう sqlite_sequence も見る)
+    return conn.execute(f'''
+        SELECT MAX(COALESCE((SELECT MAX(id) FROM {table}), 0),
+                   COALESCE((SELECT seq FROM sqlite_sequence WHERE name = ?), 0))
+    ''', (table,)).fetchone()[0] + 1
+
+
+class _Progress:
+    def __init__(self, label):
+        self.label = label
+        self.rows = 0
+        self.inserted = 0
+        self.skipped = 0
+        self.started = time.perf_counter()
+
+    def report(self, final=False):
+        elapsed = time.perf_counter() - self.started
+        rate = self.rows / elapsed if elapsed else 0
+        click.echo(f'{self.label}: {self.rows} rows read, {self.inserted} inserted, '
+                   f'{self.skipped} skipped ({rate:.0f} rows/s){" - done" if final else ""}', err=not final)
+
+
+def _run(path, label, batch_size, load_batch):
+    conn = db.open_connection(current_app._get_current_object())
+    conn.isolation_level = None
+    progress = _Progress(label)
+    try:
+        with _open(path) as stream:
+            for batch in batches(read_records(stream, path), batch_size):
+                progress.rows += len(batch)
+                # バッチごとに一つのトランザクションで書き込む
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    load_batch(conn, batch, progress)
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+                progress.report()
+        conn.execute('PRAGMA optimize')
+    finally:
+        conn.close()
+    progress.report(final=True)
+
+
+_batch_size = click.option('--batch-size', default=1000, show_default=True, help='Rows per transaction.')
+
+
+def _open(path):
+    # csvモジュールのためにnewline=''で開く。"-"は標準入力
+    if path == '-':
+        return io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8-sig', newline='')
+    return open(path, encoding='utf-8-sig', newline='')
+
+
+@import_cli.command('users')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@_batch_size
+@click.option('--processes', default=os.cpu_count(), show_default=True,
+              help='Worker processes used for password hashing.')
+def import_users(path, batch_size, processes):
+    # 列: username, password, role(省略時student), student_number, name, grade, graduation_year, bio
+    columns = ('student_number', 'name', 'grade', 'graduation_year', 'bio')
+    # アプリと同じアルゴリズム・コストでハッシュする(PASSWORD_HASH_METHOD)
+    hash_password = functools.partial(generate_password_hash, method=current_app.config['PASSWORD_HASH_METHOD'])
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        def load_batch(conn, batch, progress):
+            rows = []
+            for record in batch:
+                username, password = _text(record, 'username'), _text(record, 'password')
+                role = _text(record, 'role') or 'student'
+                if not username or not password or role not in ('student', 'teacher'):
+                    progress.skipped += 1
+                    continue
+                rows.append((username, password, role) + tuple(_text(record, key) for key in columns))
+            # ハッシュ計算はCPUを使うのでプロセスプールに分散する
+            hashes = pool.map(hash_password, [row[1] for row in rows],
+                              chunksize=max(1, len(rows) // (processes * 4)))
+            # executemanyのrowcountはトリガーによる変更を含まないので、そのまま挿入件数になる
+            inserted = conn.executemany(f'''
+                INSERT INTO user (username, password, role, {', '.join(columns)})
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (username) DO NOTHING
+            ''', [(row[0], password_hash) + row[2:] for row, password_hash in zip(rows, hashes)]).rowcount
+            progress.inserted += inserted
+            progress.skipped += len(rows) - inserted
+
+        _run(path, 'users', batch_size, load_batch)
+
+
+@import_cli.command('tags')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@_batch_size
+def import_tags(path, batch_size):
+    # 列: name
+    def load_batch(conn, batch, progress):
+        names = [_text(record, 'name') for record in batch]
+        progress.skipped += names.count(None)
+        before = read_generation(conn, 'tags')
+        resolve_tags(conn, (name for name in names if name))
+        # タグ一覧の世代番号は追加1件ごとにトリガーで進む
+        progress.inserted += read_generation(conn, 'tags') - before
+
+    _run(path, 'tags', batch_size, load_batch)
+
+
+@import_cli.command('portfolios')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@_batch_size
+def import_portfolios(path, batch_size):
+    # 列: username, title, content, created_at(省略可), tags(";"区切り、JSONLでは配列も可)
+    def load_batch(conn, batch, progress):
+        users = _lookup(conn, 'SELECT username, id FROM user WHERE username IN ({})',
+                        {_text(record, 'username') for record in batch} - {None})
+        tag_ids = resolve_tags(conn, (name for record in batch for name in _tag_names(record.get('tags'))))
+
+        portfolio_id = next_id(conn, 'portfolio')
+        portfolios = []
+        links = []
+        for record in batch:
+            user_id = users.get(_text(record, 'username'))
+            title, content = _text(record, 'title'), record.get('content')
+            if user_id is None or not title or not content:
+                progress.skipped += 1
+                continue
+            portfolios.append((portfolio_id, user_id, title, str(content), _text(record, 'created_at')))
+            links.extend((portfolio_id, tag_ids[name]) for name in dict.fromkeys(_tag_names(record.get('tags'))))
+            portfolio_id += 1
+        conn.executemany('''
+            INSERT INTO portfolio (id, user_id, title, created_at)
+            VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+        ''', [(portfolio_id, user_id, title, created_at)
+              for portfolio_id, user_id, title, content, created_at in portfolios])
+        conn.executemany('INSERT INTO portfolio_body (portfolio_id, body) VALUES (?, ?)',
+                         [(portfolio[0], pack_body(portfolio[3])) for portfolio in portfolios])
+        conn.executemany('INSERT OR IGNORE INTO portfolio_tags (portfolio_id, tag_id) VALUES (?, ?)', links)
+        progress.inserted += len(portfolios)
+
+    _run(path, 'portfolios', batch_size, load_batch)
+
+
+@import_cli.command('portfolio-tags')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@_batch_size
+def import_portfolio_tags(path, batch_size):
+    # 列: portfolio_id, tag(タグ名。存在しなければ作成する)
+    def load_batch(conn, batch, progress):
+        pairs = []
+        for record in batch:
+            portfolio_id, tag = _text(record, 'portfolio_id'), _text(record, 'tag')
+            if not portfolio_id or not portfolio_id.isdigit() or not tag:
+                progress.skipped += 1
+                continue
+            pairs.append((int(portfolio_id), tag))
+        existing = _lookup(conn, 'SELECT id, id FROM portfolio WHERE id IN ({})', {pair[0] for pair in pairs})
+        tag_ids = resolve_tags(conn, (tag for portfolio_id, tag in pairs if portfolio_id in existing))
+        rows = [(portfolio_id, tag_ids[tag]) for portfolio_id, tag in pairs if portfolio_id in existing]
+        progress.skipped += len(pairs) - len(rows)
+        progress.inserted += conn.executemany('INSERT OR IGNORE INTO portfolio_tags (portfolio_id, tag_id) VALUES (?, ?)',
+                                              rows).rowcount
+
+    _run(path, 'portfolio-tags', batch_size, load_batch)
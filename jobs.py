@@ -0,0 +1,283 @@
+import json
+import os
+import random
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import click
+from flask import current_app, g
+from flask.cli import AppGroup
+
+import db
+
+
+jobs_cli = AppGroup('jobs', help='Run and inspect background jobs.')
+
+# 種類 -> (関数, 既定の優先度, 既定の最大試行回数)
+_handlers = {}
+
+# プロセスプールの子プロセスで使うアプリ(_init_process で作る)
+_process_app = None
+
+
+def job(kind, priority=0, max_attempts=5):
+    # バックグラウンドで実行する関数を登録する。関数はアプリコンテキストの中で payload(辞書) を受け取って呼ばれ、
+    # 書き込んだ内容は自分でコミットする。失敗すると少しずつ間隔を空けて max_attempts 回まで再試行される
+    def decorator(function):
+        _handlers[kind] = (function, priority, max_attempts)
+        return function
+    return decorator
+
+
+def enqueue(conn, kind, payload=None, priority=None, delay=0, max_attempts=None, dedupe_key=None):
+    # ジョブを追加する。呼び出し側の接続で書き込むので、呼び出し側のコミットと一緒に確定する。
+    # dedupe_key が同じで未実行のジョブがあれば、新しく作らずに payload を最新のものに置き換える
+    _, default_priority, default_attempts = _handlers[kind]
+    payload = payload or {}
+    eager = current_app.config['JOBS_EAGER']
+    if eager:
+        # 開発用: ワーカーを起動しなくてもよいように、アプリコンテキストの終わりに(呼び出し側がコミットしたあと)実行する
+        delay = 0
+    now = time.time()
+    priority = default_priority if priority is None else priority
+    row = conn.execute(
+        'INSERT INTO jobs (kind, payload, priority, max_attempts, run_at, dedupe_key, created_at) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?) '
+        "ON CONFLICT (dedupe_key) WHERE status = 'queued' DO UPDATE SET payload = excluded.payload, "
+        'priority = max(priority, excluded.priority), run_at = min(run_at, excluded.run_at) '
+        'RETURNING id',
+        (kind, json.dumps(payload, ensure_ascii=False), priority,
+         default_attempts if max_attempts is None else max_attempts, now + delay, dedupe_key, now)).fetchone()
+    if eager:
+        g.setdefault('_eager_jobs', {})[row[0]] = None
+    return row[0]
+
+
+def claim(conn, worker, lease, job_id=None):
+    # 実行できるジョブを一つ取り出して、lease 秒のあいだこのワーカーのものにする(一つのUPDATE文なので、
+    # 複数のワーカーが同時に呼んでも同じジョブを取ることはない)。取り出したジョブは重複排除の対象から外す。
+    # job_id を渡すと、実行予定の時刻に関係なくそのジョブだけを取り出す(JOBS_EAGER)
+    now = time.time()
+    return conn.execute(
+        "UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, lease_until = ?, "
+        'dedupe_key = NULL '
+        "WHERE id = (SELECT id FROM jobs WHERE status = 'queued' AND (id = ? OR ? IS NULL AND run_at <= ?) "
+        'ORDER BY priority DESC, run_at, id LIMIT 1) '
+        'RETURNING id, kind, payload, attempts, max_attempts',
+        (worker, now + lease, job_id, job_id, now)).fetchone()
+
+
+def renew(conn, worker, lease):
+    # 実行中のジョブの期限を延ばす(時間のかかるジョブが他のワーカーに取られないように)
+    conn.execute("UPDATE jobs SET lease_until = ? WHERE status = 'running' AND worker = ?",
+                 (time.time() + lease, worker))
+
+
+def reclaim(conn):
+    # 期限が切れた実行中のジョブ(ワーカーが落ちたなど)を待ち行列に戻す
+    return conn.execute(
+        "UPDATE jobs SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END, "
+        "worker = NULL, lease_until = NULL, last_error = 'lease expired' "
+        "WHERE status = 'running' AND lease_until < ?", (time.time(),)).rowcount
+
+
+def complete(conn, job_id, worker):
+    # 成功したジョブは残さない(テーブルを小さく保つ)
+    conn.execute("DELETE FROM jobs WHERE id = ? AND worker = ? AND status = 'running'", (job_id, worker))
+
+
+def fail(conn, job_id, worker, attempts, max_attempts, error, backoff, backoff_max):
+    # 再試行の間隔は 1, 2, 4, ... 倍にのばし、同時に失敗したジョブが一斉に再実行されないように揺らす
+    if attempts >= max_attempts:
+        conn.execute("UPDATE jobs SET status = 'failed', worker = NULL, lease_until = NULL, last_error = ? "
+                     "WHERE id = ? AND worker = ? AND status = 'running'", (error, job_id, worker))
+        return False
+    delay = min(backoff_max, backoff * 2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+    conn.execute("UPDATE jobs SET status = 'queued', worker = NULL, lease_until = NULL, run_at = ?, last_error = ? "
+                 "WHERE id = ? AND worker = ? AND status = 'running'",
+                 (time.time() + delay, error, job_id, worker))
+    return True
+
+
+def _finish(app, conn, worker, row, error):
+    # 実行結果を記録して 'succeeded'・'retried'・'failed' のどれかを返す
+    if error is None:
+        complete(conn, row['id'], worker)
+        return 'succeeded'
+    app.logger.error('Job %s (%s) failed on attempt %s/%s', row['id'], row['kind'], row['attempts'],
+                     row['max_attempts'], exc_info=error)
+    if fail(conn, row['id'], worker, row['attempts'], row['max_attempts'], f'{type(error).__name__}: {error}',
+            app.config['JOBS_BACKOFF'], app.config['JOBS_BACKOFF_MAX']):
+        return 'retried'
+    return 'failed'
+
+
+def _execute(app, kind, payload):
+    entry = _handlers.get(kind)
+    if entry is None:
+        raise LookupError(f'No handler for job kind {kind!r}')
+    with app.app_context():
+        entry[0](json.loads(payload))
+
+
+def _init_process(config):
+    # 子プロセスではアプリを作り直す(接続やキャッシュはプロセスごとに持つ)。Ctrl-Cは親が受けて後始末する
+    global _process_app
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from app import create_app
+    _process_app = create_app(config)
+
+
+def _execute_in_process(kind, payload):
+    _execute(_process_app, kind, payload)
+
+
+def work(app, concurrency=4, processes=False, lease=60, poll=1.0, burst=False, stop=None):
+    # 待ち行列からジョブを取り出して、スレッド(またはプロセス)のプールで実行し続ける。
+    # burst のときは実行できるジョブがなくなったら終わる
+    stop = stop or threading.Event()
+    worker = f'{socket.gethostname()}:{os.getpid()}:{random.getrandbits(32):08x}'
+    conn = db.open_connection(app)
+    # 一文ずつすぐにコミットする(取り出しや結果の記録で書き込みロックを長く持たない)
+    conn.isolation_level = None
+    if processes:
+        executor = ProcessPoolExecutor(concurrency, initializer=_init_process, initargs=(dict(app.config),))
+        submit = lambda row: executor.submit(_execute_in_process, row['kind'], row['payload'])
+    else:
+        # ジョブごとに接続を借りるので、同時に実行する数だけプールに用意する
+        for key in ('DB_READ_POOL_SIZE', 'DB_WRITE_POOL_SIZE'):
+            app.config[key] = max(app.config[key], concurrency)
+        executor = ThreadPoolExecutor(concurrency, thread_name_prefix='job')
+        submit = lambda row: executor.submit(_execute, app, row['kind'], row['payload'])
+    running = {}
+    stats = {'succeeded': 0, 'retried': 0, 'failed': 0}
+    maintained = 0
+
+    def finish(future, row):
+        stats[_finish(app, conn, worker, row, future.exception())] += 1
+
+    try:
+        while not stop.is_set():
+            if time.monotonic() - maintained >= lease / 3:
+                renew(conn, worker, lease)
+                reclaim(conn)
+                maintained = time.monotonic()
+            row = None
+            while len(running) < concurrency:
+                row = claim(conn, worker, lease)
+                if row is None:
+                    break
+                running[submit(row)] = row
+            if not running:
+                if burst:
+                    break
+                stop.wait(poll)
+                continue
+            # 空きができたらすぐに次を取り出す。待ち行列が空のときは poll 秒ごとに見に行く
+            done, _ = wait(running, timeout=poll if row is None else lease / 3, return_when=FIRST_COMPLETED)
+            for future in done:
+                finish(future, running.pop(future))
+        # 止めるときは、実行中のジョブが終わるのを待ってから結果を記録する
+        for future in list(running):
+            future.exception()
+            finish(future, running.pop(future))
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        conn.close()
+    return stats
+
+
+def run_eager_jobs(exception=None):
+    # JOBS_EAGER のとき、このアプリコンテキストで追加したジョブをワーカーと同じ手順(取り出し・記録)で実行する。
+    # 呼び出し側の接続を先に返し、ジョブは新しい接続と新しいアプリコンテキストで動かす。
+    # 呼び出し側がロールバックしたジョブは行がないので取り出されない
+    job_ids = g.pop('_eager_jobs', None)
+    if not job_ids:
+        return
+    db.close_db()
+    if exception is not None:
+        return
+    app = current_app._get_current_object()
+    worker = f'eager:{os.getpid()}:{threading.get_ident()}'
+    conn = db.open_connection(app)
+    conn.isolation_level = None
+    try:
+        for job_id in job_ids:
+            row = claim(conn, worker, 3600, job_id)
+            if row is None:
+                continue
+            error = None
+            try:
+                _execute(app, row['kind'], row['payload'])
+            except Exception as exc:
+                error = exc
+            _finish(app, conn, worker, row, error)
+    finally:
+        conn.close()
+
+
+@jobs_cli.command('worker')
+@click.option('--concurrency', default=4, show_default=True, help='Jobs run at the same time.')
+@click.option('--processes', is_flag=True, help='Run jobs in child processes instead of threads '
+                                               '(for CPU-bound jobs).')
+@click.option('--lease', default=60, show_default=True,
+              help='Seconds before a job held by a dead worker is retried elsewhere.')
+@click.option('--poll', default=1.0, show_default=True, help='Seconds between checks of an empty queue.')
+@click.option('--burst', is_flag=True, help='Exit once no job is ready to run.')
+def worker_command(concurrency, processes, lease, poll, burst):
+    app = current_app._get_current_object()
+    stop = threading.Event()
+
+    def shutdown(signum, frame):
+        click.echo('Stopping after the running jobs finish...', err=True)
+        stop.set()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+    stats = work(app, concurrency, processes, lease, poll, burst, stop)
+    click.echo(f"{stats['succeeded']} jobs succeeded, {stats['retried']} will be retried, "
+               f"{stats['failed']} failed")
+
+
+@jobs_cli.command('stats')
+def stats_command():
+    conn = db.open_connection(current_app._get_current_object(), readonly=True)
+    try:
+        rows = conn.execute('SELECT kind, status, COUNT(*) AS count FROM jobs '
+                            'GROUP BY kind, status ORDER BY kind, status').fetchall()
+        for row in rows:
+            click.echo(f"{row['kind']:<24}{row['status']:<10}{row['count']:>8}")
+        failed = conn.execute("SELECT id, kind, attempts, last_error FROM jobs WHERE status = 'failed' "
+                              'ORDER BY id DESC LIMIT 10').fetchall()
+        for row in failed:
+            click.echo(f"failed #{row['id']} {row['kind']} after {row['attempts']} attempts: {row['last_error']}")
+    finally:
+        conn.close()
+
+
+@jobs_cli.command('retry')
+@click.option('--kind', default=None, help='Only retry jobs of this kind.')
+def retry_command(kind):
+    # 失敗したジョブを試行回数を0に戻して待ち行列に戻す
+    conn = db.open_connection(current_app._get_current_object())
+    try:
+        count = conn.execute("UPDATE jobs SET status = 'queued', attempts = 0, run_at = ?, last_error = NULL "
+                             "WHERE status = 'failed' AND (? IS NULL OR kind = ?)",
+                             (time.time(), kind, kind)).rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    click.echo(f'{count} jobs queued again')
+
+
+def init_app(app):
+    # 再試行の間隔(秒)。試行ごとに倍にして JOBS_BACKOFF_MAX で頭打ちにする
+    app.config.setdefault('JOBS_BACKOFF', 5)
+    app.config.setdefault('JOBS_BACKOFF_MAX', 3600)
+    # 真にすると追加したジョブをワーカーを待たずにアプリコンテキストの終わりに実行する(開発用サーバーやテスト向け)
+    app.config.setdefault('JOBS_EAGER', False)
+    app.teardown_appcontext(run_eager_jobs)
+    app.cli.add_command(jobs_cli)
@@ -0,0 +1,263 @@
+import bisect
+import hmac
+import random
+import threading
+import time
+from collections import deque
+
+from flask import before_render_template, current_app, g, request, template_rendered
+
+import db
+
+
+# 秒単位のヒストグラムの境界(Prometheusの既定に近いもの)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    # プロセス内の集計値。gunicornなどで複数のワーカーがあるときは、ワーカーごとの値になる
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, labels=(), amount=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram()
+            histogram.observe(value)
+
+    def render(self):
+        # Prometheusのテキスト形式(version 0.0.4)で書き出す
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(h.counts), h.sum, h.count)) for key, h in self._histograms.items())
+        lines = []
+        described = set()
+
+        def header(name):
+            if name not in described and name in self._help:
+                kind, text = self._help[name]
+                lines.append(f'# HELP {name} {text}')
+                lines.append(f'# TYPE {name} {kind}')
+                described.add(name)
+
+        for (name, labels), value in counters:
+            header(name)
+            lines.append(f'{name}{_labels(labels)} {value}')
+        for (name, labels), (counts, total, count) in histograms:
+            header(name)
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS + (float('inf'),), counts):
+                cumulative += bucket
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{_labels(labels + (("le", le),))} {cumulative}')
+            lines.append(f'{name}_sum{_labels(labels)} {total:.6f}')
+            lines.append(f'{name}_count{_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+class _Sample:
+    # サンプリング対象のリクエストで集める値
+    __slots__ = ('endpoint', 'statements', 'trigger_statements', 'templates')
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.statements = 0
+        self.trigger_statements = 0
+        self.templates = []
+
+
+# WSGIのenvironにこのキーがあるリクエスト(ワーカー起動時のウォームアップなど)は数えない
+SKIP_ENVIRON = 'eportfolio.metrics.skip'
+
+
+class Metrics:
+    def __init__(self, app):
+        self.registry = Registry()
+        self.sample_rate = app.config['METRICS_SAMPLE_RATE']
+        slow_query_ms = app.config['METRICS_SLOW_QUERY_MS']
+        self.slow_query_seconds = slow_query_ms / 1000 if slow_query_ms is not None else None
+        self.slow_queries = deque(maxlen=100)
+        self._explained = set()
+        # トレースコールバックはSQLを実行したスレッドで呼ばれるので、サンプル中かどうかはスレッドごとに持つ
+        self._local = threading.local()
+        self._logger = app.logger
+        describe = self.registry.describe
+        describe('http_requests_total', 'counter', 'HTTP responses by endpoint, method and status.')
+        describe('http_request_duration_seconds', 'histogram', 'Time spent handling a request.')
+        describe('sqlite_statements_total', 'counter', 'SQL statements run by sampled requests.')
+        describe('sqlite_trigger_statements_total', 'counter', 'Statements run inside triggers by sampled requests.')
+        describe('sqlite_statement_duration_seconds', 'histogram', 'Time spent in execute() by sampled requests.')
+        describe('sqlite_slow_queries_total', 'counter', 'Statements slower than METRICS_SLOW_QUERY_MS.')
+        describe('template_render_duration_seconds', 'histogram', 'Jinja render time in sampled requests.')
+        describe('password_hash_duration_seconds', 'histogram', 'Password hashing and verification time.')
+        describe('metrics_sampled_requests_total', 'counter', 'Requests that collected SQL and template details.')
+
+    def _sample(self):
+        return getattr(self._local, 'sample', None)
+
+    def sampling(self):
+        return self._sample() is not None
+
+    def timing_wanted(self):
+        # 実行時間はサンプル中のリクエストと、遅いクエリのログを有効にしたときだけ測る
+        return self.slow_query_seconds is not None or self.sampling()
+
+    def before_request(self):
+        self._local.skip = bool(request.environ.get(SKIP_ENVIRON))
+        if self._local.skip:
+            self._local.sample = None
+            return
+        g._metrics_started = time.perf_counter()
+        # SQLの文数・時間とテンプレートの時間は一部のリクエストだけで集める
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        self._local.sample = _Sample(request.endpoint or 'none') if sampled else None
+
+    def after_request(self, response):
+        started = g.pop('_metrics_started', None)
+        if started is None:
+            return response
+        endpoint = request.endpoint or 'none'
+        self.registry.observe('http_request_duration_seconds', (('endpoint', endpoint),),
+                              time.perf_counter() - started)
+        self.registry.inc('http_requests_total', (('endpoint', endpoint), ('method', request.method),
+                                                  ('status', str(response.status_code))))
+        sample = self._sample()
+        if sample is not None:
+            labels = (('endpoint', endpoint),)
+            self.registry.inc('metrics_sampled_requests_total', labels)
+            self.registry.inc('sqlite_statements_total', labels, sample.statements)
+            self.registry.inc('sqlite_trigger_statements_total', labels, sample.trigger_statements)
+            for template, seconds in sample.templates:
+                self.registry.observe('template_render_duration_seconds', (('template', template),), seconds)
+        return response
+
+    def teardown_request(self, exception=None):
+        self._local.skip = False
+        self._local.sample = None
+        self._local.renders = []
+
+    def trace(self, statement):
+        sample = self._sample()
+        if sample is None:
+            return
+        # トリガーの中の文は "-- TRIGGER 名前" のように届く
+        if statement.startswith('--'):
+            sample.trigger_statements += 1
+        else:
+            sample.statements += 1
+
+    def timing(self, conn, sql, parameters, seconds):
+        if getattr(self._local, 'skip', False):
+            return
+        sample = self._sample()
+        if sample is not None:
+            self.registry.observe('sqlite_statement_duration_seconds', (('endpoint', sample.endpoint),), seconds)
+        # 遅いクエリはサンプリングに関係なく記録する。実行計画は同じSQLにつき一度だけ取る
+        if self.slow_query_seconds is not None and seconds >= self.slow_query_seconds:
+            self.slow_query(conn, sql, parameters, seconds)
+
+    def slow_query(self, conn, sql, parameters, seconds):
+        self.registry.inc('sqlite_slow_queries_total')
+        plan = None
+        if sql not in self._explained and parameters is not None and len(self._explained) < 1000:
+            self._explained.add(sql)
+            observer, conn.observer = conn.observer, None
+            try:
+                plan = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', parameters)]
+            except Exception:
+                plan = None
+            finally:
+                conn.observer = observer
+        self.slow_queries.append((time.time(), seconds, sql, plan))
+        self._logger.warning('Slow query (%.1f ms): %s%s', seconds * 1000, ' '.join(sql.split()),
+                                   ''.join(f'\n    {line}' for line in plan or ()))
+
+    def before_render(self, sender, template, context, **extra):
+        sample = self._sample()
+        if sample is not None:
+            stack = getattr(self._local, 'renders', None)
+            if stack is None:
+                stack = self._local.renders = []
+            stack.append(time.perf_counter())
+
+    def rendered(self, sender, template, context, **extra):
+        sample = self._sample()
+        stack = getattr(self._local, 'renders', None)
+        if sample is not None and stack:
+            sample.templates.append((template.name or 'string', time.perf_counter() - stack.pop()))
+
+    def password_hash(self, operation, seconds):
+        self.registry.observe('password_hash_duration_seconds', (('operation', operation),), seconds)
+
+
+def get_metrics():
+    return current_app.extensions.get('metrics')
+
+
+def metrics_endpoint():
+    # 本番では METRICS_TOKEN が必要。リバースプロキシの後ろでは外からのアクセスも remote_addr が
+    # 127.0.0.1 になるので、トークンなしで返すのは開発用サーバー(debug)で、プロキシを通っていない同じマシンからだけ
+    token = current_app.config['METRICS_TOKEN']
+    if token:
+        given = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        if not hmac.compare_digest(given.encode(), token.encode()):
+            return 'Forbidden\n', 403, {'Content-Type': 'text/plain'}
+    elif (not current_app.debug or request.remote_addr not in ('127.0.0.1', '::1')
+          or any(header in request.headers for header in ('X-Forwarded-For', 'X-Real-IP', 'Forwarded'))):
+        return 'Forbidden (set METRICS_TOKEN)\n', 403, {'Content-Type': 'text/plain'}
+    return current_app.extensions['metrics'].registry.render(), 200, {
+        'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+def init_app(app):
+    app.config.setdefault('METRICS_ENABLED', True)
+    # SQLの文数・時間とテンプレートの時間を集めるリクエストの割合(0で無効、1で全リクエスト)
+    app.config.setdefault('METRICS_SAMPLE_RATE', 0.0)
+    # これより遅いSQLを実行計画とともにログに出す(Noneで無効。有効にすると全ての文の実行時間を測る)
+    app.config.setdefault('METRICS_SLOW_QUERY_MS', None)
+    app.config.setdefault('METRICS_TOKEN', None)
+    if not app.config['METRICS_ENABLED']:
+        return
+    metrics = app.extensions['metrics'] = Metrics(app)
+    app.before_request(metrics.before_request)
+    app.after_request(metrics.after_request)
+    app.teardown_request(metrics.teardown_request)
+    db.add_trace_hook(app, metrics.trace, when=metrics.sampling)
+    db.add_timing_hook(app, metrics.timing, when=metrics.timing_wanted)
+    before_render_template.connect(metrics.before_render, app, weak=False)
+    template_rendered.connect(metrics.rendered, app, weak=False)
+    app.add_url_rule('/metrics', 'metrics', metrics_endpoint)
@@ -0,0 +1,569 @@
+import sqlite3
+
+import click
+from flask import current_app
+
+import db
+from bodies import pack as pack_body
+
+
+# バージョン1: 既存のcreate_tables()と同じ初期スキーマ
+INITIAL_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS user (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL UNIQUE,
+    password TEXT NOT NULL,
+    role TEXT NOT NULL,
+    student_number TEXT,
+    name TEXT,
+    grade TEXT,
+    graduation_year TEXT,
+    bio TEXT
+);
+CREATE TABLE IF NOT EXISTS portfolio (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES user (id)
+);
+CREATE TABLE IF NOT EXISTS comments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    portfolio_id INTEGER,
+    teacher_id INTEGER,
+    comment TEXT,
+    rating INTEGER,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (portfolio_id) REFERENCES portfolio (id),
+    FOREIGN KEY (teacher_id) REFERENCES user (id)
+);
+CREATE TABLE IF NOT EXISTS tags (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS portfolio_tags (
+    portfolio_id INTEGER,
+    tag_id INTEGER,
+    FOREIGN KEY (portfolio_id) REFERENCES portfolio (id),
+    FOREIGN KEY (tag_id) REFERENCES tags (id),
+    PRIMARY KEY (portfolio_id, tag_id)
+);
+'''
+
+# バージョン2: 一覧・詳細ページ用のインデックス(一覧はタイトルと日付だけで済むようにカバリングにする)
+INDEXES = '''
+CREATE INDEX IF NOT EXISTS idx_portfolio_user ON portfolio (user_id, id, title, created_at);
+CREATE INDEX IF NOT EXISTS idx_comments_portfolio ON comments (portfolio_id);
+CREATE INDEX IF NOT EXISTS idx_portfolio_tags_tag ON portfolio_tags (tag_id, portfolio_id);
+CREATE INDEX IF NOT EXISTS idx_user_role ON user (role, id, username, name);
+ANALYZE;
+'''
+
+# バージョン3: 生徒とポートフォリオの全文検索インデックス(bigrams()はdb.connect()で登録される)
+FULL_TEXT_SEARCH = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS user_fts USING fts5(username, name, bio, tokenize = 'unicode61');
+CREATE VIRTUAL TABLE IF NOT EXISTS portfolio_fts USING fts5(title, content, tokenize = 'unicode61');
+INSERT INTO user_fts (rowid, username, name, bio)
+    SELECT id, bigrams(username), bigrams(name), bigrams(bio) FROM user WHERE role = 'student';
+INSERT INTO portfolio_fts (rowid, title, content)
+    SELECT id, bigrams(title), bigrams(content) FROM portfolio;
+CREATE TRIGGER IF NOT EXISTS user_fts_insert AFTER INSERT ON user WHEN new.role = 'student' BEGIN
+    INSERT INTO user_fts (rowid, username, name, bio)
+    VALUES (new.id, bigrams(new.username), bigrams(new.name), bigrams(new.bio));
+END;
+CREATE TRIGGER IF NOT EXISTS user_fts_update AFTER UPDATE OF username, name, bio ON user WHEN new.role = 'student' BEGIN
+    DELETE FROM user_fts WHERE rowid = old.id;
+    INSERT INTO user_fts (rowid, username, name, bio)
+    VALUES (new.id, bigrams(new.username), bigrams(new.name), bigrams(new.bio));
+END;
+CREATE TRIGGER IF NOT EXISTS user_fts_delete AFTER DELETE ON user BEGIN
+    DELETE FROM user_fts WHERE rowid = old.id;
+END;
+CREATE TRIGGER IF NOT EXISTS portfolio_fts_insert AFTER INSERT ON portfolio BEGIN
+    INSERT INTO portfolio_fts (rowid, title, content)
+    VALUES (new.id, bigrams(new.title), bigrams(new.content));
+END;
+CREATE TRIGGER IF NOT EXISTS portfolio_fts_update AFTER UPDATE OF title, content ON portfolio BEGIN
+    DELETE FROM portfolio_fts WHERE rowid = old.id;
+    INSERT INTO portfolio_fts (rowid, title, content)
+    VALUES (new.id, bigrams(new.title), bigrams(new.content));
+END;
+CREATE TRIGGER IF NOT EXISTS portfolio_fts_delete AFTER DELETE ON portfolio BEGIN
+    DELETE FROM portfolio_fts WHERE rowid = old.id;
+END;
+'''
+
+# バージョン4: プロセス内キャッシュの無効化に使う世代番号。タグの付け外しやポートフォリオの追加・削除で進む
+CACHE_GENERATIONS = '''
+CREATE TABLE IF NOT EXISTS cache_generation (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+INSERT OR IGNORE INTO cache_generation (name, value) VALUES ('tag_index', 0);
+CREATE TRIGGER IF NOT EXISTS tag_index_portfolio_insert AFTER INSERT ON portfolio BEGIN
+    UPDATE cache_generation SET value = value + 1 WHERE name = 'tag_index';
+END;
+CREATE TRIGGER IF NOT EXISTS tag_index_portfolio_delete AFTER DELETE ON portfolio BEGIN
+    UPDATE cache_generation SET value = value + 1 WHERE name = 'tag_index';
+END;
+CREATE TRIGGER IF NOT EXISTS tag_index_portfolio_tags_insert AFTER INSERT ON portfolio_tags BEGIN
+    UPDATE cache_generation SET value = value + 1 WHERE name = 'tag_index';
+END;
+CREATE TRIGGER IF NOT EXISTS tag_index_portfolio_tags_update AFTER UPDATE ON portfolio_tags BEGIN
+    UPDATE cache_generation SET value = value + 1 WHERE name = 'tag_index';
+END;
+CREATE TRIGGER IF NOT EXISTS tag_index_portfolio_tags_delete AFTER DELETE ON portfolio_tags BEGIN
+    UPDATE cache_generation SET value = value + 1 WHERE name = 'tag_index';
+END;
+'''
+
+# バージョン5: タグ一覧キャッシュの世代番号
+TAG_CATALOG_GENERATION = '''
+INSERT OR IGNORE INTO cache_generation (name, value) VALUES ('tags', 0);
+CREATE TRIGGER IF NOT EXISTS tag_catalog_insert AFTER INSERT ON tags BEGIN
+    UPDATE cache_generation SET value = value + 1 WHERE name = 'tags';
+END;
+CREATE TRIGGER IF NOT EXISTS tag_catalog_update AFTER UPDATE ON tags BEGIN
+    UPDATE cache_generation SET value = value + 1 WHERE name = 'tags';
+END;
+CREATE TRIGGER IF NOT EXISTS tag_catalog_delete AFTER DELETE ON tags BEGIN
+    UPDATE cache_generation SET value = value + 1 WHERE name = 'tags';
+END;
+'''
+
+# バージョン6: 詳細ページのETagと描画キャッシュに使うポートフォリオのバージョン
+PORTFOLIO_VERSION = '''
+ALTER TABLE portfolio ADD COLUMN version INTEGER NOT NULL DEFAULT 1;
+CREATE TRIGGER IF NOT EXISTS portfolio_version_update AFTER UPDATE OF title, content ON portfolio BEGIN
+    UPDATE portfolio SET version = version + 1 WHERE id = new.id;
+END;
+CREATE TRIGGER IF NOT EXISTS portfolio_version_tags_insert AFTER INSERT ON portfolio_tags BEGIN
+    UPDATE portfolio SET version = version + 1 WHERE id = new.portfolio_id;
+END;
+CREATE TRIGGER IF NOT EXISTS portfolio_version_tags_delete AFTER DELETE ON portfolio_tags BEGIN
+    UPDATE portfolio SET version = version + 1 WHERE id = old.portfolio_id;
+END;
+CREATE TRIGGER IF NOT EXISTS portfolio_version_comments_insert AFTER INSERT ON comments BEGIN
+    UPDATE portfolio SET version = version + 1 WHERE id = new.portfolio_id;
+END;
+CREATE TRIGGER IF NOT EXISTS portfolio_version_comments_delete AFTER DELETE ON comments BEGIN
+    UPDATE portfolio SET version = version + 1 WHERE id = old.portfolio_id;
+END;
+'''
+
+# バージョン7: 評価を星の文字列('★★★☆☆')から数値(1〜5)に変換し、生徒ごとの集計表を作る。
+# 集計表はトリガーで差分更新するので、生徒一覧は学年(卒業年度)ごとのインデックスを一度読むだけで済む
+STUDENT_STATS = '''
+UPDATE comments SET rating = CASE
+    WHEN CAST(rating AS TEXT) GLOB '[1-5]' THEN CAST(rating AS INTEGER)
+    WHEN rating GLOB '*★*' THEN length(rating) - length(replace(rating, '★', ''))
+END;
+CREATE TABLE IF NOT EXISTS student_stats (
+    user_id INTEGER PRIMARY KEY REFERENCES user (id),
+    graduation_year TEXT,
+    portfolio_count INTEGER NOT NULL DEFAULT 0,
+    comment_count INTEGER NOT NULL DEFAULT 0,
+    rating_sum INTEGER NOT NULL DEFAULT 0,
+    rating_count INTEGER NOT NULL DEFAULT 0,
+    rating_avg REAL GENERATED ALWAYS AS (CASE WHEN rating_count > 0 THEN 1.0 * rating_sum / rating_count ELSE 0 END) VIRTUAL,
+    last_activity TEXT NOT NULL DEFAULT ''
+);
+INSERT INTO student_stats (user_id, graduation_year, portfolio_count, comment_count, rating_sum, rating_count, last_activity)
+SELECT u.id, u.graduation_year,
+       (SELECT count(*) FROM portfolio AS p WHERE p.user_id = u.id),
+       (SELECT count(*) FROM comments AS c JOIN portfolio AS p ON p.id = c.portfolio_id WHERE p.user_id = u.id),
+       (SELECT COALESCE(sum(c.rating), 0) FROM comments AS c JOIN portfolio AS p ON p.id = c.portfolio_id WHERE p.user_id = u.id),
+       (SELECT count(c.rating) FROM comments AS c JOIN portfolio AS p ON p.id = c.portfolio_id WHERE p.user_id = u.id),
+       (SELECT COALESCE(max(p.created_at), '') FROM portfolio AS p WHERE p.user_id = u.id)
+FROM user AS u WHERE u.role = 'student';
+CREATE INDEX IF NOT EXISTS idx_student_stats_portfolios ON student_stats (graduation_year, portfolio_count, user_id);
+CREATE INDEX IF NOT EXISTS idx_student_stats_comments ON student_stats (graduation_year, comment_count, user_id);
+CREATE INDEX IF NOT EXISTS idx_student_stats_rating ON student_stats (graduation_year, rating_avg, user_id);
+CREATE INDEX IF NOT EXISTS idx_student_stats_activity ON student_stats (graduation_year, last_activity, user_id);
+CREATE TRIGGER IF NOT EXISTS student_stats_user_insert AFTER INSERT ON user WHEN new.role = 'student' BEGIN
+    INSERT INTO student_stats (user_id, graduation_year) VALUES (new.id, new.graduation_year);
+END;
+CREATE TRIGGER IF NOT EXISTS student_stats_user_update AFTER UPDATE OF graduation_year ON user BEGIN
+    UPDATE student_stats SET graduation_year = new.graduation_year WHERE user_id = new.id;
+END;
+CREATE TRIGGER IF NOT EXISTS student_stats_user_delete AFTER DELETE ON user BEGIN
+    DELETE FROM student_stats WHERE user_id = old.id;
+END;
+CREATE TRIGGER IF NOT EXISTS student_stats_portfolio_insert AFTER INSERT ON portfolio BEGIN
+    UPDATE student_stats SET portfolio_count = portfolio_count + 1,
+                             last_activity = max(last_activity, COALESCE(new.created_at, ''))
+    WHERE user_id = new.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS student_stats_portfolio_update AFTER UPDATE OF title, content ON portfolio BEGIN
+    UPDATE student_stats SET last_activity = max(last_activity, CURRENT_TIMESTAMP) WHERE user_id = new.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS student_stats_portfolio_delete AFTER DELETE ON portfolio BEGIN
+    UPDATE student_stats SET portfolio_count = portfolio_count - 1 WHERE user_id = old.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS student_stats_comments_insert AFTER INSERT ON comments BEGIN
+    UPDATE student_stats SET comment_count = comment_count + 1,
+                             rating_sum = rating_sum + COALESCE(new.rating, 0),
+                             rating_count = rating_count + (new.rating IS NOT NULL)
+    WHERE user_id = (SELECT user_id FROM portfolio WHERE id = new.portfolio_id);
+END;
+CREATE TRIGGER IF NOT EXISTS student_stats_comments_delete AFTER DELETE ON comments BEGIN
+    UPDATE student_stats SET comment_count = comment_count - 1,
+                             rating_sum = rating_sum - COALESCE(old.rating, 0),
+                             rating_count = rating_count - (old.rating IS NOT NULL)
+    WHERE user_id = (SELECT user_id FROM portfolio WHERE id = old.portfolio_id);
+END;
+ANALYZE student_stats;
+'''
+
+# バージョン8: バックグラウンドジョブのキュー(jobs.py)。時刻はUNIX時間(秒)で持つ
+JOBS = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL DEFAULT '{}',
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 5,
+    run_at REAL NOT NULL,
+    lease_until REAL,
+    worker TEXT,
+    last_error TEXT,
+    dedupe_key TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs (status, priority DESC, run_at, id);
+CREATE INDEX IF NOT EXISTS idx_jobs_lease ON jobs (status, lease_until);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_dedupe ON jobs (dedupe_key) WHERE status = 'queued';
+'''
+
+# バージョン9: ポートフォリオの添付ファイル。ファイルの実体(blobs)は内容のSHA-256で一つだけ持ち、
+# 同じファイルを何度添付しても共有する。参照数はトリガーで数え、0になった実体は flask attachments gc で消す。
+# thumbnail は 0: 未作成, 1: 作成済み, -1: 作れない(画像でない・壊れている)
+ATTACHMENTS = '''
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mimetype TEXT NOT NULL,
+    refcount INTEGER NOT NULL DEFAULT 0,
+    thumbnail INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_blobs_unreferenced ON blobs (refcount) WHERE refcount = 0;
+CREATE TABLE IF NOT EXISTS attachments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    portfolio_id INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (portfolio_id) REFERENCES portfolio (id),
+    FOREIGN KEY (sha256) REFERENCES blobs (sha256)
+);
+CREATE INDEX IF NOT EXISTS idx_attachments_portfolio ON attachments (portfolio_id, id);
+CREATE INDEX IF NOT EXISTS idx_attachments_blob ON attachments (sha256);
+CREATE TRIGGER IF NOT EXISTS attachments_insert AFTER INSERT ON attachments BEGIN
+    UPDATE blobs SET refcount = refcount + 1 WHERE sha256 = new.sha256;
+    UPDATE portfolio SET version = version + 1 WHERE id = new.portfolio_id;
+END;
+CREATE TRIGGER IF NOT EXISTS attachments_delete AFTER DELETE ON attachments BEGIN
+    UPDATE blobs SET refcount = refcount - 1 WHERE sha256 = old.sha256;
+    UPDATE portfolio SET version = version + 1 WHERE id = old.portfolio_id;
+END;
+CREATE TRIGGER IF NOT EXISTS blobs_thumbnail AFTER UPDATE OF thumbnail ON blobs BEGIN
+    UPDATE portfolio SET version = version + 1
+    WHERE id IN (SELECT portfolio_id FROM attachments WHERE sha256 = new.sha256);
+END;
+'''
+
+# バージョン10: 教師向けのライブ更新(events.py)の変更履歴。idは単調に増える(AUTOINCREMENTは番号を再利用しない)ので、
+# 読み手はidをカーソルにして末尾だけを読む。user_id はポートフォリオの持ち主、actor_id は操作した人
+EVENTS = '''
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    portfolio_id INTEGER,
+    user_id INTEGER,
+    actor_id INTEGER,
+    created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_events_created ON events (created_at);
+CREATE TRIGGER IF NOT EXISTS events_portfolio_insert AFTER INSERT ON portfolio BEGIN
+    INSERT INTO events (kind, portfolio_id, user_id, actor_id) VALUES ('portfolio_created', new.id, new.user_id, new.user_id);
+END;
+CREATE TRIGGER IF NOT EXISTS events_portfolio_update AFTER UPDATE OF title, content ON portfolio BEGIN
+    INSERT INTO events (kind, portfolio_id, user_id, actor_id) VALUES ('portfolio_updated', new.id, new.user_id, new.user_id);
+END;
+CREATE TRIGGER IF NOT EXISTS events_portfolio_delete AFTER DELETE ON portfolio BEGIN
+    INSERT INTO events (kind, portfolio_id, user_id, actor_id) VALUES ('portfolio_deleted', old.id, old.user_id, old.user_id);
+END;
+CREATE TRIGGER IF NOT EXISTS events_comments_insert AFTER INSERT ON comments BEGIN
+    INSERT INTO events (kind, portfolio_id, user_id, actor_id)
+    SELECT 'comment_added', id, user_id, new.teacher_id FROM portfolio WHERE id = new.portfolio_id;
+END;
+CREATE TRIGGER IF NOT EXISTS events_attachments_insert AFTER INSERT ON attachments BEGIN
+    INSERT INTO events (kind, portfolio_id, user_id, actor_id)
+    SELECT 'attachment_added', id, user_id, user_id FROM portfolio WHERE id = new.portfolio_id;
+END;
+-- タグは1行ずつ変わるので、直前の変更履歴が同じポートフォリオの作成・タグ変更なら追加しない
+CREATE TRIGGER IF NOT EXISTS events_tags_insert AFTER INSERT ON portfolio_tags
+WHEN NOT EXISTS (SELECT 1 FROM events WHERE id = (SELECT MAX(id) FROM events)
+                 AND kind IN ('portfolio_created', 'tags_changed') AND portfolio_id = new.portfolio_id)
+BEGIN
+    INSERT INTO events (kind, portfolio_id, user_id, actor_id)
+    SELECT 'tags_changed', id, user_id, user_id FROM portfolio WHERE id = new.portfolio_id;
+END;
+CREATE TRIGGER IF NOT EXISTS events_tags_delete AFTER DELETE ON portfolio_tags
+WHEN NOT EXISTS (SELECT 1 FROM events WHERE id = (SELECT MAX(id) FROM events)
+                 AND kind = 'tags_changed' AND portfolio_id = old.portfolio_id)
+BEGIN
+    INSERT INTO events (kind, portfolio_id, user_id, actor_id)
+    SELECT 'tags_changed', id, user_id, user_id FROM portfolio WHERE id = old.portfolio_id;
+END;
+'''
+
+# バージョン11: ポートフォリオの本文を portfolio_body に分ける。一覧が読む portfolio の行が小さくなり、
+# 本文は詳細・編集ページでだけ読む。長い本文は圧縮して保存する(bodies.py)。
+# content を参照していたトリガーは作り直し、タイトルの更新(本文だけの編集でも
+# repository.update_portfolio が必ず行う)でバージョン・集計・変更履歴を進める
+PORTFOLIO_BODY = '''
+CREATE TABLE IF NOT EXISTS portfolio_body (
+    portfolio_id INTEGER PRIMARY KEY REFERENCES portfolio (id),
+    body NOT NULL
+);
+DROP TRIGGER IF EXISTS portfolio_fts_insert;
+DROP TRIGGER IF EXISTS portfolio_fts_update;
+DROP TRIGGER IF EXISTS portfolio_version_update;
+DROP TRIGGER IF EXISTS student_stats_portfolio_update;
+DROP TRIGGER IF EXISTS events_portfolio_update;
+'''
+
+PORTFOLIO_BODY_TRIGGERS = '''
+ALTER TABLE portfolio DROP COLUMN content;
+CREATE TRIGGER IF NOT EXISTS portfolio_fts_insert AFTER INSERT ON portfolio_body BEGIN
+    INSERT INTO portfolio_fts (rowid, title, content)
+    SELECT id, bigrams(title), bigrams(body_text(new.body)) FROM portfolio WHERE id = new.portfolio_id;
+END;
+CREATE TRIGGER IF NOT EXISTS portfolio_fts_update AFTER UPDATE OF body ON portfolio_body BEGIN
+    DELETE FROM portfolio_fts WHERE rowid = old.portfolio_id;
+    INSERT INTO portfolio_fts (rowid, title, content)
+    SELECT id, bigrams(title), bigrams(body_text(new.body)) FROM portfolio WHERE id = new.portfolio_id;
+END;
+CREATE TRIGGER IF NOT EXISTS portfolio_fts_title AFTER UPDATE OF title ON portfolio WHEN new.title IS NOT old.title BEGIN
+    DELETE FROM portfolio_fts WHERE rowid = old.id;
+    INSERT INTO portfolio_fts (rowid, title, content)
+    SELECT new.id, bigrams(new.title), bigrams(body_text(body)) FROM portfolio_body WHERE portfolio_id = new.id;
+END;
+CREATE TRIGGER IF NOT EXISTS portfolio_body_delete AFTER DELETE ON portfolio BEGIN
+    DELETE FROM portfolio_body WHERE portfolio_id = old.id;
+END;
+CREATE TRIGGER IF NOT EXISTS portfolio_version_update AFTER UPDATE OF title ON portfolio BEGIN
+    UPDATE portfolio SET version = version + 1 WHERE id = new.id;
+END;
+CREATE TRIGGER IF NOT EXISTS student_stats_portfolio_update AFTER UPDATE OF title ON portfolio BEGIN
+    UPDATE student_stats SET last_activity = max(last_activity, CURRENT_TIMESTAMP) WHERE user_id = new.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS events_portfolio_update AFTER UPDATE OF title ON portfolio BEGIN
+    INSERT INTO events (kind, portfolio_id, user_id, actor_id) VALUES ('portfolio_updated', new.id, new.user_id, new.user_id);
+END;
+'''
+
+
+def split_portfolio_body(conn):
+    for statement in split_statements(PORTFOLIO_BODY):
+        conn.execute(statement)
+    # 圧縮はPythonで行うので、既存の本文は読みながら1件ずつ移す(全件をメモリに載せない)
+    conn.executemany('INSERT OR REPLACE INTO portfolio_body (portfolio_id, body) VALUES (?, ?)',
+                     ((portfolio_id, pack_body(content))
+                      for portfolio_id, content in conn.execute('SELECT id, content FROM portfolio')))
+    for statement in split_statements(PORTFOLIO_BODY_TRIGGERS):
+        conn.execute(statement)
+
+
+# バージョン12: 関連ポートフォリオ(related.py)。一覧は portfolio_id ごとに類似度の高い順に rank を振って持つ。
+# 本文・タイトル・タグが変わったポートフォリオには related_dirty に印を付け、ジョブがまとめて計算し直す。
+# 削除されたポートフォリオは他の一覧からも消し、その一覧には印を付ける
+RELATED = '''
+CREATE TABLE IF NOT EXISTS related_portfolios (
+    portfolio_id INTEGER NOT NULL,
+    rank INTEGER NOT NULL,
+    related_id INTEGER NOT NULL,
+    score REAL NOT NULL,
+    PRIMARY KEY (portfolio_id, rank)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_related_target ON related_portfolios (related_id);
+CREATE TABLE IF NOT EXISTS related_dirty (
+    portfolio_id INTEGER PRIMARY KEY,
+    marked REAL NOT NULL
+);
+INSERT OR REPLACE INTO related_dirty (portfolio_id, marked) SELECT id, julianday('now') FROM portfolio;
+CREATE TRIGGER IF NOT EXISTS related_body_insert AFTER INSERT ON portfolio_body BEGIN
+    INSERT OR REPLACE INTO related_dirty (portfolio_id, marked) VALUES (new.portfolio_id, julianday('now'));
+END;
+CREATE TRIGGER IF NOT EXISTS related_body_update AFTER UPDATE OF body ON portfolio_body BEGIN
+    INSERT OR REPLACE INTO related_dirty (portfolio_id, marked) VALUES (new.portfolio_id, julianday('now'));
+END;
+CREATE TRIGGER IF NOT EXISTS related_title_update AFTER UPDATE OF title ON portfolio WHEN new.title IS NOT old.title BEGIN
+    INSERT OR REPLACE INTO related_dirty (portfolio_id, marked) VALUES (new.id, julianday('now'));
+END;
+CREATE TRIGGER IF NOT EXISTS related_tags_insert AFTER INSERT ON portfolio_tags BEGIN
+    INSERT OR REPLACE INTO related_dirty (portfolio_id, marked) VALUES (new.portfolio_id, julianday('now'));
+END;
+CREATE TRIGGER IF NOT EXISTS related_tags_delete AFTER DELETE ON portfolio_tags BEGIN
+    INSERT OR REPLACE INTO related_dirty (portfolio_id, marked) VALUES (old.portfolio_id, julianday('now'));
+END;
+CREATE TRIGGER IF NOT EXISTS related_portfolio_delete AFTER DELETE ON portfolio BEGIN
+    INSERT OR REPLACE INTO related_dirty (portfolio_id, marked)
+    SELECT portfolio_id, julianday('now') FROM related_portfolios WHERE related_id = old.id;
+    DELETE FROM related_portfolios WHERE related_id = old.id;
+    DELETE FROM related_portfolios WHERE portfolio_id = old.id;
+    DELETE FROM related_dirty WHERE portfolio_id = old.id;
+END;
+'''
+
+# バージョン13: 重複チェック(duplicates.py)。ポートフォリオごとのMinHash署名と、それを区切ったLSHのバケット。
+# 本文が変わったら古い署名を消す(作成・編集の画面が計算し直し、それ以外は flask duplicates backfill で埋める)
+MINHASH = '''
+CREATE TABLE IF NOT EXISTS portfolio_minhash (
+    portfolio_id INTEGER PRIMARY KEY,
+    shingles INTEGER NOT NULL,
+    signature BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS portfolio_lsh (
+    band INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    portfolio_id INTEGER NOT NULL,
+    PRIMARY KEY (band, bucket, portfolio_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_lsh_portfolio ON portfolio_lsh (portfolio_id);
+CREATE TRIGGER IF NOT EXISTS minhash_body_update AFTER UPDATE OF body ON portfolio_body
+WHEN new.body IS NOT old.body BEGIN
+    DELETE FROM portfolio_minhash WHERE portfolio_id = new.portfolio_id;
+    DELETE FROM portfolio_lsh WHERE portfolio_id = new.portfolio_id;
+END;
+CREATE TRIGGER IF NOT EXISTS minhash_portfolio_delete AFTER DELETE ON portfolio BEGIN
+    DELETE FROM portfolio_minhash WHERE portfolio_id = old.id;
+    DELETE FROM portfolio_lsh WHERE portfolio_id = old.id;
+END;
+'''
+
+# バージョン14: タグの変更履歴はトリガーで1行ずつ書くのをやめ、タグを付け替える書き込み
+# (repository.change_portfolio_tags)が1回の変更につき1件書く。
+# 直前の履歴と比べて重複を省くトリガーでは、作成直後や続けて行ったタグの変更が記録されなかった
+TAG_EVENTS = '''
+DROP TRIGGER IF EXISTS events_tags_insert;
+DROP TRIGGER IF EXISTS events_tags_delete;
+'''
+
+# バージョン15: 関連ポートフォリオ(related.py)の手元のモデルが、他のプロセスの書き込みに気付くための世代番号。
+# 一覧に出ているポートフォリオの題名が変わったり消えたりしたら、それを一覧に出している詳細ページの描画キャッシュも作り直す
+RELATED_GENERATION = '''
+INSERT OR IGNORE INTO cache_generation (name, value) VALUES ('related', 0);
+CREATE TRIGGER IF NOT EXISTS related_title_listed AFTER UPDATE OF title ON portfolio WHEN new.title IS NOT old.title BEGIN
+    UPDATE portfolio SET version = version + 1
+    WHERE id IN (SELECT portfolio_id FROM related_portfolios WHERE related_id = new.id);
+END;
+DROP TRIGGER IF EXISTS related_portfolio_delete;
+CREATE TRIGGER IF NOT EXISTS related_portfolio_delete AFTER DELETE ON portfolio BEGIN
+    INSERT OR REPLACE INTO related_dirty (portfolio_id, marked)
+    SELECT portfolio_id, julianday('now') FROM related_portfolios WHERE related_id = old.id;
+    UPDATE portfolio SET version = version + 1
+    WHERE id IN (SELECT portfolio_id FROM related_portfolios WHERE related_id = old.id);
+    DELETE FROM related_portfolios WHERE related_id = old.id;
+    DELETE FROM related_portfolios WHERE portfolio_id = old.id;
+    DELETE FROM related_dirty WHERE portfolio_id = old.id;
+END;
+'''
+
+# 順番に適用される。途中の要素を書き換えたり削除したりせず、末尾に追加すること
+MIGRATIONS = [
+    INITIAL_SCHEMA,
+    INDEXES,
+    FULL_TEXT_SEARCH,
+    CACHE_GENERATIONS,
+    TAG_CATALOG_GENERATION,
+    PORTFOLIO_VERSION,
+    STUDENT_STATS,
+    JOBS,
+    ATTACHMENTS,
+    EVENTS,
+    split_portfolio_body,
+    RELATED,
+    MINHASH,
+    TAG_EVENTS,
+    RELATED_GENERATION,
+]
+
+
+def split_statements(script):
+    statements = []
+    buffer = ''
+    for line in script.splitlines(keepends=True):
+        buffer += line
+        # トリガーのBEGIN ... END; も一つの文として扱われる
+        if sqlite3.complete_statement(buffer):
+            statements.append(buffer.strip())
+            buffer = ''
+    if buffer.strip():
+        statements.append(buffer.strip())
+    return statements
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn, target=None):
+    if target is None:
+        target = len(MIGRATIONS)
+    applied = []
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        for version, step in enumerate(MIGRATIONS[:target], start=1):
+            if version <= schema_version(conn):
+                continue
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # 別プロセスが先に適用していないか、ロックを取ってから確認する
+                if version <= schema_version(conn):
+                    conn.execute('COMMIT')
+                    continue
+                if callable(step):
+                    step(conn)
+                else:
+                    for statement in split_statements(step):
+                        conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {version}')
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            applied.append(version)
+        if applied:
+            conn.execute('PRAGMA optimize')
+    finally:
+        conn.isolation_level = isolation_level
+    return applied
+
+
+def migrate_app(app, target=None):
+    conn = db.open_connection(app)
+    try:
+        return migrate(conn, target)
+    finally:
+        conn.close()
+
+
+@click.command('migrate')
+@click.option('--to', 'target', type=int, default=None, help='Schema version to migrate up to.')
+def migrate_command(target):
+    app = current_app._get_current_object()
+    applied = migrate_app(app, target)
+    if applied:
+        click.echo(f"Applied migrations: {', '.join(map(str, applied))}")
+    conn = db.open_connection(app, readonly=True)
+    try:
+        click.echo(f'Schema version: {schema_version(conn)}')
+    finally:
+        conn.close()
@@ -1,25 +1,51 @@
-class User:
-    def __init__(self, id, username, password, role, student_number=None, name=None, grade=None, graduation_year=None, bio=None):
-        self.id = id
-        self.username = username
-        self.password = password
-        self.role = role
-        self.student_number = student_number
-        self.name = name
-        self.grade = grade
-        self.graduation_year = graduation_year
-        self.bio = bio
-
-    def __repr__(self):
-        return f"<User {self.id}>"
-
-class Portfolio:
-    def __init__(self, id, user_id, title, content, created_at):
-        self.id = id
-        self.user_id = user_id
-        self.title = title
-        self.content = content
-        self.created_at = created_at
-
-    def __repr__(self):
-        return f"<Portfolio {self.id}>"
\ No newline at end of file
+from collections import namedtuple
+
+
+# 行をそのまま受け取るタプルのモデル(インスタンスごとの__dict__を持たない)。
+# 画面ごとに必要な列だけを持つものを分け、パスワードや本文はそれを使う画面でだけ読む。
+# 列の並びは repository.py のSELECT文と同じにすること
+
+# ログイン用
+User = namedtuple('User', ['id', 'username', 'password', 'role'])
+
+# プロフィールの表示・編集用
+Profile = namedtuple('Profile', ['id', 'username', 'role', 'student_number', 'name', 'grade', 'graduation_year', 'bio'])
+
+# 教師が見る生徒のポートフォリオ一覧の見出し用
+Student = namedtuple('Student', ['id', 'username'])
+
+# 生徒一覧の1行(集計はstudent_statsから)
+StudentStats = namedtuple('StudentStats', ['id', 'username', 'name', 'graduation_year', 'portfolio_count',
+                                           'comment_count', 'rating_avg', 'rating_count', 'last_activity'])
+
+# 詳細ページ用(本文を含む)
+Portfolio = namedtuple('Portfolio', ['id', 'user_id', 'title', 'content', 'created_at'])
+
+# 一覧用(本文を含まない)
+PortfolioSummary = namedtuple('PortfolioSummary', ['id', 'user_id', 'title', 'created_at'])
+
+# 詳細ページの描画キャッシュの確認用
+PortfolioVersion = namedtuple('PortfolioVersion', ['id', 'user_id', 'version'])
+
+Comment = namedtuple('Comment', ['id', 'teacher_id', 'comment', 'rating', 'created_at'])
+
+# 詳細ページの添付ファイル一覧用
+Attachment = namedtuple('Attachment', ['id', 'filename', 'size', 'mimetype', 'thumbnail'])
+
+# 添付ファイルの配信用
+AttachmentFile = namedtuple('AttachmentFile', ['filename', 'sha256', 'mimetype', 'thumbnail'])
+
+# ライブ更新の1件(events にポートフォリオの題名と持ち主の名前を結合したもの)
+Event = namedtuple('Event', ['id', 'kind', 'portfolio_id', 'user_id', 'actor_id', 'created_at', 'title', 'username'])
+
+# 卒業生のアーカイブ(archive.py)の生徒一覧の1行
+ArchivedStudent = namedtuple('ArchivedStudent', ['id', 'username', 'name', 'graduation_year', 'portfolio_count'])
+
+# アーカイブのコメント(教師は名前で持つ)
+ArchivedComment = namedtuple('ArchivedComment', ['id', 'teacher', 'comment', 'rating', 'created_at'])
+
+# 詳細ページの関連ポートフォリオ(related_portfolios から)
+RelatedPortfolio = namedtuple('RelatedPortfolio', ['id', 'title', 'username', 'score'])
+
+# 重複チェックのレポートの1件分(duplicates.py)
+PortfolioOwner = namedtuple('PortfolioOwner', ['id', 'user_id', 'title', 'username'])
@@ -0,0 +1,81 @@
+import base64
+import binascii
+import json
+from collections import namedtuple
+
+from flask import current_app, request
+
+
+Page = namedtuple('Page', ['items', 'next_cursor', 'prev_cursor'])
+
+
+def encode_cursor(values):
+    data = json.dumps(list(values), separators=(',', ':'), ensure_ascii=False).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def decode_cursor(cursor, size):
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError):
+        return None
+    # 壊れたカーソルや別の一覧のカーソルは無視して先頭ページを返す
+    if not isinstance(values, list) or len(values) != size:
+        return None
+    return values
+
+
+def paginate(conn, columns, from_where, params=(), keys=('id',), after=None, before=None,
+             per_page=20, descending=True, model=None):
+    # OFFSETを使わず、並び順のキー(最後の要素が一意になるもの)より後ろ/前だけを読む
+    # from_whereは 'FROM ... WHERE ...' の形で、WHERE句を必ず含めること。
+    # modelを渡すと、行はsqlite3.Rowではなくそのnamedtuple(columnsと同じ並び)になる
+    after = decode_cursor(after, len(keys))
+    before = decode_cursor(before, len(keys)) if after is None else None
+    sql = f"SELECT {columns}, {', '.join(f'{key} AS _key{i}' for i, key in enumerate(keys))} {from_where}"
+    params = list(params)
+    cursor = after if after is not None else before
+    if cursor is not None:
+        forward = (after is not None) == descending
+        sql += f" AND ({', '.join(keys)}) {'<' if forward else '>'} ({', '.join('?' for _ in keys)})"
+        params += cursor
+    backwards = before is not None
+    direction = 'DESC' if descending != backwards else 'ASC'
+    sql += f" ORDER BY {', '.join(f'{key} {direction}' for key in keys)} LIMIT ?"
+    params.append(per_page + 1)
+
+    if model is None:
+        rows = conn.execute(sql, params).fetchall()
+    else:
+        statement = conn.cursor()
+        statement.row_factory = None
+        rows = statement.execute(sql, params).fetchall()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+
+    width = len(model._fields) if model is not None else None
+
+    def row_cursor(row):
+        if model is not None:
+            return encode_cursor(row[width:])
+        return encode_cursor(row[f'_key{i}'] for i in range(len(keys)))
+
+    next_cursor = prev_cursor = None
+    if rows:
+        if backwards or has_more:
+            next_cursor = row_cursor(rows[-1])
+        if after is not None or (backwards and has_more):
+            prev_cursor = row_cursor(rows[0])
+    if model is not None:
+        rows = [model._make(row[:width]) for row in rows]
+    return Page(rows, next_cursor, prev_cursor)
+
+
+def paginate_request(conn, columns, from_where, params=(), **options):
+    options.setdefault('per_page', current_app.config['PAGE_SIZE'])
+    return paginate(conn, columns, from_where, params,
+                    after=request.args.get('after'), before=request.args.get('before'), **options)
@@ -0,0 +1,85 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HashingBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    # scrypt/pbkdf2はhashlib(OpenSSL)の中でGILを解放するので、スレッドでも複数コアを使える。
+    # 実行中+待ち行列が上限に達したら待たせずにHashingBusyを返し、ワーカーが詰まらないようにする
+    def __init__(self, method, workers, max_pending, timeout):
+        self.method = method
+        # 'scrypt' のような省略形を 'scrypt:32768:8:1' のような保存時の表記にそろえる。
+        # このハッシュは存在しないユーザーのログインの照合にも使う
+        self._dummy = generate_password_hash('', method)
+        self.prefix = self._dummy.split('$', 1)[0]
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+        self._timeout = timeout
+        # 計測用。observer(操作名, 秒) に順番待ちを含めた時間を渡す
+        self.observer = None
+
+    def _run(self, operation, function, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy('Too many password hashes in progress')
+        try:
+            future = self._executor.submit(function, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        started = time.perf_counter()
+        try:
+            result = future.result(timeout=self._timeout)
+        except TimeoutError:
+            # 待ち行列で待っている分は取り消す(実行中のものは終わるまで枠を使う)
+            future.cancel()
+            raise HashingBusy('Password hashing timed out') from None
+        if self.observer is not None:
+            self.observer(operation, time.perf_counter() - started)
+        return result
+
+    def hash(self, password):
+        return self._run('hash', generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        # 存在しないユーザー(password_hash が None)も同じ手間で照合して失敗させ、応答時間から有無が分からないようにする
+        if password_hash is None:
+            self._run('verify', check_password_hash, self._dummy, password)
+            return False
+        return self._run('verify', check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        # 設定したアルゴリズム・コストと異なるハッシュは、次にログインしたときに作り直す
+        return password_hash.split('$', 1)[0] != self.prefix
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+def get_password_hasher():
+    # フォーク後の子プロセスには親のスレッドが残らないので、プロセスごとに作り直す
+    app = current_app._get_current_object()
+    state = app.extensions.get('password_hasher')
+    if state is None or state[0] != os.getpid():
+        hasher = PasswordHasher(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_HASH_WORKERS'],
+                                app.config['PASSWORD_HASH_QUEUE'], app.config['PASSWORD_HASH_TIMEOUT'])
+        metrics = app.extensions.get('metrics')
+        if metrics is not None:
+            hasher.observer = metrics.password_hash
+        state = app.extensions['password_hasher'] = (os.getpid(), hasher)
+    return state[1]
+
+
+def init_app(app):
+    app.config.setdefault('PASSWORD_HASH_METHOD', 'scrypt')
+    app.config.setdefault('PASSWORD_HASH_WORKERS', os.cpu_count() or 1)
+    app.config.setdefault('PASSWORD_HASH_QUEUE', 32)
+    app.config.setdefault('PASSWORD_HASH_TIMEOUT', 10)
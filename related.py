@@ -0,0 +1,498 @@
+import math
+import os
+import threading
+import unicodedata
+from array import array
+from collections import Counter, defaultdict
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+import db
+from jobs import enqueue, job
+
+try:
+    import numpy as np
+except ImportError:  # NumPyがなければ同じ計算をPythonで行う(遅いが結果は同じ)
+    np = None
+
+
+related_cli = AppGroup('related', help='Build the related portfolios index.')
+
+NGRAMS = (2, 3)
+TITLE_WEIGHT = 2  # タイトルのN-gramは本文の2倍に数える
+MAX_CHARS = 4000  # 本文は先頭からこの文字数までを見る
+PRECISION = 4  # 保存する類似度の桁数(細かな揺れで一覧を書き直さないように)
+
+
+def _grams(text):
+    # 文字N-gram。形態素解析なしで日本語と英語の両方を扱え、表記の揺れ(全角・半角など)はNFKCでそろえる
+    text = ' '.join(unicodedata.normalize('NFKC', text).lower().split())
+    for n in NGRAMS:
+        for i in range(len(text) - n + 1):
+            gram = text[i:i + n]
+            if ' ' not in gram:
+                yield gram
+
+
+def _document(title, body):
+    counts = Counter(_grams(title or ''))
+    for gram in counts:
+        counts[gram] *= TITLE_WEIGHT
+    counts.update(_grams((body or '')[:MAX_CHARS]))
+    return counts
+
+
+class RelatedModel:
+    # 全ポートフォリオの文字N-gramのTF-IDFベクトルとタグのベクトル。similar()で1件と全件の類似度を出す。
+    # 文書側は疎な行列(CSR)と、その転置(N-gramごとの出現リスト)で持つので、1件あたり共通のN-gramを持つ文書しか見ない。
+    # タグは共起で広げる: 一緒に付きやすいタグ同士も cooc / sqrt(freq * freq) の重みで似ているとみなす。
+    # 作ったあとに変わった・増えたポートフォリオは update() で、作ったときの語彙とIDFのままベクトルにして別に持ち
+    # (self.changed)、消えたものは self.removed に入れる。CSRは作り直さない
+    def __init__(self, rows, tag_rows, max_df=0.3, tag_weight=0.3):
+        documents = []
+        self.ids = array('q')
+        self.users = array('q')
+        df = Counter()
+        # 1回目: 文書頻度を数える(N-gramの数が多いので、文書ごとの数は持たずに本文だけを取っておく)
+        for portfolio_id, user_id, title, body in rows:
+            self.ids.append(portfolio_id)
+            self.users.append(user_id)
+            documents.append((title or '', (body or '')[:MAX_CHARS]))
+            df.update(_document(title, body).keys())
+        n = self.base = len(self.ids)
+        self.index = {portfolio_id: i for i, portfolio_id in enumerate(self.ids)}
+        # 1件にしか出ないN-gramは比べる相手がなく、多くの文書に出るものは区別に役立たないので使わない
+        limit = max(2, max_df * n)
+        self.vocabulary = {}
+        self.idf = []
+        for gram, count in df.items():
+            if 1 < count <= limit:
+                self.vocabulary[gram] = len(self.idf)
+                self.idf.append(math.log((n + 1) / (count + 1)) + 1)
+        del df
+        # 2回目: 文書ごとのベクトル(1 + log(tf)) * idf を長さ1にしてCSRに並べる
+        self.doc_indptr = array('q', [0])
+        self.doc_terms = array('q')
+        self.doc_weights = array('d')
+        for title, body in documents:
+            terms, weights = self._vector(title, body)
+            self.doc_terms.extend(terms)
+            self.doc_weights.extend(weights)
+            self.doc_indptr.append(len(self.doc_terms))
+        del documents
+        self._postings(len(self.idf))
+        self._tags(tag_rows)
+        self.tag_weight = tag_weight if self.tag_count else 0.0
+        self.changed = {}  # 文書番号 -> (N-gram, 重み, タグ)
+        self.removed = set()
+        if np is not None:
+            self._vectorize()
+
+    def _vector(self, title, body):
+        vector = [(self.vocabulary[gram], (1 + math.log(count)) * self.idf[self.vocabulary[gram]])
+                  for gram, count in _document(title, body).items() if gram in self.vocabulary]
+        norm = math.sqrt(sum(weight * weight for _, weight in vector)) or 1.0
+        vector.sort()
+        return [term for term, _ in vector], [weight / norm for _, weight in vector]
+
+    def _postings(self, terms):
+        # N-gramごとの出現リスト(文書番号と重み)。CSRの転置を、N-gramごとの件数を数えてから一度で埋める
+        counts = array('q', [0]) * (terms + 1)
+        for term in self.doc_terms:
+            counts[term + 1] += 1
+        for term in range(terms):
+            counts[term + 1] += counts[term]
+        self.term_indptr = array('q', counts)
+        self.term_docs = array('q', [0]) * len(self.doc_terms)
+        self.term_weights = array('d', [0.0]) * len(self.doc_terms)
+        for doc in range(len(self.ids)):
+            for i in range(self.doc_indptr[doc], self.doc_indptr[doc + 1]):
+                term = self.doc_terms[i]
+                position = counts[term]
+                self.term_docs[position] = doc
+                self.term_weights[position] = self.doc_weights[i]
+                counts[term] = position + 1
+
+    def _tags(self, tag_rows):
+        self.doc_tags = defaultdict(list)
+        self.tag_index = {}
+        for portfolio_id, tag_id in tag_rows:
+            doc = self.index.get(portfolio_id)
+            if doc is not None:
+                self.doc_tags[doc].append(self.tag_index.setdefault(tag_id, len(self.tag_index)))
+        self.tag_count = len(self.tag_index)
+        frequency = Counter(tag for tags in self.doc_tags.values() for tag in tags)
+        pairs = Counter((a, b) for tags in self.doc_tags.values() for a in tags for b in tags)
+        # 共起の強さ(自分自身とは1)
+        self.cooccurrence = {pair: count / math.sqrt(frequency[pair[0]] * frequency[pair[1]])
+                             for pair, count in pairs.items()}
+        self.tag_docs = defaultdict(list)
+        for doc, tags in self.doc_tags.items():
+            for tag in tags:
+                self.tag_docs[tag].append(doc)
+        self.tag_norms = {doc: self._tag_norm(tags) for doc, tags in self.doc_tags.items()}
+
+    def _tag_norm(self, tags):
+        return math.sqrt(sum(self.cooccurrence.get((a, b), 0.0) for a in tags for b in tags))
+
+    def _vectorize(self):
+        # NumPyがあるときは、1件分の類似度を全文書まとめて配列の演算で求める。
+        # ids・users は update() で伸びるので、配列にはコピーを持つ(作ったときの文書の分だけ)
+        self._term_indptr = np.frombuffer(self.term_indptr, dtype=np.int64)
+        self._term_docs = np.frombuffer(self.term_docs, dtype=np.int64)
+        self._term_weights = np.frombuffer(self.term_weights, dtype=np.float64)
+        self._ids = np.array(self.ids, dtype=np.int64)
+        self._users = np.array(self.users, dtype=np.int64)
+        self._tag_matrix = np.zeros((self.base, self.tag_count))
+        for doc, tags in self.doc_tags.items():
+            self._tag_matrix[doc, tags] = 1.0
+        self._cooccurrence = np.zeros((self.tag_count, self.tag_count))
+        for (a, b), value in self.cooccurrence.items():
+            self._cooccurrence[a, b] = value
+        # score(x, d) = A[x] C A[d]。Cは対称なので A C の行と A の内積で全文書分が一度に出る
+        self._tag_norms = np.sqrt(((self._tag_matrix @ self._cooccurrence) * self._tag_matrix).sum(axis=1))
+
+    def __contains__(self, portfolio_id):
+        return portfolio_id in self.index
+
+    @property
+    def changes(self):
+        return len(self.changed) + len(self.removed)
+
+    def update(self, portfolio_id, user_id, title, body, tag_ids):
+        # 変わった(増えた)ポートフォリオを作ったときの語彙・IDF・タグの番号でベクトルにする。新しいタグは作り直すまで使わない
+        doc = self.index.get(portfolio_id)
+        if doc is None:
+            doc = self.index[portfolio_id] = len(self.ids)
+            self.ids.append(portfolio_id)
+            self.users.append(user_id)
+        terms, weights = self._vector(title, body)
+        self.changed[doc] = (terms, weights, [self.tag_index[tag] for tag in tag_ids if tag in self.tag_index])
+
+    def remove(self, portfolio_id):
+        doc = self.index.pop(portfolio_id, None)
+        if doc is not None:
+            self.changed.pop(doc, None)
+            self.removed.add(doc)
+
+    def _document_vector(self, doc):
+        if doc in self.changed:
+            return self.changed[doc]
+        start, end = self.doc_indptr[doc], self.doc_indptr[doc + 1]
+        return self.doc_terms[start:end], self.doc_weights[start:end], self.doc_tags.get(doc, [])
+
+    def _pair(self, query, doc):
+        # 変わった文書との類似度は1件ずつ求める
+        terms, weights, tags = query
+        other_terms, other_weights, other_tags = self.changed[doc]
+        weights = dict(zip(terms, weights))
+        text = sum(weights.get(term, 0.0) * weight for term, weight in zip(other_terms, other_weights))
+        score = (1 - self.tag_weight) * text
+        norm, other_norm = self._tag_norm(tags), self._tag_norm(other_tags)
+        if self.tag_weight and norm and other_norm:
+            score += self.tag_weight * sum(self.cooccurrence.get((a, b), 0.0)
+                                           for a in tags for b in other_tags) / (norm * other_norm)
+        return score
+
+    def similar(self, portfolio_id, min_score):
+        # 別の生徒のポートフォリオとの類似度(本文のコサイン類似度とタグの類似度の加重和)を、
+        # min_score以上のものについて高い順に (ID, 類似度) で返す。類似度は対称(aから見てもbから見ても同じ)
+        doc = self.index[portfolio_id]
+        query = self._document_vector(doc)
+        user = self.users[doc]
+        if np is not None:
+            found = self._similar_numpy(query, user, min_score)
+        else:
+            found = self._similar_python(query, user, min_score)
+        # 作ったあとに変わった・消えた文書は、CSRにある古いベクトルの分を置き換える
+        if self.changed or self.removed:
+            skip = {self.ids[other] for other in self.removed.union(self.changed)}
+            found = [(other, score) for other, score in found if other not in skip]
+            for other in self.changed:
+                if self.users[other] != user:
+                    score = round(self._pair(query, other), PRECISION)
+                    if score >= min_score:
+                        found.append((self.ids[other], score))
+            found.sort(key=lambda item: (-item[1], item[0]))
+        return found
+
+    def _similar_numpy(self, query, user, min_score):
+        terms, weights, tags = query
+        terms, weights = np.asarray(terms, dtype=np.int64), np.asarray(weights, dtype=np.float64)
+        starts = self._term_indptr[terms]
+        lengths = self._term_indptr[terms + 1] - starts
+        # 各N-gramの出現リストをつなげた位置を一度に作る
+        offsets = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+        positions = offsets + np.arange(lengths.sum())
+        text = np.bincount(self._term_docs[positions], minlength=self.base,
+                           weights=self._term_weights[positions] * np.repeat(weights, lengths))
+        scores = (1 - self.tag_weight) * text
+        norm = self._tag_norm(tags)
+        if self.tag_weight and norm:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                tag_scores = self._tag_matrix @ self._cooccurrence[tags].sum(axis=0) / (self._tag_norms * norm)
+            scores += self.tag_weight * np.nan_to_num(tag_scores)
+        scores = np.round(scores, PRECISION)
+        scores[self._users == user] = 0
+        candidates = np.flatnonzero(scores >= min_score)
+        order = candidates[np.lexsort((self._ids[candidates], -scores[candidates]))]
+        return [(int(self._ids[i]), float(scores[i])) for i in order]
+
+    def _similar_python(self, query, user, min_score):
+        terms, weights, tags = query
+        scores = defaultdict(float)
+        text_weight = 1 - self.tag_weight
+        for term, weight in zip(terms, weights):
+            weight *= text_weight
+            for j in range(self.term_indptr[term], self.term_indptr[term + 1]):
+                scores[self.term_docs[j]] += weight * self.term_weights[j]
+        norm = self._tag_norm(tags)
+        if self.tag_weight and norm:
+            expanded = defaultdict(float)
+            for a in tags:
+                for b in range(self.tag_count):
+                    expanded[b] += self.cooccurrence.get((a, b), 0.0)
+            tag_scores = defaultdict(float)
+            for tag, weight in expanded.items():
+                if weight:
+                    for other in self.tag_docs[tag]:
+                        tag_scores[other] += weight
+            for other, value in tag_scores.items():
+                scores[other] += self.tag_weight * value / (norm * self.tag_norms[other])
+        found = [(self.ids[other], round(score, PRECISION)) for other, score in scores.items()
+                 if self.users[other] != user]
+        return sorted(((portfolio_id, score) for portfolio_id, score in found if score >= min_score),
+                      key=lambda item: (-item[1], item[0]))
+
+
+def _rows(conn, where='', params=()):
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    return cursor.execute('SELECT p.id, p.user_id, p.title, body_text(b.body) FROM portfolio p '
+                          f'LEFT JOIN portfolio_body b ON b.portfolio_id = p.id {where} ORDER BY p.id', params)
+
+
+def build_model(conn, app):
+    tag_rows = conn.cursor().execute('SELECT portfolio_id, tag_id FROM portfolio_tags').fetchall()
+    return RelatedModel(_rows(conn), tag_rows, app.config['RELATED_MAX_DF'], app.config['RELATED_TAG_WEIGHT'])
+
+
+def _apply_marks(conn, model, portfolio_ids, chunk=500):
+    # 印の付いたポートフォリオだけを読み直してモデルに反映する
+    for start in range(0, len(portfolio_ids), chunk):
+        ids = portfolio_ids[start:start + chunk]
+        placeholders = ', '.join('?' for _ in ids)
+        tags = defaultdict(list)
+        for portfolio_id, tag_id in conn.execute(
+                f'SELECT portfolio_id, tag_id FROM portfolio_tags WHERE portfolio_id IN ({placeholders})', ids):
+            tags[portfolio_id].append(tag_id)
+        found = set()
+        for portfolio_id, user_id, title, body in _rows(conn, f'WHERE p.id IN ({placeholders})', ids):
+            model.update(portfolio_id, user_id, title, body, tags[portfolio_id])
+            found.add(portfolio_id)
+        for portfolio_id in ids:
+            if portfolio_id not in found:
+                model.remove(portfolio_id)
+
+
+class _Lists:
+    # 保存済みの関連の一覧を、使う分だけDBから読んで持つ(1回の実行の間だけ)。
+    # 書き換える前に必ず読んでおくので、手元の内容はコミットしたDBの内容に変更を重ねたものになる
+    def __init__(self, conn):
+        self._conn = conn
+        self._lists = {}
+        self._listed_by = {}
+
+    def get(self, portfolio_id):
+        if portfolio_id not in self._lists:
+            self._lists[portfolio_id] = [(related_id, score) for related_id, score in self._conn.execute(
+                'SELECT related_id, score FROM related_portfolios WHERE portfolio_id = ? ORDER BY rank',
+                (portfolio_id,))]
+        return self._lists[portfolio_id]
+
+    def listed_by(self, portfolio_id):
+        # portfolio_id を一覧に入れているポートフォリオ
+        if portfolio_id not in self._listed_by:
+            self._listed_by[portfolio_id] = {row[0] for row in self._conn.execute(
+                'SELECT portfolio_id FROM related_portfolios WHERE related_id = ?', (portfolio_id,))}
+        return self._listed_by[portfolio_id]
+
+    def set(self, portfolio_id, entries, changed):
+        for related_id, _ in self.get(portfolio_id):
+            self.listed_by(related_id).discard(portfolio_id)
+        for related_id, _ in entries:
+            self.listed_by(related_id).add(portfolio_id)
+        self._lists[portfolio_id] = entries
+        changed.add(portfolio_id)
+
+
+def _update(model, lists, portfolio_id, count, min_score, changed, stale):
+    # portfolio_id の一覧を作り直し、他のポートフォリオの一覧にある portfolio_id も差分で直す。
+    # 類似度は対称なので、相手の一覧では portfolio_id の類似度を書き換えて並べ直すか、最下位より高ければ入れ替えるだけで済む。
+    # 下限を下回って相手の一覧から外れたときは、その次の候補が分からないので相手も計算し直す(stale)。
+    # IDFが変わって他の組の類似度がわずかにずれる分は追いかけない(モデルを作り直すときに揃う)
+    similar = model.similar(portfolio_id, min_score)
+    top = similar[:count]
+    if top != lists.get(portfolio_id):
+        lists.set(portfolio_id, top, changed)
+    scores = dict(similar)
+    for other in list(lists.listed_by(portfolio_id)):
+        score = scores.get(other)
+        if score is None:
+            stale.add(other)
+        elif score != dict(lists.get(other))[portfolio_id]:
+            entries = sorted([(related_id, score if related_id == portfolio_id else value)
+                              for related_id, value in lists.get(other)], key=lambda item: (-item[1], item[0]))
+            lists.set(other, entries, changed)
+    for other, score in similar:
+        if other in lists.listed_by(portfolio_id) or other not in model:
+            continue
+        entries = lists.get(other)
+        if len(entries) < count or score > entries[-1][1]:
+            entries = sorted(entries + [(portfolio_id, score)], key=lambda item: (-item[1], item[0]))[:count]
+            lists.set(other, entries, changed)
+
+
+class _State:
+    # プロセスごとに持つモデル。generation は最後に自分が書いたときの cache_generation('related') の値
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.model = None
+        self.generation = None
+
+
+def _get_state(app):
+    # フォーク後の子プロセスは自分のモデルを作り直す
+    state = app.extensions.get('related_model')
+    if state is None or state[0] != os.getpid():
+        state = app.extensions['related_model'] = (os.getpid(), _State())
+    return state[1]
+
+
+def _model(app, conn, state):
+    # 手元のモデルに印の付いた分だけを反映して使う。他のプロセスが一覧を書いていたとき(世代が違う)と、
+    # 作ったあとの変更が RELATED_REFIT の割合を超えたとき(語彙・IDFが古くなった)は全件から作り直す。
+    # 作り直したときは保存済みの一覧の類似度も全てずれているので、全件に印を付けて計算し直す。
+    # モデルに反映した印(ID -> 印を付けた時刻)も返す
+    marks = dict(conn.execute('SELECT portfolio_id, marked FROM related_dirty').fetchall())
+    model = state.model
+    if (model is None or db.read_generation(conn, 'related') != state.generation
+            or model.changes + len(marks) > app.config['RELATED_REFIT'] * model.base):
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute("INSERT OR IGNORE INTO related_dirty (portfolio_id, marked) "
+                     "SELECT id, julianday('now') FROM portfolio")
+        conn.commit()
+        marks = dict(conn.execute('SELECT portfolio_id, marked FROM related_dirty').fetchall())
+        model = state.model = build_model(conn, app)
+    else:
+        _apply_marks(conn, model, sorted(marks))
+    return model, marks
+
+
+def rebuild(app, conn, passes=3):
+    # related_dirty の印が付いたポートフォリオの関連を計算し直す。モデルはプロセスの中で使い回し、
+    # RELATED_BATCH 件ごとに短い書き込みトランザクションで保存する。残った印の数を返す
+    count, min_score, batch = app.config['RELATED_COUNT'], app.config['RELATED_MIN_SCORE'], app.config['RELATED_BATCH']
+    state = _get_state(app)
+    with state.lock:
+        model, applied = _model(app, conn, state)
+        lists = _Lists(conn)
+        processed = 0
+        for _ in range(passes):
+            after = 0
+            found = False
+            while True:
+                marks = conn.execute('SELECT portfolio_id, marked FROM related_dirty WHERE portfolio_id > ? '
+                                     'ORDER BY portfolio_id LIMIT ?', (after, batch)).fetchall()
+                if not marks:
+                    break
+                after = marks[-1][0]
+                # 実行中に付いた印(編集・追加されたものと、前の回の stale)は、先にモデルに反映する
+                fresh = [portfolio_id for portfolio_id, marked in marks if applied.get(portfolio_id) != marked]
+                if fresh:
+                    _apply_marks(conn, model, fresh)
+                    applied.update(marks)
+                marks = [(portfolio_id, marked) for portfolio_id, marked in marks if portfolio_id in model]
+                changed, stale = set(), set()
+                for portfolio_id, _ in marks:
+                    _update(model, lists, portfolio_id, count, min_score, changed, stale)
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    for portfolio_id in changed:
+                        conn.execute('DELETE FROM related_portfolios WHERE portfolio_id = ?', (portfolio_id,))
+                        conn.executemany('INSERT INTO related_portfolios (portfolio_id, rank, related_id, score) '
+                                         'VALUES (?, ?, ?, ?)',
+                                         [(portfolio_id, rank, related_id, score)
+                                          for rank, (related_id, score) in enumerate(lists.get(portfolio_id))])
+                    # 詳細ページの描画キャッシュを作り直させる(タイトルの更新ではないので、他のトリガーは動かない)
+                    conn.executemany('UPDATE portfolio SET version = version + 1 WHERE id = ?',
+                                     [(portfolio_id,) for portfolio_id in changed])
+                    conn.executemany('DELETE FROM related_dirty WHERE portfolio_id = ? AND marked = ?', marks)
+                    # 内容は変わっていないので、次の回でモデルに反映し直さないよう印の時刻を覚えておく
+                    now = conn.execute("SELECT julianday('now')").fetchone()[0]
+                    conn.executemany('INSERT OR REPLACE INTO related_dirty (portfolio_id, marked) VALUES (?, ?)',
+                                     [(portfolio_id, now) for portfolio_id in stale])
+                    state.generation = conn.execute("UPDATE cache_generation SET value = value + 1 "
+                                                    "WHERE name = 'related' RETURNING value").fetchone()[0]
+                    conn.commit()
+                    applied.update((portfolio_id, now) for portfolio_id in stale)
+                except Exception:
+                    conn.rollback()
+                    # 書けなかった分は手元のモデルと一覧が食い違うので、次の実行で作り直す
+                    state.model = None
+                    raise
+                processed += len(marks)
+                found = found or bool(marks)
+            if not found:
+                break
+    remaining = conn.execute('SELECT count(*) FROM related_dirty').fetchone()[0]
+    return {'processed': processed, 'remaining': remaining}
+
+
+def schedule(conn):
+    # 印を付けた書き込みをコミットしたあとに呼ぶ。RELATED_DELAY 秒の間に付いた印は1回のジョブでまとめて処理する
+    enqueue(conn, 'related_portfolios', delay=current_app.config['RELATED_DELAY'], dedupe_key='related_portfolios')
+    conn.commit()
+
+
+@job('related_portfolios', priority=-10, max_attempts=3)
+def rebuild_job(payload):
+    app = current_app._get_current_object()
+    conn = db.get_db_connection()
+    result = rebuild(app, conn)
+    if result['remaining'] and not app.config['JOBS_EAGER']:
+        schedule(conn)
+
+
+@related_cli.command('rebuild')
+@click.option('--all', 'everything', is_flag=True, help='Recompute every portfolio, not only changed ones.')
+def rebuild_command(everything):
+    app = current_app._get_current_object()
+    conn = db.open_connection(app)
+    try:
+        if everything:
+            conn.execute("INSERT OR REPLACE INTO related_dirty (portfolio_id, marked) "
+                         "SELECT id, julianday('now') FROM portfolio")
+            conn.commit()
+        result = rebuild(app, conn)
+    finally:
+        conn.close()
+    click.echo(f"{result['processed']} portfolios updated ({'NumPy' if np is not None else 'pure Python'}), "
+               f"{result['remaining']} still marked")
+
+
+def init_app(app):
+    # 1件あたりに保存する関連ポートフォリオの数と、それに入れる類似度の下限
+    app.config.setdefault('RELATED_COUNT', 5)
+    app.config.setdefault('RELATED_MIN_SCORE', 0.05)
+    # 類似度に占めるタグの割合(残りは本文)と、使うN-gramの文書頻度の上限(全体に対する割合)
+    app.config.setdefault('RELATED_TAG_WEIGHT', 0.3)
+    app.config.setdefault('RELATED_MAX_DF', 0.3)
+    # 1回の書き込みトランザクションで扱う件数と、最初の変更からジョブを実行するまでの待ち時間(秒)
+    app.config.setdefault('RELATED_BATCH', 100)
+    app.config.setdefault('RELATED_DELAY', 60)
+    # 手元のモデルを全件から作り直すまでに反映する変更の割合(全件に対する)
+    app.config.setdefault('RELATED_REFIT', 0.1)
+    app.cli.add_command(related_cli)
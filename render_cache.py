@@ -0,0 +1,70 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import current_app, make_response, session
+from flask_wtf.csrf import generate_csrf
+
+from compression import etag_matches
+
+
+# キャッシュする HTML ではリクエストごとに変わる CSRF トークンをこの文字列に置き換えておく
+CSRF_PLACEHOLDER = '\x00csrf-token\x00'
+
+
+class RenderCache:
+    # 描画済み HTML の LRU キャッシュ。件数ではなく合計サイズ(文字数)で上限を決める
+    def __init__(self, max_size):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self.max_size = max_size
+
+    def get(self, key):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+            return html
+
+    def put(self, key, html):
+        if len(html) > self.max_size:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._entries[key] = html
+            self._size += len(html)
+            while self._size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+def cached_page(key, render):
+    # keyには描画結果を一意に決める値(ID・バージョン・テンプレートなど)をすべて含めること。
+    # フラッシュメッセージのように一度きりの内容があるページには使わない
+    token = generate_csrf()
+    digest = hashlib.sha256(repr((key, session.get('csrf_token'))).encode()).hexdigest()[:32]
+    if etag_matches(digest):
+        response = current_app.response_class(status=304)
+    else:
+        cache = current_app.extensions['render_cache']
+        html = cache.get(key)
+        if html is None:
+            html = render().replace(token, CSRF_PLACEHOLDER)
+            cache.put(key, html)
+        response = make_response(html.replace(CSRF_PLACEHOLDER, token))
+    response.set_etag(digest)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def init_app(app):
+    app.config.setdefault('RENDER_CACHE_SIZE', 16 * 1024 * 1024)
+    app.extensions['render_cache'] = RenderCache(app.config['RENDER_CACHE_SIZE'])
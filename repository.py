@@ -0,0 +1,338 @@
+from functools import lru_cache
+
+from bodies import pack as pack_body
+
+from models import (ArchivedComment, ArchivedStudent, Attachment, AttachmentFile, Comment, Event, Portfolio,
+                    PortfolioOwner, PortfolioSummary, PortfolioVersion, Profile, RelatedPortfolio, Student, StudentStats,
+                    User)
+from pagination import paginate_request
+
+
+# 画面から使うSQLをここにまとめる。同じ文字列を使い回すので、接続ごとの準備済み文のキャッシュに当たる。
+# SELECTは使う列だけを並べ(SELECT * を使わない)、列の並びは models.py のnamedtupleと合わせる
+
+USER_BY_USERNAME = "SELECT id, username, password, role FROM user WHERE username = ?"
+PROFILE = ("SELECT id, username, role, student_number, name, grade, graduation_year, bio "
+           "FROM user WHERE id = ?")
+STUDENT = "SELECT id, username FROM user WHERE id = ?"
+# 本文は portfolio_body に分けて(長いものは圧縮して)あるので、読むのは詳細・編集ページだけ
+PORTFOLIO = ("SELECT p.id, p.user_id, p.title, body_text(b.body), p.created_at FROM portfolio p "
+             "LEFT JOIN portfolio_body b ON b.portfolio_id = p.id WHERE p.id = ?")
+OWN_PORTFOLIO = ("SELECT p.id, p.user_id, p.title, body_text(b.body), p.created_at FROM portfolio p "
+                 "LEFT JOIN portfolio_body b ON b.portfolio_id = p.id WHERE p.id = ? AND p.user_id = ?")
+IS_OWNER = "SELECT 1 FROM portfolio WHERE id = ? AND user_id = ?"
+PORTFOLIO_EXISTS = "SELECT 1 FROM portfolio WHERE id = ?"
+PORTFOLIO_VERSION = "SELECT id, user_id, version FROM portfolio WHERE id = ?"
+PORTFOLIO_TAG_IDS = "SELECT tag_id FROM portfolio_tags WHERE portfolio_id = ? ORDER BY tag_id"
+COMMENTS = "SELECT id, teacher_id, comment, rating, created_at FROM comments WHERE portfolio_id = ? ORDER BY id"
+ATTACHMENTS = ("SELECT a.id, a.filename, b.size, b.mimetype, b.thumbnail FROM attachments a "
+               "JOIN blobs b ON b.sha256 = a.sha256 WHERE a.portfolio_id = ? ORDER BY a.id")
+ATTACHMENT_FILE = ("SELECT a.filename, b.sha256, b.mimetype, b.thumbnail FROM attachments a "
+                   "JOIN blobs b ON b.sha256 = a.sha256 WHERE a.id = ?")
+OWN_ATTACHMENT = ("SELECT a.portfolio_id FROM attachments a JOIN portfolio p ON p.id = a.portfolio_id "
+                  "WHERE a.id = ? AND p.user_id = ?")
+RELATED_PORTFOLIOS = ("SELECT p.id, p.title, u.username, r.score FROM related_portfolios r "
+                      "JOIN portfolio p ON p.id = r.related_id JOIN user u ON u.id = p.user_id "
+                      "WHERE r.portfolio_id = ? ORDER BY r.rank")
+HAS_MINHASH = "SELECT 1 FROM portfolio_minhash WHERE portfolio_id = ?"
+MISSING_MINHASH = ("SELECT p.id, b.body FROM portfolio p LEFT JOIN portfolio_body b ON b.portfolio_id = p.id "
+                   "WHERE p.id > ? AND NOT EXISTS (SELECT 1 FROM portfolio_minhash m WHERE m.portfolio_id = p.id) "
+                   "ORDER BY p.id LIMIT ?")
+# 同じバケットに入った別の生徒のポートフォリオの組(duplicates.py)。大きすぎるバケットは使わない
+DUPLICATE_CANDIDATES = """
+WITH shared AS (
+    SELECT band, bucket FROM portfolio_lsh GROUP BY band, bucket HAVING count(*) BETWEEN 2 AND :max_bucket
+), pairs AS (
+    SELECT DISTINCT a.portfolio_id AS first_id, b.portfolio_id AS second_id FROM shared s
+    JOIN portfolio_lsh a ON a.band = s.band AND a.bucket = s.bucket
+    JOIN portfolio_lsh b ON b.band = s.band AND b.bucket = s.bucket AND b.portfolio_id > a.portfolio_id
+)
+SELECT pairs.first_id, pairs.second_id, ma.signature, mb.signature FROM pairs
+JOIN portfolio pa ON pa.id = pairs.first_id
+JOIN portfolio pb ON pb.id = pairs.second_id
+JOIN portfolio_minhash ma ON ma.portfolio_id = pairs.first_id
+JOIN portfolio_minhash mb ON mb.portfolio_id = pairs.second_id
+WHERE pa.user_id != pb.user_id AND (:student IS NULL OR :student IN (pa.user_id, pb.user_id))
+"""
+GRADUATION_YEARS = ("SELECT DISTINCT graduation_year FROM student_stats "
+                    "WHERE graduation_year IS NOT NULL ORDER BY graduation_year")
+EVENTS_AFTER = ("SELECT e.id, e.kind, e.portfolio_id, e.user_id, e.actor_id, e.created_at, p.title, u.username "
+                "FROM events e LEFT JOIN portfolio p ON p.id = e.portfolio_id LEFT JOIN user u ON u.id = e.user_id "
+                "WHERE e.id > ? ORDER BY e.id LIMIT ?")
+LATEST_EVENT = "SELECT COALESCE(MAX(id), 0) FROM events"
+
+# 卒業生のアーカイブを読む。archive.attached() で archive としてつないだ接続で使う
+ARCHIVED_STUDENTS = ("SELECT u.id, u.username, u.name, u.graduation_year, "
+                     "(SELECT count(*) FROM archive.portfolio AS p WHERE p.user_id = u.id) "
+                     "FROM archive.user AS u ORDER BY u.username")
+ARCHIVED_STUDENT = "SELECT id, username FROM archive.user WHERE id = ?"
+ARCHIVED_PORTFOLIOS = "SELECT id, user_id, title, created_at FROM archive.portfolio WHERE user_id = ? ORDER BY id DESC"
+ARCHIVED_PORTFOLIO = ("SELECT p.id, p.user_id, p.title, body_text(b.body), p.created_at FROM archive.portfolio p "
+                      "LEFT JOIN archive.portfolio_body b ON b.portfolio_id = p.id WHERE p.id = ?")
+ARCHIVED_TAGS = "SELECT tag FROM archive.portfolio_tags WHERE portfolio_id = ? ORDER BY tag"
+ARCHIVED_COMMENTS = ("SELECT id, teacher, comment, rating, created_at FROM archive.comments "
+                     "WHERE portfolio_id = ? ORDER BY id")
+# アーカイブの添付にはサムネイルを出さない(thumbnail = -1)
+ARCHIVED_ATTACHMENTS = ("SELECT id, filename, size, mimetype, -1 FROM archive.attachments "
+                        "WHERE portfolio_id = ? ORDER BY id")
+ARCHIVED_ATTACHMENT_FILE = "SELECT filename, sha256, mimetype, -1 FROM archive.attachments WHERE id = ?"
+
+INSERT_USER = "INSERT INTO user (username, password, role) VALUES (?, ?, ?)"
+UPDATE_PASSWORD = "UPDATE user SET password = ? WHERE id = ? AND password = ?"
+UPDATE_PROFILE = ("UPDATE user SET student_number = ?, name = ?, grade = ?, graduation_year = ?, bio = ? "
+                  "WHERE id = ?")
+INSERT_PORTFOLIO = "INSERT INTO portfolio (user_id, title) VALUES (?, ?)"
+UPDATE_PORTFOLIO = "UPDATE portfolio SET title = ? WHERE id = ?"
+INSERT_PORTFOLIO_BODY = "INSERT INTO portfolio_body (portfolio_id, body) VALUES (?, ?)"
+UPDATE_PORTFOLIO_BODY = "UPDATE portfolio_body SET body = ? WHERE portfolio_id = ? AND body IS NOT ?"
+DELETE_PORTFOLIO = "DELETE FROM portfolio WHERE id = ?"
+INSERT_PORTFOLIO_TAG = "INSERT INTO portfolio_tags (portfolio_id, tag_id) VALUES (?, ?)"
+DELETE_PORTFOLIO_TAG = "DELETE FROM portfolio_tags WHERE portfolio_id = ? AND tag_id = ?"
+TAGS_CHANGED_EVENT = ("INSERT INTO events (kind, portfolio_id, user_id, actor_id) "
+                      "SELECT 'tags_changed', id, user_id, user_id FROM portfolio WHERE id = ?")
+DELETE_PORTFOLIO_TAGS = "DELETE FROM portfolio_tags WHERE portfolio_id = ?"
+INSERT_COMMENT = "INSERT INTO comments (portfolio_id, teacher_id, comment, rating) VALUES (?, ?, ?, ?)"
+DELETE_COMMENTS = "DELETE FROM comments WHERE portfolio_id = ?"
+DELETE_ATTACHMENT = "DELETE FROM attachments WHERE id = ?"
+DELETE_ATTACHMENTS = "DELETE FROM attachments WHERE portfolio_id = ?"
+INSERT_TAG = "INSERT INTO tags (name) VALUES (?)"
+
+# 生徒一覧で選べる並び順。student_statsのインデックス (graduation_year, 列, user_id) に対応する
+STUDENT_SORTS = {
+    'activity': 's.last_activity',
+    'portfolios': 's.portfolio_count',
+    'comments': 's.comment_count',
+    'rating': 's.rating_avg',
+}
+
+
+@lru_cache(maxsize=None)
+def _row_factory(model):
+    # sqlite3.Rowを経由せずに、取り出した行のタプルからモデルを直接作る
+    make = model._make
+    return lambda cursor, row: make(row)
+
+
+def _select(conn, model, sql, params):
+    cursor = conn.cursor()
+    cursor.row_factory = _row_factory(model)
+    return cursor.execute(sql, params)
+
+
+def _column(conn, sql, params):
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    return [row[0] for row in cursor.execute(sql, params)]
+
+
+def user_by_username(conn, username):
+    return _select(conn, User, USER_BY_USERNAME, (username,)).fetchone()
+
+
+def profile(conn, user_id):
+    return _select(conn, Profile, PROFILE, (user_id,)).fetchone()
+
+
+def student(conn, user_id):
+    return _select(conn, Student, STUDENT, (user_id,)).fetchone()
+
+
+def portfolio(conn, portfolio_id):
+    return _select(conn, Portfolio, PORTFOLIO, (portfolio_id,)).fetchone()
+
+
+def own_portfolio(conn, portfolio_id, user_id):
+    return _select(conn, Portfolio, OWN_PORTFOLIO, (portfolio_id, user_id)).fetchone()
+
+
+def is_owner(conn, portfolio_id, user_id):
+    return conn.execute(IS_OWNER, (portfolio_id, user_id)).fetchone() is not None
+
+
+def portfolio_exists(conn, portfolio_id):
+    return conn.execute(PORTFOLIO_EXISTS, (portfolio_id,)).fetchone() is not None
+
+
+def portfolio_version(conn, portfolio_id):
+    return _select(conn, PortfolioVersion, PORTFOLIO_VERSION, (portfolio_id,)).fetchone()
+
+
+def portfolio_tag_ids(conn, portfolio_id):
+    return _column(conn, PORTFOLIO_TAG_IDS, (portfolio_id,))
+
+
+def comments(conn, portfolio_id):
+    return _select(conn, Comment, COMMENTS, (portfolio_id,)).fetchall()
+
+
+def attachments(conn, portfolio_id):
+    return _select(conn, Attachment, ATTACHMENTS, (portfolio_id,)).fetchall()
+
+
+def attachment_file(conn, attachment_id):
+    return _select(conn, AttachmentFile, ATTACHMENT_FILE, (attachment_id,)).fetchone()
+
+
+def own_attachment_portfolio(conn, attachment_id, user_id):
+    ids = _column(conn, OWN_ATTACHMENT, (attachment_id, user_id))
+    return ids[0] if ids else None
+
+
+def related_portfolios(conn, portfolio_id):
+    # 計算済みの一覧を主キーの範囲で読むだけ(計算は related.py のジョブで行う)
+    return _select(conn, RelatedPortfolio, RELATED_PORTFOLIOS, (portfolio_id,)).fetchall()
+
+
+def has_minhash(conn, portfolio_id):
+    return conn.execute(HAS_MINHASH, (portfolio_id,)).fetchone() is not None
+
+
+def missing_minhash(conn, after, limit):
+    # 署名のないポートフォリオのIDと本文(保存したままの形式)。IDの順に limit 件ずつ読む
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    return cursor.execute(MISSING_MINHASH, (after, limit)).fetchall()
+
+
+def duplicate_candidates(conn, max_bucket, student_id=None):
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    return cursor.execute(DUPLICATE_CANDIDATES, {'max_bucket': max_bucket, 'student': student_id})
+
+
+def portfolio_owners(conn, portfolio_ids):
+    placeholders = ', '.join('?' for _ in portfolio_ids)
+    return _select(conn, PortfolioOwner,
+                   f"SELECT p.id, p.user_id, p.title, u.username FROM portfolio p JOIN user u ON u.id = p.user_id "
+                   f"WHERE p.id IN ({placeholders})", portfolio_ids).fetchall()
+
+
+def portfolio_titles(conn, portfolio_ids):
+    # タグ検索の結果ページ用。件数ごとに別の文になるが、1ページの件数は多くない
+    placeholders = ', '.join('?' for _ in portfolio_ids)
+    return _select(conn, PortfolioSummary,
+                   f"SELECT id, user_id, title, created_at FROM portfolio WHERE id IN ({placeholders}) "
+                   "ORDER BY id DESC", portfolio_ids).fetchall()
+
+
+def portfolio_page(conn, user_id):
+    return paginate_request(conn, 'id, user_id, title, created_at', 'FROM portfolio WHERE user_id = ?',
+                            (user_id,), model=PortfolioSummary)
+
+
+def student_page(conn, sort, year, descending):
+    # 集計はstudent_statsにトリガーで保存済みなので、卒業年度と並び順のインデックスを読むだけで済む
+    from_where = "FROM student_stats AS s JOIN user AS u ON u.id = s.user_id WHERE 1"
+    params = []
+    if year:
+        from_where += " AND s.graduation_year = ?"
+        params.append(year)
+    return paginate_request(conn, '''u.id, u.username, u.name, s.graduation_year, s.portfolio_count, s.comment_count,
+                                     s.rating_avg, s.rating_count, s.last_activity''',
+                            from_where, params, keys=(STUDENT_SORTS[sort], 's.user_id'), descending=descending,
+                            model=StudentStats)
+
+
+def graduation_years(conn):
+    return _column(conn, GRADUATION_YEARS, ())
+
+
+def events_after(conn, event_id, limit):
+    # 主キーの範囲を読むだけなので、履歴が長くなっても末尾の数件しか読まない
+    return _select(conn, Event, EVENTS_AFTER, (event_id, limit)).fetchall()
+
+
+def latest_event_id(conn):
+    return _column(conn, LATEST_EVENT, ())[0]
+
+
+def archived_students(conn):
+    return _select(conn, ArchivedStudent, ARCHIVED_STUDENTS, ()).fetchall()
+
+
+def archived_student(conn, user_id):
+    return _select(conn, Student, ARCHIVED_STUDENT, (user_id,)).fetchone()
+
+
+def archived_portfolios(conn, user_id):
+    return _select(conn, PortfolioSummary, ARCHIVED_PORTFOLIOS, (user_id,)).fetchall()
+
+
+def archived_portfolio(conn, portfolio_id):
+    return _select(conn, Portfolio, ARCHIVED_PORTFOLIO, (portfolio_id,)).fetchone()
+
+
+def archived_tags(conn, portfolio_id):
+    return _column(conn, ARCHIVED_TAGS, (portfolio_id,))
+
+
+def archived_comments(conn, portfolio_id):
+    return _select(conn, ArchivedComment, ARCHIVED_COMMENTS, (portfolio_id,)).fetchall()
+
+
+def archived_attachments(conn, portfolio_id):
+    return _select(conn, Attachment, ARCHIVED_ATTACHMENTS, (portfolio_id,)).fetchall()
+
+
+def archived_attachment_file(conn, attachment_id):
+    return _select(conn, AttachmentFile, ARCHIVED_ATTACHMENT_FILE, (attachment_id,)).fetchone()
+
+
+def create_user(conn, username, password_hash, role):
+    return conn.execute(INSERT_USER, (username, password_hash, role)).lastrowid
+
+
+def update_password(conn, user_id, new_hash, old_hash):
+    # 別のリクエストが先にパスワードを変えていたら上書きしない
+    return conn.execute(UPDATE_PASSWORD, (new_hash, user_id, old_hash)).rowcount
+
+
+def update_profile(conn, user_id, student_number, name, grade, graduation_year, bio):
+    conn.execute(UPDATE_PROFILE, (student_number, name, grade, graduation_year, bio, user_id))
+
+
+def create_portfolio(conn, user_id, title, content, tag_ids=()):
+    portfolio_id = conn.execute(INSERT_PORTFOLIO, (user_id, title)).lastrowid
+    conn.execute(INSERT_PORTFOLIO_BODY, (portfolio_id, pack_body(content)))
+    conn.executemany(INSERT_PORTFOLIO_TAG, [(portfolio_id, tag_id) for tag_id in tag_ids])
+    return portfolio_id
+
+
+def update_portfolio(conn, portfolio_id, title, content):
+    # 本文は変わったときだけ書き換える(全文検索の更新を省く)。タイトルは同じでも必ず更新し、
+    # それを合図にトリガーがバージョン・生徒の集計・変更履歴を進める
+    body = pack_body(content)
+    conn.execute(UPDATE_PORTFOLIO_BODY, (body, portfolio_id, body))
+    conn.execute(UPDATE_PORTFOLIO, (title, portfolio_id))
+
+
+def change_portfolio_tags(conn, portfolio_id, added=(), removed=()):
+    # 何本変えても、ライブ更新の変更履歴は1回の変更につき1件
+    conn.executemany(DELETE_PORTFOLIO_TAG, [(portfolio_id, tag_id) for tag_id in removed])
+    conn.executemany(INSERT_PORTFOLIO_TAG, [(portfolio_id, tag_id) for tag_id in added])
+    if added or removed:
+        conn.execute(TAGS_CHANGED_EVENT, (portfolio_id,))
+
+
+def delete_portfolio(conn, portfolio_id):
+    # タグの関連・コメント・添付も一緒に削除し、外したタグのIDを返す(タグインデックスの更新用)。
+    # コメントの削除で生徒の集計も更新される。添付の実体は他から参照されていることがあるので、
+    # ここでは消さない(flask attachments gc で消す)
+    removed = portfolio_tag_ids(conn, portfolio_id)
+    conn.execute(DELETE_PORTFOLIO_TAGS, (portfolio_id,))
+    conn.execute(DELETE_COMMENTS, (portfolio_id,))
+    conn.execute(DELETE_ATTACHMENTS, (portfolio_id,))
+    conn.execute(DELETE_PORTFOLIO, (portfolio_id,))
+    return removed
+
+
+def add_comment(conn, portfolio_id, teacher_id, comment, rating):
+    conn.execute(INSERT_COMMENT, (portfolio_id, teacher_id, comment, rating))
+
+
+def delete_attachment(conn, attachment_id):
+    conn.execute(DELETE_ATTACHMENT, (attachment_id,))
+
+
+def create_tag(conn, name):
+    return conn.execute(INSERT_TAG, (name,)).lastrowid
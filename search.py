@@ -0,0 +1,93 @@
+import re
+import unicodedata
+from collections import namedtuple
+
+
+# ひらがな・カタカナ・漢字の連続はバイグラムに、それ以外の英数字は単語単位に分割する
+_CJK = '぀-ヿ㐀-䶿一-鿿豈-﫿ｦ-ﾟ'
+_TOKEN = re.compile(rf'(?P<cjk>[{_CJK}]+)|(?P<word>[^\W_{_CJK}]+)')
+
+SearchResults = namedtuple('SearchResults', ['hits', 'page', 'has_next'])
+
+
+def _tokens(text):
+    text = unicodedata.normalize('NFKC', text).lower()
+    for match in _TOKEN.finditer(text):
+        run = match.group('cjk')
+        if run is None:
+            yield match.group('word')
+        elif len(run) == 1:
+            yield run
+        else:
+            for i in range(len(run) - 1):
+                yield run[i:i + 2]
+
+
+def to_bigrams(text):
+    # FTS5のunicode61トークナイザに渡す前に、形態素解析の代わりにN-gram化しておく
+    if not text:
+        return ''
+    return ' '.join(_tokens(text))
+
+
+def match_query(text):
+    terms = []
+    for token in dict.fromkeys(_tokens(text or '')):
+        token = token.replace('"', '""')
+        # 1文字の漢字や入力途中の英単語は前方一致で拾う
+        if len(token) == 1 or token.isascii():
+            terms.append(f'"{token}"*')
+        else:
+            terms.append(f'"{token}"')
+    return ' AND '.join(terms) or None
+
+
+def _tag_filter(tag_ids):
+    placeholders = ', '.join('?' for _ in tag_ids)
+    return f'''
+        SELECT portfolio_id FROM portfolio_tags
+        WHERE tag_id IN ({placeholders})
+        GROUP BY portfolio_id HAVING COUNT(*) = {len(tag_ids)}
+    '''
+
+
+def search(conn, query, tag_ids=(), page=1, per_page=20):
+    match = match_query(query)
+    if match is None:
+        return SearchResults([], page, False)
+    tag_ids = sorted(set(tag_ids))
+
+    student_sql = '''
+        SELECT 'student' AS kind, rowid AS id, bm25(user_fts, 5.0, 10.0, 1.0) AS rank
+        FROM user_fts WHERE user_fts MATCH ?
+    '''
+    portfolio_sql = '''
+        SELECT 'portfolio' AS kind, rowid AS id, bm25(portfolio_fts, 5.0, 1.0) AS rank
+        FROM portfolio_fts WHERE portfolio_fts MATCH ?
+    '''
+    student_params = [match]
+    portfolio_params = [match]
+    if tag_ids:
+        # タグ指定時は、すべてのタグが付いたポートフォリオと、その持ち主だけに絞り込む
+        tagged = _tag_filter(tag_ids)
+        student_sql += f' AND rowid IN (SELECT user_id FROM portfolio WHERE id IN ({tagged}))'
+        portfolio_sql += f' AND rowid IN ({tagged})'
+        student_params += tag_ids
+        portfolio_params += tag_ids
+
+    rows = conn.execute(f'''
+        SELECT hits.kind, hits.id, hits.rank,
+               COALESCE(u.username, owner.username) AS username,
+               COALESCE(u.name, owner.name) AS name,
+               p.title, p.user_id
+        FROM (
+            SELECT * FROM ({student_sql} UNION ALL {portfolio_sql})
+            ORDER BY rank, kind, id
+            LIMIT ? OFFSET ?
+        ) AS hits
+        LEFT JOIN user AS u ON hits.kind = 'student' AND u.id = hits.id
+        LEFT JOIN portfolio AS p ON hits.kind = 'portfolio' AND p.id = hits.id
+        LEFT JOIN user AS owner ON owner.id = p.user_id
+        ORDER BY hits.rank, hits.kind, hits.id
+    ''', student_params + portfolio_params + [per_page + 1, (page - 1) * per_page]).fetchall()
+    return SearchResults(rows[:per_page], page, len(rows) > per_page)
@@ -0,0 +1,170 @@
+import random
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from werkzeug.security import generate_password_hash
+
+import db
+from bodies import pack as pack_body
+from importer import batches, next_id
+
+
+# 文章を組み立てるための語彙。実際のポートフォリオに近い長さと文字種(漢字・かな)にする
+SUBJECTS = ['機械学習', 'ロボット制御', '地域活性化', '環境調査', 'プログラミング', 'データ分析', '英語ディベート',
+            '化学実験', '歴史研究', '映像制作', '起業体験', 'ボランティア活動', '数学オリンピック', '部活動',
+            '天体観測', '農業体験', 'ウェブ制作', '音楽制作', '防災マップ', '福祉施設訪問']
+ACTIONS = ['について調べました', 'に取り組みました', 'の発表を行いました', 'のチームを立ち上げました',
+           'の課題を解決しました', 'に参加しました', 'の報告書をまとめました', 'の試作品を作りました']
+DETAILS = ['仮説を立てて検証したところ、予想とは異なる結果になりました。',
+           '先生や地域の方々から多くの助言をいただきました。',
+           '失敗を繰り返しながらも、最後までやり遂げることができました。',
+           'チームで役割を分担し、週に一度進捗を共有しました。',
+           '集めたデータをグラフにまとめ、考察を加えました。',
+           '次の学年では、この経験をさらに発展させたいと考えています。',
+           '発表会では質問にうまく答えられず、準備の大切さを学びました。',
+           '文献を読み比べることで、多角的な見方が身につきました。']
+COMMENTS = ['よくまとまっています。', '考察をもう少し深めましょう。', '素晴らしい取り組みです。',
+            '根拠となるデータを示すとさらに良くなります。', '継続して取り組んでください。',
+            '発表の工夫が伝わってきました。']
+FAMILY_NAMES = ['佐藤', '鈴木', '高橋', '田中', '伊藤', '渡辺', '山本', '中村', '小林', '加藤', '吉田', '山田']
+GIVEN_NAMES = ['翔太', '陽菜', '大翔', '結衣', '蓮', '美咲', '悠真', '葵', '颯太', 'さくら', '湊', '凛']
+TAG_WORDS = ['探究', '研究', '実験', '発表', '地域', '国際', '情報', '理科', '数学', '国語', '社会', '芸術',
+             '体育', '英語', '福祉', '環境', '進路', '部活動', '生徒会', '資格']
+
+# シードで作るユーザーのパスワード(ベンチマークのログインにも使う)
+DEFAULT_PASSWORD = 'password'
+
+
+def _paragraphs(rng, count):
+    return '\n\n'.join(
+        f'{rng.choice(SUBJECTS)}{rng.choice(ACTIONS)}。' + ''.join(rng.sample(DETAILS, rng.randint(2, 5)))
+        for _ in range(count))
+
+
+def _tag_names(count):
+    # 語彙を組み合わせて必要な数だけ一意なタグ名を作る
+    names = list(TAG_WORDS)
+    for first in TAG_WORDS:
+        for second in TAG_WORDS:
+            if len(names) >= count:
+                return names[:count]
+            if first != second:
+                names.append(f'{first}・{second}')
+    return names[:count]
+
+
+def _reserve_ids(conn, table, count):
+    # 書き込みロックを取ってから続きのIDを決め、sqlite_sequence を進めてその範囲を予約する。
+    # 行はあとでバッチごとに書くので、その間にアプリが追加した行は予約した範囲の後ろのIDになる
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        first = next_id(conn, table)
+        if count:
+            last = first + count - 1
+            if not conn.execute('UPDATE sqlite_sequence SET seq = ? WHERE name = ?', (last, table)).rowcount:
+                conn.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (table, last))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return list(range(first, first + count))
+
+
+def seed(conn, students=100, teachers=5, portfolios_per_student=5, comments_per_portfolio=2, tags=30,
+         tags_per_portfolio=3, graduation_years=('2025', '2026', '2027'), password_hash=None,
+         random_seed=0, batch_size=1000, progress=None):
+    # 既存のデータは残したまま追加する。ユーザー名は既存のIDの続きの番号にする
+    rng = random.Random(random_seed)
+    now = datetime.now()
+    conn.isolation_level = None
+
+    def write(rows, sql):
+        for batch in batches(rows, batch_size):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany(sql, batch)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            if progress:
+                progress(len(batch))
+
+    conn.executemany('INSERT OR IGNORE INTO tags (name) VALUES (?)', [(name,) for name in _tag_names(tags)])
+    tag_ids = [row[0] for row in conn.execute('SELECT id FROM tags ORDER BY id LIMIT ?', (tags,))]
+
+    user_ids = _reserve_ids(conn, 'user', teachers + students)
+    teacher_ids, student_ids = user_ids[:teachers], user_ids[teachers:]
+    write(((user_id, f'teacher{user_id}', password_hash, 'teacher', None, f'{rng.choice(FAMILY_NAMES)}先生',
+            None, None, None) for user_id in teacher_ids),
+          'INSERT INTO user (id, username, password, role, student_number, name, grade, graduation_year, bio) '
+          'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)')
+    write(((user_id, f'student{user_id}', password_hash, 'student', f'S{user_id:06d}',
+            f'{rng.choice(FAMILY_NAMES)} {rng.choice(GIVEN_NAMES)}', str(rng.randint(1, 3)),
+            rng.choice(graduation_years), _paragraphs(rng, 1)) for user_id in student_ids),
+          'INSERT INTO user (id, username, password, role, student_number, name, grade, graduation_year, bio) '
+          'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)')
+
+    portfolio_ids = _reserve_ids(conn, 'portfolio', students * portfolios_per_student)
+
+    # 本文は後から portfolio_body に書くので、ここで作ったものを取っておく
+    bodies = {}
+
+    def portfolio_rows():
+        for index, portfolio_id in enumerate(portfolio_ids):
+            created_at = now - timedelta(minutes=rng.randint(0, 365 * 24 * 60))
+            bodies[portfolio_id] = _paragraphs(rng, rng.randint(1, 4))
+            yield (portfolio_id, student_ids[index // portfolios_per_student],
+                   f'{rng.choice(SUBJECTS)}{rng.choice(ACTIONS)}', created_at.strftime('%Y-%m-%d %H:%M:%S'))
+
+    write(portfolio_rows(), 'INSERT INTO portfolio (id, user_id, title, created_at) VALUES (?, ?, ?, ?)')
+    write(((portfolio_id, pack_body(bodies.pop(portfolio_id))) for portfolio_id in portfolio_ids),
+          'INSERT INTO portfolio_body (portfolio_id, body) VALUES (?, ?)')
+    if tag_ids:
+        write(((portfolio_id, tag_id) for portfolio_id in portfolio_ids
+               for tag_id in rng.sample(tag_ids, min(len(tag_ids), rng.randint(0, tags_per_portfolio)))),
+              'INSERT OR IGNORE INTO portfolio_tags (portfolio_id, tag_id) VALUES (?, ?)')
+    if teacher_ids:
+        write(((portfolio_id, rng.choice(teacher_ids), rng.choice(COMMENTS), rng.randint(1, 5))
+               for portfolio_id in portfolio_ids for _ in range(rng.randint(0, 2 * comments_per_portfolio))),
+              'INSERT INTO comments (portfolio_id, teacher_id, comment, rating) VALUES (?, ?, ?, ?)')
+    conn.execute('ANALYZE')
+    conn.execute('PRAGMA optimize')
+    return {'teachers': len(teacher_ids), 'students': len(student_ids), 'portfolios': len(portfolio_ids)}
+
+
+@click.command('seed')
+@click.option('--students', default=100, show_default=True)
+@click.option('--teachers', default=5, show_default=True)
+@click.option('--portfolios-per-student', default=5, show_default=True)
+@click.option('--comments-per-portfolio', default=2, show_default=True, help='Average comments per portfolio.')
+@click.option('--tags', default=30, show_default=True)
+@click.option('--tags-per-portfolio', default=3, show_default=True, help='Maximum tags per portfolio.')
+@click.option('--graduation-years', default='2025,2026,2027', show_default=True)
+@click.option('--seed', 'random_seed', default=0, show_default=True, help='Random seed (same seed, same data).')
+@click.option('--password', default=DEFAULT_PASSWORD, show_default=True, help='Password for every seeded user.')
+def seed_command(students, teachers, portfolios_per_student, comments_per_portfolio, tags, tags_per_portfolio,
+                 graduation_years, random_seed, password):
+    app = current_app._get_current_object()
+    # 全員同じパスワードなので、ハッシュは一度だけ計算する
+    password_hash = generate_password_hash(password, method=app.config['PASSWORD_HASH_METHOD'])
+    conn = db.open_connection(app)
+    started = time.perf_counter()
+    rows = 0
+
+    def progress(count):
+        nonlocal rows
+        rows += count
+        click.echo(f'{rows} rows written', err=True)
+
+    try:
+        created = seed(conn, students, teachers, portfolios_per_student, comments_per_portfolio, tags,
+                       tags_per_portfolio, [year.strip() for year in graduation_years.split(',') if year.strip()],
+                       password_hash, random_seed, progress=progress)
+    finally:
+        conn.close()
+    click.echo(f"Seeded {created['teachers']} teachers, {created['students']} students and "
+               f"{created['portfolios']} portfolios in {time.perf_counter() - started:.1f}s "
+               f"(password: {password})")
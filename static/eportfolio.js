@@ -0,0 +1,40 @@
+// 教師用ページのライブ更新。/events(Server-Sent Events)から届いた変更を画面上部の一覧に足していく。
+// 接続が切れたときはブラウザが最後に受け取ったIDを付けてつなぎ直すので、その間の変更も後から届く
+(function () {
+  var box = document.getElementById('live-events');
+  if (!box || !window.EventSource) {
+    return;
+  }
+  var list = box.querySelector('ul');
+  var messages = {
+    portfolio_created: 'さんがポートフォリオを投稿しました',
+    portfolio_updated: 'さんがポートフォリオを編集しました',
+    portfolio_deleted: 'さんがポートフォリオを削除しました',
+    tags_changed: 'さんがタグを変更しました',
+    attachment_added: 'さんがファイルを添付しました',
+    comment_added: 'さんのポートフォリオにコメントがつきました'
+  };
+  var source = new EventSource(box.dataset.url);
+
+  Object.keys(messages).forEach(function (kind) {
+    source.addEventListener(kind, function (message) {
+      var event = JSON.parse(message.data);
+      var item = document.createElement('li');
+      // 名前や題名は生徒が入力したものなので、HTMLとしてではなく文字列として入れる
+      item.appendChild(document.createTextNode((event.username || '') + messages[kind] + ' '));
+      if (event.url) {
+        var link = document.createElement('a');
+        link.href = event.url;
+        link.textContent = event.title || '';
+        item.appendChild(link);
+      } else if (event.title) {
+        item.appendChild(document.createTextNode(event.title));
+      }
+      list.insertBefore(item, list.firstChild);
+      while (list.children.length > 10) {
+        list.removeChild(list.lastChild);
+      }
+      box.hidden = false;
+    });
+  });
+})();
@@ -0,0 +1,85 @@
+import threading
+from collections import namedtuple
+
+from flask import current_app, g, has_app_context
+
+import repository
+from db import read_generation
+
+
+Tag = namedtuple('Tag', ['id', 'name'])
+
+
+class TagCatalog:
+    # タグ一覧のプロセス内キャッシュ。タグが追加されるとトリガーが世代番号を進めるので、
+    # 各ワーカーは主キー検索一回で自分のコピーが古いかどうかを判定できる
+    GENERATION = 'tags'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generation = None
+        self._tags = ()
+        self._by_id = {}
+
+    def _load(self, conn):
+        own_transaction = not conn.in_transaction
+        if own_transaction:
+            conn.execute('BEGIN')
+        try:
+            generation = read_generation(conn, self.GENERATION)
+            tags = tuple(Tag(row[0], row[1]) for row in conn.execute('SELECT id, name FROM tags ORDER BY id'))
+        finally:
+            if own_transaction:
+                conn.commit()
+        self._tags = tags
+        self._by_id = {tag.id: tag for tag in tags}
+        self._generation = generation
+
+    def _current(self, conn):
+        # 世代番号の確認はアプリコンテキスト(リクエスト)ごとに一回だけ行う
+        if has_app_context() and g.get('_tag_catalog_checked'):
+            return self._tags, self._by_id
+        with self._lock:
+            if self._generation is None or self._generation != read_generation(conn, self.GENERATION):
+                self._load(conn)
+            tags, by_id = self._tags, self._by_id
+        if has_app_context():
+            g._tag_catalog_checked = True
+        return tags, by_id
+
+    def invalidate(self):
+        # 自プロセスで書き込んだ直後に呼ぶ。他のプロセスは世代番号で気付く
+        with self._lock:
+            self._generation = None
+        if has_app_context():
+            g.pop('_tag_catalog_checked', None)
+
+    def all(self, conn):
+        return self._current(conn)[0]
+
+    def choices(self, conn):
+        return [(tag.id, tag.name) for tag in self.all(conn)]
+
+    def ids_by_name(self, conn):
+        return {tag.name: tag.id for tag in self.all(conn)}
+
+    def name(self, conn, tag_id):
+        tag = self._current(conn)[1].get(tag_id)
+        return tag.name if tag else None
+
+    def lookup(self, conn, tag_ids):
+        by_id = self._current(conn)[1]
+        return [by_id[tag_id] for tag_id in tag_ids if tag_id in by_id]
+
+
+def get_tag_catalog():
+    return current_app.extensions['tag_catalog']
+
+
+def tags_for_portfolio(conn, portfolio_id):
+    # 詳細ページ用。タグ名はキャッシュから引くのでtagsテーブルとの結合は不要
+    return get_tag_catalog().lookup(conn, repository.portfolio_tag_ids(conn, portfolio_id))
+
+
+def init_app(app):
+    app.extensions['tag_catalog'] = TagCatalog()
@@ -0,0 +1,226 @@
+import re
+import threading
+
+from flask import current_app
+
+from db import read_generation
+from pagination import Page, decode_cursor, encode_cursor
+
+
+class TagQueryError(ValueError):
+    pass
+
+
+def _bitmap(ids):
+    # ポートフォリオIDをビット位置とする整数。一つずつ |= すると大きな整数を何度も作り直すので、まとめて組み立てる
+    ids = list(ids)
+    if not ids:
+        return 0
+    buffer = bytearray(max(ids) // 8 + 1)
+    for portfolio_id in ids:
+        buffer[portfolio_id >> 3] |= 1 << (portfolio_id & 7)
+    return int.from_bytes(buffer, 'little')
+
+
+class TagIndex:
+    # タグID -> ポートフォリオIDのビットマップ。AND/OR/NOTは整数のビット演算で計算する
+    GENERATION = 'tag_index'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generation = None
+        self._tags = {}
+        self._all = 0
+
+    def _load(self, conn):
+        # 世代番号と中身が同じスナップショットから読まれるように、一つのトランザクションで読む
+        own_transaction = not conn.in_transaction
+        if own_transaction:
+            conn.execute('BEGIN')
+        try:
+            generation = read_generation(conn, self.GENERATION)
+            members = {}
+            for portfolio_id, tag_id in conn.execute('SELECT portfolio_id, tag_id FROM portfolio_tags'):
+                members.setdefault(tag_id, []).append(portfolio_id)
+            everything = _bitmap(row[0] for row in conn.execute('SELECT id FROM portfolio'))
+        finally:
+            if own_transaction:
+                conn.commit()
+        self._tags = {tag_id: _bitmap(ids) for tag_id, ids in members.items()}
+        self._all = everything
+        self._generation = generation
+
+    def snapshot(self, conn):
+        # 他のワーカープロセスが書き込んでいれば世代番号がずれているので読み直す
+        with self._lock:
+            if self._generation != read_generation(conn, self.GENERATION):
+                self._load(conn)
+            return dict(self._tags), self._all
+
+    def record(self, conn, portfolio_id, added=(), removed=(), created=False, deleted=False):
+        # 書き込みトランザクションの中、コミットの直前に呼ぶ。
+        # 自分の変更分だけ世代番号が進んでいれば差分を反映し、そうでなければ次の検索で読み直す
+        expected = len(added) + len(removed) + created + deleted
+        generation = read_generation(conn, self.GENERATION)
+        bit = 1 << portfolio_id
+        with self._lock:
+            if self._generation is None or self._generation + expected != generation:
+                self._generation = None
+                return
+            for tag_id in added:
+                self._tags[tag_id] = self._tags.get(tag_id, 0) | bit
+            for tag_id in removed:
+                self._tags[tag_id] = self._tags.get(tag_id, 0) & ~bit
+            if created:
+                self._all |= bit
+            if deleted:
+                self._all &= ~bit
+            self._generation = generation
+
+    def query(self, conn, expression, tag_names):
+        tags, everything = self.snapshot(conn)
+        return _Parser(expression, tag_names, tags, everything).parse()
+
+    def tagged(self, conn, tag_id):
+        tags, _ = self.snapshot(conn)
+        return tags.get(tag_id, 0)
+
+
+_TOKEN = re.compile(r'\s*(?:(\()|(\))|"([^"]*)"|([^\s()"]+))')
+
+
+class _Parser:
+    # expr := term (OR term)* / term := factor ([AND] factor)* / factor := NOT factor | ( expr ) | タグ名
+    def __init__(self, expression, tag_names, tags, everything):
+        self._tokens = self._tokenize(expression)
+        self._position = 0
+        self._tag_names = {name.casefold(): tag_id for name, tag_id in tag_names.items()}
+        self._tags = tags
+        self._all = everything
+
+    @staticmethod
+    def _tokenize(expression):
+        tokens = []
+        position = 0
+        expression = expression.rstrip()
+        while position < len(expression):
+            match = _TOKEN.match(expression, position)
+            if not match:
+                raise TagQueryError('Unbalanced quotes in tag query.')
+            opening, closing, quoted, word = match.groups()
+            if opening or closing:
+                tokens.append(opening or closing)
+            elif quoted is not None:
+                tokens.append(('tag', quoted))
+            elif word.upper() in ('AND', 'OR', 'NOT'):
+                tokens.append(word.upper())
+            else:
+                tokens.append(('tag', word))
+            position = match.end()
+        return tokens
+
+    def _peek(self):
+        return self._tokens[self._position] if self._position < len(self._tokens) else None
+
+    def _next(self):
+        token = self._peek()
+        self._position += 1
+        return token
+
+    def parse(self):
+        if not self._tokens:
+            raise TagQueryError('Enter at least one tag.')
+        result = self._expr()
+        if self._peek() is not None:
+            raise TagQueryError('Unexpected input in tag query.')
+        return result
+
+    def _expr(self):
+        result = self._term()
+        while self._peek() == 'OR':
+            self._next()
+            result |= self._term()
+        return result
+
+    def _term(self):
+        result = self._factor()
+        # 演算子を省略して並べたタグはANDとして扱う
+        while self._peek() not in (None, 'OR', ')'):
+            if self._peek() == 'AND':
+                self._next()
+            result &= self._factor()
+        return result
+
+    def _factor(self):
+        token = self._next()
+        if token == 'NOT':
+            return self._all & ~self._factor()
+        if token == '(':
+            result = self._expr()
+            if self._next() != ')':
+                raise TagQueryError('Missing closing parenthesis in tag query.')
+            return result
+        if isinstance(token, tuple):
+            tag_id = self._tag_names.get(token[1].casefold())
+            if tag_id is None:
+                raise TagQueryError(f'Unknown tag: {token[1]}')
+            return self._tags.get(tag_id, 0)
+        raise TagQueryError('Incomplete tag query.')
+
+
+def _take_descending(bitmap, limit):
+    ids = []
+    while bitmap and len(ids) < limit:
+        top = bitmap.bit_length() - 1
+        ids.append(top)
+        bitmap ^= 1 << top
+    return ids
+
+
+def _take_ascending(bitmap, limit):
+    ids = []
+    while bitmap and len(ids) < limit:
+        lowest = bitmap & -bitmap
+        ids.append(lowest.bit_length() - 1)
+        bitmap ^= lowest
+    return ids
+
+
+def _cursor_id(cursor, limit):
+    value = decode_cursor(cursor, 1)
+    if value is None or type(value[0]) is not int:
+        return None
+    # 巨大なシフトを作らないよう、ビットマップの範囲に収める
+    return min(max(value[0], -1), limit)
+
+
+def page_ids(bitmap, after=None, before=None, per_page=20):
+    # IDの降順でキーセットページングする(pagination.paginate()と同じカーソル形式)
+    after = _cursor_id(after, bitmap.bit_length())
+    before = _cursor_id(before, bitmap.bit_length()) if after is None else None
+    if before is not None:
+        ids = _take_ascending(bitmap >> (before + 1) << (before + 1), per_page + 1)
+        has_more = len(ids) > per_page
+        ids = ids[:per_page][::-1]
+    else:
+        if after is not None:
+            bitmap &= (1 << max(after, 0)) - 1
+        ids = _take_descending(bitmap, per_page + 1)
+        has_more = len(ids) > per_page
+        ids = ids[:per_page]
+
+    next_cursor = prev_cursor = None
+    if ids:
+        if before is not None or has_more:
+            next_cursor = encode_cursor([ids[-1]])
+        if after is not None or (before is not None and has_more):
+            prev_cursor = encode_cursor([ids[0]])
+    return Page(ids, next_cursor, prev_cursor)
+
+
+def get_tag_index():
+    return current_app.extensions['tag_index']
+
+
+def init_app(app):
+    app.extensions['tag_index'] = TagIndex()
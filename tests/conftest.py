@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from migrations import migrate_app  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = create_app({
+        'TESTING': True,
+        'WTF_CSRF_ENABLED': False,
+        'DATABASE': str(tmp_path / 'eportfolio.db'),
+        'ATTACHMENTS_FOLDER': str(tmp_path / 'attachments'),
+        'ARCHIVE_FOLDER': str(tmp_path / 'archive'),
+        # ジョブはワーカーを使わずにその場で実行する
+        'JOBS_EAGER': True,
+    })
+    migrate_app(app)
+    return app
+
+
+def login(app, username, role):
+    client = app.test_client()
+    client.post('/register', data={'username': username, 'password': 'pw', 'role': role})
+    client.post('/login', data={'username': username, 'password': 'pw'})
+    return client
@@ -0,0 +1,120 @@
+import io
+import os
+
+import pytest
+
+import archive
+import db
+from conftest import login
+
+
+def setup_cohorts(app):
+    # 2020年卒の s1・s3 と在校生の s2。s1 と s2 は同じ内容のファイルを添付する(実体は共有)
+    teacher = login(app, 't1', 'teacher')
+    teacher.post('/tags', data={'tag_name': '探究'})
+    students = [login(app, name, 'student') for name in ('s1', 's2', 's3')]
+    for number, student in enumerate(students, 1):
+        student.post('/portfolio', data={'title': f'卒業研究{number}', 'content': f'地域の水質を調べました{number}'})
+        if number < 3:
+            student.post(f'/portfolio/{number}/attachments',
+                         data={'file': (io.BytesIO(b'measurements'), 'data.csv')})
+        teacher.post(f'/portfolio/{number}', data={'comment': f'よくできました{number}', 'rating': '4'})
+    students[0].post('/portfolio/1/tags', data={'tag_ids': ['1']})
+    with db.connect(app.config['DATABASE']) as conn:
+        conn.execute("UPDATE user SET graduation_year = '2020' WHERE username IN ('s1', 's3')")
+        conn.execute("UPDATE user SET graduation_year = '2030' WHERE username = 's2'")
+    os.makedirs(archive.folder(app))
+    return teacher
+
+
+def counts(conn, user_id, portfolio_id):
+    return {
+        'user': conn.execute('SELECT count(*) FROM user WHERE id = ?', (user_id,)).fetchone()[0],
+        'portfolio': conn.execute('SELECT count(*) FROM portfolio WHERE id = ?', (portfolio_id,)).fetchone()[0],
+        'body': conn.execute('SELECT count(*) FROM portfolio_body WHERE portfolio_id = ?', (portfolio_id,)).fetchone()[0],
+        'comments': conn.execute('SELECT count(*) FROM comments WHERE portfolio_id = ?', (portfolio_id,)).fetchone()[0],
+        'tags': conn.execute('SELECT count(*) FROM portfolio_tags WHERE portfolio_id = ?', (portfolio_id,)).fetchone()[0],
+        'attachments': conn.execute('SELECT count(*) FROM attachments WHERE portfolio_id = ?',
+                                    (portfolio_id,)).fetchone()[0],
+        'events': conn.execute('SELECT count(*) FROM events WHERE user_id = ?', (user_id,)).fetchone()[0],
+        'stats': conn.execute('SELECT count(*) FROM student_stats WHERE user_id = ?', (user_id,)).fetchone()[0],
+        'portfolio_fts': conn.execute('SELECT count(*) FROM portfolio_fts WHERE rowid = ?',
+                                      (portfolio_id,)).fetchone()[0],
+        'user_fts': conn.execute('SELECT count(*) FROM user_fts WHERE rowid = ?', (user_id,)).fetchone()[0],
+    }
+
+
+def test_archived_cohort_leaves_main_and_stays_readable(app):
+    teacher = setup_cohorts(app)
+    path = archive.archive_path(app, 2020)
+    with app.app_context():
+        conn = db.open_connection(app)
+        conn.row_factory = None
+        # 1人ずつのトランザクションで移す
+        assert archive.archive_cohort(conn, path, 2020, batch_size=1) == {'students': 2, 'portfolios': 2}
+        assert 'archive' not in [row[1] for row in conn.execute('PRAGMA database_list')]
+
+        for user_id, portfolio_id in ((2, 1), (4, 3)):
+            assert set(counts(conn, user_id, portfolio_id).values()) == {0}
+        # 在校生の分はそのまま。共有している添付の実体はアーカイブからも配信するので参照が残る
+        assert counts(conn, 3, 2) == {'user': 1, 'portfolio': 1, 'body': 1, 'comments': 1, 'tags': 0, 'attachments': 1,
+                                      'events': 3, 'stats': 1, 'portfolio_fts': 1, 'user_fts': 1}
+        assert conn.execute('SELECT portfolio_count, comment_count FROM student_stats WHERE user_id = 3').fetchone() \
+            == (1, 1)
+        assert conn.execute('SELECT refcount FROM blobs').fetchall() == [(2,)]
+        for table in ('portfolio_fts', 'user_fts'):
+            conn.execute(f"INSERT INTO {table} ({table}) VALUES ('integrity-check')")
+        conn.close()
+
+    page = teacher.get('/archive/2020').get_data(as_text=True)
+    assert 's1' in page and 's3' in page and 's2' not in page
+    assert '卒業研究1' in teacher.get('/archive/2020/students/2').get_data(as_text=True)
+    page = teacher.get('/archive/2020/portfolio/1').get_data(as_text=True)
+    for text in ('卒業研究1', '地域の水質を調べました1', 'よくできました1', 't1', '探究', 'data.csv'):
+        assert text in page
+    attachment_id = int(page.split('/archive/2020/attachments/')[1].split('"')[0])
+    response = teacher.get(f'/archive/2020/attachments/{attachment_id}')
+    assert response.status_code == 200 and response.get_data() == b'measurements'
+    response.close()
+    assert teacher.get('/archive/2020/portfolio/2').status_code == 404
+
+
+def test_failed_batch_rolls_back(app, monkeypatch):
+    setup_cohorts(app)
+    path = archive.archive_path(app, 2020)
+
+    def fail_on_second_student(user_id):
+        if user_id == 4:
+            raise ValueError('disk full')
+        return user_id
+
+    # コメントを消したあとで失敗させる
+    move = list(archive.MOVE)
+    move.insert(move.index('DELETE FROM main.comments WHERE portfolio_id IN (SELECT id FROM temp.archiving_portfolios)')
+                + 1, 'SELECT fail_on_second_student(id) FROM temp.archiving_users')
+    monkeypatch.setattr(archive, 'MOVE', move)
+    with app.app_context():
+        conn = db.open_connection(app)
+        conn.row_factory = None
+        conn.create_function('fail_on_second_student', 1, fail_on_second_student)
+        with pytest.raises(Exception):
+            archive.archive_cohort(conn, path, 2020, batch_size=1)
+        assert not conn.in_transaction
+        assert 'archive' not in [row[1] for row in conn.execute('PRAGMA database_list')]
+
+        # 先のバッチ(s1)は移ったまま、失敗したバッチ(s3)は何も消えていない
+        assert set(counts(conn, 2, 1).values()) == {0}
+        after = counts(conn, 4, 3)
+        assert after.pop('events') > 0 and after.pop('attachments') == 0 and after.pop('tags') == 0
+        assert set(after.values()) == {1}
+        assert conn.execute('SELECT refcount FROM blobs').fetchall() == [(2,)]
+        conn.execute('ATTACH DATABASE ? AS archive', (path,))
+        assert conn.execute('SELECT id FROM archive.user').fetchall() == [(2,)]
+        assert conn.execute('SELECT portfolio_id FROM archive.comments').fetchall() == [(1,)]
+        conn.execute('DETACH DATABASE archive')
+
+        # やり直せば残りも移る
+        monkeypatch.setattr(archive, 'MOVE', [statement for statement in move if 'fail_on' not in statement])
+        assert archive.archive_cohort(conn, path, 2020, batch_size=1) == {'students': 1, 'portfolios': 1}
+        assert set(counts(conn, 4, 3).values()) == {0}
+        conn.close()
@@ -0,0 +1,19 @@
+import io
+import os
+import sqlite3
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+import attachments
+from db import get_db_connection
+
+
+def test_failed_store_leaves_no_blob_behind(app):
+    with app.test_request_context():
+        upload = FileStorage(io.BytesIO(b'report'), filename='report.txt')
+        # 行の追加が失敗したとき(ここでは portfolio_id がない)、置いた実体も消える
+        with pytest.raises(sqlite3.IntegrityError):
+            attachments.store(get_db_connection(), None, upload)
+    blobs = os.path.join(app.config['ATTACHMENTS_FOLDER'], 'blobs')
+    assert not os.path.exists(blobs) or not any(files for _, _, files in os.walk(blobs))
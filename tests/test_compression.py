@@ -0,0 +1,21 @@
+from conftest import login
+
+
+def test_compressed_responses_get_their_own_etag(app):
+    student = login(app, 's1', 'student')
+    student.post('/portfolio', data={'title': 'テーマ', 'content': '本文です。' * 200})
+    student.get('/portfolio/1')  # 作成のフラッシュメッセージを出しておく(出ているページはキャッシュしない)
+
+    for url in ('/portfolio/1', '/api/v1/portfolios/1'):
+        plain = student.get(url, headers={'Accept-Encoding': 'identity'})
+        compressed = student.get(url, headers={'Accept-Encoding': 'gzip'})
+        assert compressed.headers['Content-Encoding'] == 'gzip'
+        # 圧縮前と圧縮後で別のバイト列なので、同じ強いETagを付けない
+        assert compressed.headers['ETag'] == plain.headers['ETag'][:-1] + '-gzip"'
+
+        # どちらのETagで聞かれても変わっていなければ304で、持っている方のETagを返す
+        for response in (plain, compressed):
+            again = student.get(url, headers={'Accept-Encoding': response.headers.get('Content-Encoding', 'identity'),
+                                              'If-None-Match': response.headers['ETag']})
+            assert again.status_code == 304
+            assert again.headers['ETag'] == response.headers['ETag']
@@ -0,0 +1,18 @@
+import db
+from conftest import login
+from forms import PORTFOLIO_CONTENT_MAX
+
+
+def test_signature_is_stored_and_long_bodies_are_rejected(app):
+    student = login(app, 's1', 'student')
+    student.post('/portfolio', data={'title': 'テーマ', 'content': '研究の内容をまとめました。' * 10})
+    too_long = 'あ' * (PORTFOLIO_CONTENT_MAX + 1)
+    student.post('/portfolio', data={'title': '長すぎる', 'content': too_long})
+    student.post('/portfolio/1/edit', data={'title': 'テーマ', 'content': too_long})
+
+    with db.connect(app.config['DATABASE']) as conn:
+        conn.row_factory = None
+        assert conn.execute('SELECT id, title FROM portfolio').fetchall() == [(1, 'テーマ')]
+        # 上限を超えた編集は保存しない
+        assert conn.execute('SELECT length(body_text(body)) FROM portfolio_body').fetchone()[0] == 130
+        assert conn.execute('SELECT portfolio_id FROM portfolio_minhash').fetchall() == [(1,)]
@@ -0,0 +1,24 @@
+import sqlite3
+
+from conftest import login
+
+
+def events(app):
+    with sqlite3.connect(app.config['DATABASE']) as conn:
+        return conn.execute('SELECT kind, portfolio_id FROM events ORDER BY id').fetchall()
+
+
+def test_every_tag_change_is_recorded_once(app):
+    teacher = login(app, 't1', 'teacher')
+    for name in ('Python', 'Research', 'Art'):
+        teacher.post('/tags', data={'tag_name': name})
+    student = login(app, 's1', 'student')
+    student.post('/portfolio', data={'title': 'テーマ', 'content': '本文'})
+
+    # 作成直後の変更も、続けて行った変更も、それぞれ1件ずつ(何本のタグを変えても1件)
+    for tag_ids in (['1', '2'], ['3'], ['1', '3']):
+        student.post('/portfolio/1/tags', data={'tag_ids': tag_ids})
+    # 変わらない選び直しは記録しない
+    student.post('/portfolio/1/tags', data={'tag_ids': ['1', '3']})
+
+    assert events(app) == [('portfolio_created', 1)] + [('tags_changed', 1)] * 3
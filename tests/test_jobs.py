@@ -0,0 +1,99 @@
+import json
+import time
+
+import pytest
+
+import db
+import jobs
+
+calls = []
+
+
+@jobs.job('test_record', max_attempts=2)
+def record_job(payload):
+    if payload.get('fail'):
+        raise RuntimeError('boom')
+    calls.append(payload)
+
+
+@pytest.fixture
+def queue(app):
+    app.config['JOBS_EAGER'] = False
+    calls.clear()
+    with app.app_context():
+        conn = db.open_connection(app)
+        conn.isolation_level = None
+        yield conn
+        conn.close()
+
+
+def rows(conn):
+    return [tuple(row) for row in conn.execute('SELECT id, status, attempts, payload, priority FROM jobs ORDER BY id')]
+
+
+def test_enqueue_claim_complete(app, queue):
+    job_id = jobs.enqueue(queue, 'test_record', {'n': 1})
+    assert jobs.enqueue(queue, 'test_record', {'n': 2}, delay=3600) == job_id + 1
+    row = jobs.claim(queue, 'w1', 60)
+    assert (row['id'], row['kind'], json.loads(row['payload']), row['attempts']) == (job_id, 'test_record', {'n': 1}, 1)
+    assert jobs.claim(queue, 'w2', 60) is None  # もう一つはまだ実行の時刻になっていない
+    jobs.complete(queue, job_id, 'w1')
+    assert [row[0] for row in rows(queue)] == [job_id + 1]
+
+    queue.execute('UPDATE jobs SET run_at = 0')
+    assert jobs.work(app, concurrency=1, burst=True) == {'succeeded': 1, 'retried': 0, 'failed': 0}
+    assert calls == [{'n': 2}] and rows(queue) == []
+
+
+def test_failed_jobs_back_off_then_give_up(queue):
+    job_id = jobs.enqueue(queue, 'test_record', {'fail': True})
+    row = jobs.claim(queue, 'w1', 60)
+    started = time.time()
+    assert jobs.fail(queue, job_id, 'w1', row['attempts'], row['max_attempts'], 'boom', 10, 3600)
+    run_at, last_error = queue.execute('SELECT run_at, last_error FROM jobs').fetchone()
+    assert started + 8 <= run_at <= started + 12.5 and last_error == 'boom'
+    assert jobs.claim(queue, 'w1', 60) is None
+
+    queue.execute('UPDATE jobs SET run_at = 0')
+    row = jobs.claim(queue, 'w1', 60)
+    assert not jobs.fail(queue, job_id, 'w1', row['attempts'], row['max_attempts'], 'boom', 10, 3600)
+    assert rows(queue)[0][1:3] == ('failed', 2)
+
+
+def test_expired_lease_is_reclaimed(queue):
+    job_id = jobs.enqueue(queue, 'test_record')
+    jobs.claim(queue, 'dead', -1)
+    assert jobs.reclaim(queue) == 1
+    row = jobs.claim(queue, 'w2', 60)
+    assert (row['id'], row['attempts']) == (job_id, 2)
+    # 期限切れのあとに戻ってきた元のワーカーは、結果を書き込めない
+    jobs.complete(queue, job_id, 'dead')
+    assert rows(queue)[0][1] == 'running'
+    jobs.complete(queue, job_id, 'w2')
+    assert rows(queue) == []
+
+
+def test_dedupe_key_replaces_queued_payload(queue):
+    first = jobs.enqueue(queue, 'test_record', {'n': 1}, dedupe_key='same')
+    assert jobs.enqueue(queue, 'test_record', {'n': 2}, priority=5, dedupe_key='same') == first
+    assert rows(queue) == [(first, 'queued', 0, '{"n": 2}', 5)]
+    # 取り出したあとは別のジョブとして追加される
+    jobs.claim(queue, 'w1', 60)
+    assert jobs.enqueue(queue, 'test_record', {'n': 3}, dedupe_key='same') != first
+
+
+def test_eager_jobs_run_after_commit(app):
+    calls.clear()
+    with app.app_context():
+        conn = db.get_db_connection()
+        jobs.enqueue(conn, 'test_record', {'n': 1}, delay=3600)
+        conn.commit()
+        assert calls == []  # 呼び出し側のトランザクションの中では実行しない
+    assert calls == [{'n': 1}]
+    with app.app_context():
+        conn = db.get_db_connection()
+        jobs.enqueue(conn, 'test_record', {'n': 2})
+        conn.rollback()
+    assert calls == [{'n': 1}]
+    with db.connect(app.config['DATABASE']) as conn:
+        assert conn.execute('SELECT count(*) FROM jobs').fetchone()[0] == 0
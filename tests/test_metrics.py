@@ -0,0 +1,55 @@
+import sqlite3
+
+import db
+from conftest import login
+from warmup import warmup
+
+
+def test_only_observed_connections_pay_for_timing(tmp_path):
+    conn = db.connect(str(tmp_path / 'timing.db'))
+    # 計測しない接続は標準のカーソル(行の読み出しもCの実装のまま)
+    assert type(conn.execute('SELECT 1')) is sqlite3.Cursor
+    calls = []
+    conn.observer = lambda conn, sql, parameters, seconds: calls.append(sql)
+    conn.execute('CREATE TABLE t (x)')
+    conn.executemany('INSERT INTO t VALUES (?)', [(1,), (2,)])
+    cursor = conn.execute('SELECT x FROM t')
+    assert isinstance(cursor, db.Cursor) and len(cursor.fetchall()) == 2
+    assert calls == ['CREATE TABLE t (x)', 'INSERT INTO t VALUES (?)', 'SELECT x FROM t']
+
+
+def test_timing_hook_is_opt_in(app):
+    # 既定ではサンプルしないリクエストの接続に実行時間のフックを付けない
+    with app.test_request_context():
+        assert db.get_db_connection(readonly=True).observer is None
+    app.extensions['metrics'].slow_query_seconds = 0.1
+    with app.test_request_context():
+        assert db.get_db_connection(readonly=True).observer is not None
+
+
+def test_metrics_needs_token_behind_a_proxy(app):
+    client = app.test_client()
+    assert client.get('/metrics').status_code == 403
+    app.debug = True
+    assert client.get('/metrics').status_code == 200
+    assert client.get('/metrics', headers={'X-Forwarded-For': '203.0.113.5'}).status_code == 403
+    app.config['METRICS_TOKEN'] = 'secret'
+    assert client.get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code == 200
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 403
+
+
+def test_warmup_is_not_counted(app):
+    login(app, 's1', 'student').post('/portfolio', data={'title': 'テーマ', 'content': '本文'})
+    login(app, 't1', 'teacher')
+    hooks = list(app.extensions.get('db_timing_hooks', []))
+    app.config['METRICS_TOKEN'] = 'secret'
+    client = app.test_client()
+    before = client.get('/metrics', headers={'Authorization': 'Bearer secret'}).get_data(as_text=True)
+
+    assert warmup(app)['pages'] > 10
+    # 準備するSQLを集めるためのフックは外れ、開いたページはリクエストの数に入らない
+    assert app.extensions.get('db_timing_hooks', []) == hooks
+    after = client.get('/metrics', headers={'Authorization': 'Bearer secret'}).get_data(as_text=True)
+    counts = [[line for line in text.splitlines() if line.startswith('http_requests_total{')
+               and 'endpoint="metrics' not in line] for text in (before, after)]
+    assert counts[0] and counts[0] == counts[1]
@@ -0,0 +1,47 @@
+import threading
+
+import pytest
+
+from passwords import HashingBusy, PasswordHasher
+
+
+def test_timeout_is_reported_as_busy():
+    hasher = PasswordHasher('pbkdf2:sha256:1000', workers=1, max_pending=1, timeout=0.01)
+    started, release = threading.Event(), threading.Event()
+
+    def slow(password):
+        started.set()
+        release.wait()
+        return password
+
+    try:
+        with pytest.raises(HashingBusy):
+            hasher._run('hash', slow, 'pw')
+        assert started.wait(1)
+        # 待ち行列で時間切れになったものは取り消され、枠も返る
+        with pytest.raises(HashingBusy):
+            hasher._run('hash', slow, 'pw')
+        release.set()
+        assert hasher.verify(hasher.hash('pw'), 'pw')
+    finally:
+        release.set()
+        hasher.shutdown()
+
+
+def test_unknown_users_are_hashed_too():
+    hasher = PasswordHasher('pbkdf2:sha256:1000', workers=1, max_pending=0, timeout=1)
+    operations = []
+    hasher.observer = lambda operation, seconds: operations.append(operation)
+    try:
+        # 空のパスワードでも通らない。照合はした(応答時間は同じ)
+        assert hasher.verify(None, '') is False
+        assert operations == ['verify']
+        # 混んでいるときは(枠が埋まっている)、存在しないユーザーでも同じように HashingBusy になる
+        hasher._slots.acquire()
+        try:
+            with pytest.raises(HashingBusy):
+                hasher.verify(None, 'pw')
+        finally:
+            hasher._slots.release()
+    finally:
+        hasher.shutdown()
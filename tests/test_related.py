@@ -0,0 +1,28 @@
+import related
+from conftest import login
+
+TEXT = '機械学習を使って画像認識の研究をしました。データを集めてモデルを学習させ、精度を評価しました。'
+
+
+def test_related_portfolios_follow_edits_without_rebuilding(app):
+    first = login(app, 's1', 'student')
+    second = login(app, 's2', 'student')
+    first.post('/portfolio', data={'title': '画像認識の研究', 'content': TEXT})
+    second.post('/portfolio', data={'title': '料理', 'content': 'カレーを作りました。玉ねぎを炒めるのに時間がかかりました。'})
+    second.post('/portfolio', data={'title': '機械学習', 'content': TEXT + '次は音声認識もやりたいです。'})
+
+    page = first.get('/portfolio/1').get_data(as_text=True)
+    assert '関連するポートフォリオ' in page and '機械学習' in page and '料理' not in page
+    model = related._get_state(app).model
+    # 件数が少ないうちは毎回作り直すので、ここからは作り直さないようにする
+    app.config['RELATED_REFIT'] = 100
+
+    # 一覧に出ているポートフォリオの題名を変えると、それを出しているページのキャッシュも作り直される
+    second.post('/portfolio/3/edit', data={'title': '深層学習', 'content': TEXT + '次は音声認識もやりたいです。'})
+    page = first.get('/portfolio/1').get_data(as_text=True)
+    assert '深層学習' in page and '>機械学習<' not in page
+    # 変わった分だけを手元のモデルに反映する(全件から作り直さない)
+    assert related._get_state(app).model is model and model.changes == 1
+
+    second.get('/portfolio/3/delete')
+    assert '関連するポートフォリオ' not in first.get('/portfolio/1').get_data(as_text=True)
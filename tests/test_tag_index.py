@@ -0,0 +1,96 @@
+import pytest
+
+import db
+from conftest import login
+from pagination import decode_cursor
+from tag_index import TagQueryError, _bitmap, _Parser, get_tag_index, page_ids
+
+TAGS = {1: _bitmap([1, 2]), 2: _bitmap([2, 3]), 3: _bitmap([4]), 4: _bitmap([5])}
+NAMES = {'Python': 1, 'Research': 2, 'Art': 3, 'Data Science': 4}
+EVERYTHING = _bitmap([1, 2, 3, 4, 5, 6])
+
+
+def query(expression):
+    bitmap = _Parser(expression, NAMES, TAGS, EVERYTHING).parse()
+    return sorted(i for i in range(bitmap.bit_length()) if bitmap >> i & 1)
+
+
+def test_operator_precedence():
+    # NOT > AND(省略も含む) > OR
+    assert query('Python OR Research AND Art') == [1, 2]
+    assert query('(Python OR Research) AND Art') == []
+    assert query('Python Research') == query('Python AND Research') == [2]
+    assert query('NOT Python AND Research') == [3]
+    assert query('NOT (Python OR Research) OR Art') == [4, 5, 6]
+    assert query('python or "data science"') == [1, 2, 5]
+
+
+def test_not_is_taken_over_every_portfolio():
+    # タグのないポートフォリオ(6)も NOT の結果に入る
+    assert query('NOT Python') == [3, 4, 5, 6]
+    assert query('NOT NOT Python') == [1, 2]
+
+
+@pytest.mark.parametrize('expression', ['', '   ', 'Python AND', 'OR Python', '(Python', 'Python)', '()',
+                                        '"Python', 'NOT', 'Unknown', 'Python OR OR Art'])
+def test_malformed_queries(expression):
+    with pytest.raises(TagQueryError):
+        query(expression)
+
+
+def test_paging_is_stable_across_a_tag_change():
+    bitmap = _bitmap(range(1, 11))
+    first = page_ids(bitmap, per_page=4)
+    assert first.items == [10, 9, 8, 7] and first.prev_cursor is None
+    # 1ページ目を見ている間に、新しいポートフォリオ(11)にタグが付き、1ページ目の9と次のページの6から外れた
+    bitmap = (bitmap | 1 << 11) & ~(1 << 9) & ~(1 << 6)
+    second = page_ids(bitmap, after=first.next_cursor, per_page=4)
+    assert second.items == [5, 4, 3, 2]
+    assert decode_cursor(second.prev_cursor, 1) == [5]
+    # 戻ると、カーソルより新しいものが新しい内容で出る
+    assert page_ids(bitmap, before=second.prev_cursor, per_page=4).items == [11, 10, 8, 7]
+    last = page_ids(bitmap, after=second.next_cursor, per_page=4)
+    assert last.items == [1] and last.next_cursor is None
+
+
+def portfolios_with_tags(app):
+    teacher = login(app, 't1', 'teacher')
+    for name in ('Python', 'Research'):
+        teacher.post('/tags', data={'tag_name': name})
+    student = login(app, 's1', 'student')
+    for title in ('一つ目', '二つ目'):
+        student.post('/portfolio', data={'title': title, 'content': '本文'})
+
+
+def test_matching_generation_applies_the_delta(app, monkeypatch):
+    portfolios_with_tags(app)
+    index = app.extensions['tag_index']
+    with app.app_context():
+        conn = db.open_connection(app)
+        index.snapshot(conn)
+        monkeypatch.setattr(index, '_load', lambda conn: pytest.fail('should not reload'))
+        conn.execute('INSERT INTO portfolio_tags (portfolio_id, tag_id) VALUES (1, 2)')
+        get_tag_index().record(conn, 1, added=[2])
+        conn.commit()
+        tags, _ = index.snapshot(conn)
+        assert tags[2] == 1 << 1
+        conn.close()
+
+
+def test_stale_generation_forces_a_reload(app):
+    portfolios_with_tags(app)
+    index = app.extensions['tag_index']
+    with app.app_context():
+        conn = db.open_connection(app)
+        index.snapshot(conn)
+        # 別のワーカープロセスが書き込んだ(このプロセスのインデックスには差分が届かない)
+        with db.connect(app.config['DATABASE']) as other:
+            other.execute('INSERT INTO portfolio_tags (portfolio_id, tag_id) VALUES (2, 1)')
+        conn.execute('INSERT INTO portfolio_tags (portfolio_id, tag_id) VALUES (1, 2)')
+        index.record(conn, 1, added=[2])
+        conn.commit()
+        # 差分だけを足すと他のプロセスの変更が抜けるので、反映せずに次の検索で読み直す
+        assert index._generation is None
+        tags, _ = index.snapshot(conn)
+        assert tags == {1: 1 << 2, 2: 1 << 1}
+        conn.close()
@@ -0,0 +1,627 @@
+from flask import Blueprint, Response, abort, current_app, render_template, redirect, url_for, session, request, flash
+from flask_wtf import FlaskForm
+from forms import (RegistrationForm, LoginForm, PortfolioForm, ProfileEditForm, SearchForm, CommentForm, AttachmentForm,
+                   PORTFOLIO_CONTENT_MAX)
+from archive import attached, years as archive_years
+from attachments import send_attachment, store
+import repository
+from db import get_db_connection
+import duplicates
+from exporter import FORMATS, KINDS, content_type, stream_export
+from jobs import enqueue, job
+from passwords import HashingBusy, get_password_hasher
+import related
+from render_cache import cached_page
+from search import search
+from tag_catalog import get_tag_catalog, tags_for_portfolio
+from tag_index import TagQueryError, get_tag_index, page_ids
+import sqlite3
+
+main = Blueprint('main', __name__)
+
+@main.app_template_filter('stars') # 数値の評価(1〜5)を星で表示する
+def stars(rating):
+    if rating is None:
+        return ''
+    return '★' * rating + '☆' * (5 - rating)
+
+@main.route('/')
+def index():
+    return render_template('index.html')
+
+def busy_response(template, form):
+    # ハッシュ計算の順番待ちが上限を超えたときは、待たせずに503を返す
+    flash('Server is busy. Please try again in a moment.', 'danger')
+    return render_template(template, form=form), 503, {'Retry-After': '5'}
+
+def upgrade_password_hash(hasher, user, password):
+    # 古いアルゴリズム・コストのハッシュを、ログインに成功したときに設定どおりのものへ置き換える
+    try:
+        new_hash = hasher.hash(password)
+    except HashingBusy:
+        return  # 混んでいるときは次回のログインに回す
+    conn = get_db_connection()
+    repository.update_password(conn, user.id, new_hash, user.password)
+    conn.commit()
+
+@main.route('/register', methods=['GET', 'POST']) # ユーザー登録
+def register():
+    form = RegistrationForm()
+    if form.validate_on_submit():
+        username = form.username.data
+        password = form.password.data
+        role = form.role.data
+        try:
+            hash_password = get_password_hasher().hash(password)
+        except HashingBusy:
+            return busy_response('register.html', form)
+
+        conn = get_db_connection()
+        repository.create_user(conn, username, hash_password, role)
+        conn.commit()
+
+        flash('Registration successful!', 'success')
+        return redirect(url_for('main.login'))
+    return render_template('register.html', form=form)
+
+@main.route('/login', methods=['GET', 'POST']) # ログイン
+def login():
+    form = LoginForm()
+    if form.validate_on_submit():
+        username = form.username.data
+        password = form.password.data
+
+        conn = get_db_connection(readonly=True)
+        user = repository.user_by_username(conn, username)
+
+        hasher = get_password_hasher()
+        try:
+            valid = hasher.verify(user.password if user is not None else None, password)
+        except HashingBusy:
+            return busy_response('login.html', form)
+
+        if valid:
+            if hasher.needs_rehash(user.password):
+                upgrade_password_hash(hasher, user, password)
+            session['user_id'] = user.id
+            session['role'] = user.role
+            flash('Login successful!', 'success')
+
+            if user.role == 'teacher':
+                return redirect(url_for('main.teacher_dashboard'))
+            else:
+                return redirect(url_for('main.index'))
+        else:
+            flash('Login failed. Check your username and/or password.', 'danger')
+
+    return render_template('login.html', form=form)
+
+@main.route('/logout') # ログアウト
+def logout():
+    session.clear()
+    flash('You have been logged out.', 'info')
+    return redirect(url_for('main.index'))
+
+
+@main.route('/portfolio', methods=['GET', 'POST'])
+def portfolio():
+    if 'user_id' not in session:
+        flash('You need to be logged in to view this page.', 'danger')
+        return redirect(url_for('main.login'))
+
+    conn = get_db_connection(readonly=request.method == 'GET')
+
+    # フォームにタグの選択肢を追加
+    form = PortfolioForm()
+    form.tags.choices = get_tag_catalog().choices(conn)
+
+    if form.validate_on_submit():
+        title = form.title.data
+        content = form.content.data
+        # 重複チェックの署名は書き込みロックを取る前に計算しておく
+        signature = duplicates.compute(content)
+
+        # ポートフォリオの作成と、選択されたタグの保存
+        portfolio_id = repository.create_portfolio(conn, session['user_id'], title, content, form.tags.data)
+        get_tag_index().record(conn, portfolio_id, added=form.tags.data, created=True)
+        duplicates.record(conn, portfolio_id, signature)
+        conn.commit()
+        related.schedule(conn)
+
+        flash('Portfolio entry added!', 'success')
+        return redirect(url_for('main.portfolio'))
+
+    page = repository.portfolio_page(conn, session['user_id'])
+
+    return render_template('portfolio.html', form=form, portfolios=page.items, page=page)
+
+@main.route('/profile') # プロフィール
+def profile():
+    if 'user_id' not in session:
+        flash('You need to be logged in to view this page.', 'danger')
+        return redirect(url_for('main.login'))
+
+    conn = get_db_connection(readonly=True)
+    user = repository.profile(conn, session['user_id'])
+
+    if user:
+        return render_template('profile.html', user=user)
+    else:
+        flash('User not found.', 'danger')
+        return redirect(url_for('main.index'))
+
+@main.route('/edit_profile', methods=['GET', 'POST']) # プロフィール編集
+def edit_profile():
+    if 'user_id' not in session:
+        flash('You need to be logged in to view this page.', 'danger')
+        return redirect(url_for('main.login'))
+
+    conn = get_db_connection(readonly=request.method == 'GET')
+    user = repository.profile(conn, session['user_id'])
+
+    form = ProfileEditForm()
+
+    if request.method == 'POST' and form.validate_on_submit():
+        student_number = form.student_number.data
+        name = form.name.data
+        grade = form.grade.data
+        graduation_year = form.graduation_year.data
+        bio = form.bio.data
+
+        repository.update_profile(conn, session['user_id'], student_number, name, grade, graduation_year, bio)
+        conn.commit()
+
+        flash('Profile updated successfully', 'success')
+        return redirect(url_for('main.profile'))
+
+    if user:
+        form.student_number.data = user.student_number
+        form.name.data = user.name
+        form.grade.data = user.grade
+        form.graduation_year.data = user.graduation_year
+        form.bio.data = user.bio
+        return render_template('edit_profile.html', form=form, user=user)
+    else:
+        flash('User not found.', 'danger')
+        return redirect(url_for('main.profile'))
+    
+@main.route('/teacher_dashboard') # 教師ダッシュボード
+def teacher_dashboard():
+    if 'user_id' not in session or session.get('role') != 'teacher':
+        flash('You need to be logged in as a teacher to view this page.', 'danger')
+        return redirect(url_for('main.login'))
+
+    conn = get_db_connection(readonly=True)
+    # 検索結果のページ送りをリンクでできるように、検索フォームはGETで受け取る
+    form = SearchForm(request.args, meta={'csrf': False})
+    form.tags.choices = get_tag_catalog().choices(conn)
+    results = None
+
+    if form.search_query.data and form.validate():
+        page = request.args.get('page', 1, type=int)
+        results = search(conn, form.search_query.data, form.tags.data or (), page=max(page, 1))
+
+    return render_template('teacher_dashboard.html', form=form, results=results)
+
+
+@main.route('/students_list') # 生徒一覧
+def students_list():
+    if 'user_id' not in session or session.get('role') != 'teacher':
+        flash('You need to be logged in as a teacher to view this page.', 'danger')
+        return redirect(url_for('main.login'))
+
+    conn = get_db_connection(readonly=True)
+    sort = request.args.get('sort')
+    if sort not in repository.STUDENT_SORTS:
+        sort = 'activity'
+    order = 'asc' if request.args.get('order') == 'asc' else 'desc'
+    year = request.args.get('year') or None
+    page = repository.student_page(conn, sort, year, descending=order == 'desc')
+    years = repository.graduation_years(conn)
+
+    return render_template('students_list.html', students=page.items, page=page,
+                           sort=sort, order=order, year=year, years=years)
+
+@main.route('/view_portfolio/<int:student_id>') # ポートフォリオ一覧
+def view_portfolio(student_id):
+    if 'user_id' not in session or session.get('role') != 'teacher':
+        flash('You need to be logged in as a teacher to view this page.', 'danger')
+        return redirect(url_for('main.login'))
+
+    conn = get_db_connection(readonly=True)
+    student = repository.student(conn, student_id)
+
+    if not student:
+        flash('Student not found.', 'danger')
+        return redirect(url_for('main.teacher_dashboard'))
+
+    page = repository.portfolio_page(conn, student_id)
+
+    return render_template('view_portfolio.html', student=student, portfolios=page.items, page=page)
+
+def render_portfolio_detail(conn, portfolio_row, form):
+    if session.get('role') == 'teacher':
+        template = 'teacher_portfolio_detail.html'
+    else:
+        template = 'portfolio_detail.html'
+    portfolio_id = portfolio_row.id
+
+    def render():
+        return render_template(template, portfolio=repository.portfolio(conn, portfolio_id),
+                               comments=repository.comments(conn, portfolio_id),
+                               tags=tags_for_portfolio(conn, portfolio_id), form=form,
+                               attachments=repository.attachments(conn, portfolio_id),
+                               related=repository.related_portfolios(conn, portfolio_id),
+                               attachment_form=AttachmentForm())
+
+    if request.method != 'GET' or session.get('_flashes'):
+        return render()
+
+    # 編集・コメント・タグ変更でversionが進むので、同じversionの間は描画結果を使い回せる
+    is_owner = session['user_id'] == portfolio_row.user_id
+    return cached_page(('portfolio', portfolio_id, portfolio_row.version, template, is_owner), render)
+
+@main.route('/portfolio/<int:portfolio_id>', methods=['GET', 'POST']) # ポートフォリオ詳細
+def show_portfolio_with_comment(portfolio_id):
+    if 'user_id' not in session:
+        flash('You need to be logged in to view this page.', 'danger')
+        return redirect(url_for('main.login'))
+
+    conn = get_db_connection(readonly=request.method == 'GET')
+    portfolio_row = repository.portfolio_version(conn, portfolio_id)
+    
+    if not portfolio_row:
+        flash('Portfolio not found.', 'danger')
+        return redirect(url_for('main.portfolio'))
+    
+    form = CommentForm()
+    if form.validate_on_submit():
+        comment_text = form.comment.data
+        rating = form.rating.data
+        repository.add_comment(conn, portfolio_id, session['user_id'], comment_text, rating)
+        conn.commit()
+        flash('Comment added!', 'success')
+        return redirect(url_for('main.show_portfolio_with_comment', portfolio_id=portfolio_id))
+
+    return render_portfolio_detail(conn, portfolio_row, form)
+
+@main.route('/portfolio/<int:portfolio_id>/edit', methods=['GET', 'POST']) # ポートフォリオ編集
+def edit_portfolio(portfolio_id):
+    if 'user_id' not in session:
+        flash('You need to be logged in to edit a portfolio.', 'danger')
+        return redirect(url_for('main.login'))
+
+    conn = get_db_connection(readonly=request.method == 'GET')
+    portfolio_row = repository.own_portfolio(conn, portfolio_id, session['user_id'])
+    
+    if not portfolio_row:
+        flash('Portfolio not found or you do not have permission to edit.', 'danger')
+        return redirect(url_for('main.portfolio'))
+
+    if request.method == 'POST':
+        title = request.form['title']
+        content = request.form['content']
+        if len(content) > PORTFOLIO_CONTENT_MAX:
+            flash(f'Content must be at most {PORTFOLIO_CONTENT_MAX} characters.', 'danger')
+            return render_template('edit_portfolio.html', portfolio=portfolio_row)
+        signature = duplicates.compute(content)
+        repository.update_portfolio(conn, portfolio_id, title, content)
+        duplicates.record(conn, portfolio_id, signature)
+        conn.commit()
+        related.schedule(conn)
+        flash('Portfolio has been updated!', 'success')
+        return redirect(url_for('main.show_portfolio_with_comment', portfolio_id=portfolio_id))
+    
+    return render_template('edit_portfolio.html', portfolio=portfolio_row)
+
+@main.route('/portfolio/<int:portfolio_id>/delete') # ポートフォリオ削除
+def delete_portfolio(portfolio_id):
+    if 'user_id' not in session:
+        flash('You need to be logged in to delete a portfolio.', 'danger')
+        return redirect(url_for('main.login'))
+    
+    conn = get_db_connection()
+    if not repository.is_owner(conn, portfolio_id, session['user_id']):
+        flash('Portfolio not found or you do not have permission to delete.', 'danger')
+        return redirect(url_for('main.portfolio'))
+
+    removed = repository.delete_portfolio(conn, portfolio_id)
+    get_tag_index().record(conn, portfolio_id, removed=removed, deleted=True)
+    conn.commit()
+    related.schedule(conn)
+    flash('Portfolio has been deleted!', 'success')
+    return redirect(url_for('main.portfolio'))
+
+@main.route('/portfolio/<int:portfolio_id>/attachments', methods=['POST']) # 添付ファイルの追加(生徒専用)
+def upload_attachment(portfolio_id):
+    if 'user_id' not in session:
+        flash('You need to be logged in to attach files.', 'danger')
+        return redirect(url_for('main.login'))
+
+    conn = get_db_connection()
+    if not repository.is_owner(conn, portfolio_id, session['user_id']):
+        flash('Portfolio not found or you do not have permission to edit.', 'danger')
+        return redirect(url_for('main.portfolio'))
+
+    # ファイルは受け取りながらハッシュを計算して一時ファイルに書かれているので、ここでは名前を変えるだけ
+    form = AttachmentForm()
+    if form.validate_on_submit():
+        store(conn, portfolio_id, form.file.data)
+        flash('File attached!', 'success')
+    else:
+        flash('Please choose a file to attach.', 'danger')
+    return redirect(url_for('main.show_portfolio_with_comment', portfolio_id=portfolio_id))
+
+@main.route('/attachments/<int:attachment_id>/delete', methods=['POST']) # 添付ファイルの削除
+def delete_attachment(attachment_id):
+    if 'user_id' not in session:
+        flash('You need to be logged in to delete a file.', 'danger')
+        return redirect(url_for('main.login'))
+
+    conn = get_db_connection()
+    portfolio_id = repository.own_attachment_portfolio(conn, attachment_id, session['user_id'])
+    if portfolio_id is None or not FlaskForm().validate_on_submit():
+        flash('File not found or you do not have permission to delete.', 'danger')
+        return redirect(url_for('main.portfolio'))
+    repository.delete_attachment(conn, attachment_id)
+    conn.commit()
+    flash('File has been deleted!', 'success')
+    return redirect(url_for('main.show_portfolio_with_comment', portfolio_id=portfolio_id))
+
+def attachment_row(attachment_id):
+    if 'user_id' not in session:
+        abort(403)
+    row = repository.attachment_file(get_db_connection(readonly=True), attachment_id)
+    if row is None:
+        abort(404)
+    return row
+
+@main.route('/attachments/<int:attachment_id>') # 添付ファイルの配信
+def download_attachment(attachment_id):
+    return send_attachment(attachment_row(attachment_id))
+
+@main.route('/attachments/<int:attachment_id>/thumbnail') # 画像の添付ファイルのサムネイル
+def attachment_thumbnail(attachment_id):
+    row = attachment_row(attachment_id)
+    if row.thumbnail != 1:
+        abort(404)
+    return send_attachment(row, thumbnail=True)
+
+# タグを管理するルート（教師専用）
+@main.route('/tags', methods=['GET', 'POST'])
+def manage_tags():
+    if 'user_id' not in session or session.get('role') != 'teacher':
+        flash('You need to be logged in as a teacher to manage tags.', 'danger')
+        return redirect(url_for('main.login'))
+
+    conn = get_db_connection(readonly=request.method == 'GET')
+    
+    if request.method == 'POST':
+        tag_name = request.form['tag_name']
+        try:
+            repository.create_tag(conn, tag_name)
+        except sqlite3.IntegrityError:
+            flash('That tag already exists.', 'danger')
+        else:
+            conn.commit()
+            get_tag_catalog().invalidate()
+            flash('Tag added!', 'success')
+    
+    tags = get_tag_catalog().all(conn)
+
+    return render_template('manage_tags.html', tags=tags)
+
+# ポートフォリオにタグを追加するルート（生徒専用）
+@main.route('/portfolio/<int:portfolio_id>/tags', methods=['GET', 'POST'])
+def add_tags_to_portfolio(portfolio_id):
+    if 'user_id' not in session or session.get('role') != 'student':
+        flash('You need to be logged in as a student to add tags.', 'danger')
+        return redirect(url_for('main.login'))
+
+    conn = get_db_connection(readonly=request.method == 'GET')
+    if not repository.is_owner(conn, portfolio_id, session['user_id']):
+        flash('Portfolio not found or you do not have permission to edit.', 'danger')
+        return redirect(url_for('main.portfolio'))
+
+    tags = get_tag_catalog().all(conn)
+    portfolio_tags = repository.portfolio_tag_ids(conn, portfolio_id)
+
+    if request.method == 'POST':
+        # 書き込みはワーカーに任せて、ここではジョブを追加するだけですぐに返す。
+        # 同じポートフォリオの未実行のジョブがあれば、最後に選んだタグで置き換える
+        known = {tag.id for tag in tags}
+        selected_tags = sorted({int(tag_id) for tag_id in request.form.getlist('tag_ids') if tag_id.isdigit()} & known)
+        if selected_tags == portfolio_tags:
+            flash('Tags updated!', 'success')
+        else:
+            enqueue(conn, 'portfolio_tags', {'portfolio_id': portfolio_id, 'tag_ids': selected_tags},
+                    dedupe_key=f'portfolio_tags:{portfolio_id}')
+            conn.commit()
+            flash('Tags will be updated shortly.', 'success')
+        return redirect(url_for('main.show_portfolio_with_comment', portfolio_id=portfolio_id))
+
+    return render_template('add_tags_to_portfolio.html', tags=tags, portfolio_tags=portfolio_tags,
+                           portfolio_id=portfolio_id)
+
+@job('portfolio_tags', priority=10) # ポートフォリオのタグを選び直す(add_tags_to_portfolioから追加される)
+def apply_portfolio_tags(payload):
+    portfolio_id = payload['portfolio_id']
+    conn = get_db_connection()
+    # 差分の計算から書き込みまでを一つの書き込みトランザクションで行い、他のジョブと入れ違わないようにする
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        if not repository.portfolio_exists(conn, portfolio_id):
+            conn.rollback()
+            return  # 実行までの間に削除された
+        # 実行までの間に削除されたタグは付けない
+        known = {tag.id for tag in get_tag_catalog().all(conn)}
+        selected_tags = set(payload['tag_ids']) & known
+        current = repository.portfolio_tag_ids(conn, portfolio_id)
+        # 付け替えではなく差分だけを書き込み、タグインデックスにも差分を反映する
+        removed = [tag_id for tag_id in current if tag_id not in selected_tags]
+        added = sorted(selected_tags.difference(current))
+        repository.change_portfolio_tags(conn, portfolio_id, added=added, removed=removed)
+        get_tag_index().record(conn, portfolio_id, added=added, removed=removed)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    # 関連ポートフォリオの計算は、印がまとまるまで待ってから別のジョブで行う
+    related.schedule(conn)
+
+# タグによる検索のルート（教師専用）
+@main.route('/search_by_tag', methods=['GET', 'POST'])
+def search_by_tag():
+    if 'user_id' not in session or session.get('role') != 'teacher':
+        flash('You need to be logged in as a teacher to search by tags.', 'danger')
+        return redirect(url_for('main.login'))
+
+    conn = get_db_connection(readonly=True)
+    tags = get_tag_catalog().all(conn)
+
+    # ページ送りのリンクからも検索できるように、条件はクエリ文字列でも受け取る
+    # qは "Python AND Research AND NOT Draft" のようなタグの論理式
+    selected_tag_id = request.values.get('tag_id', type=int)
+    tag_query = request.values.get('q', '').strip()
+    page = None
+    total = 0
+    try:
+        if tag_query:
+            matched = get_tag_index().query(conn, tag_query, get_tag_catalog().ids_by_name(conn))
+        elif selected_tag_id is not None:
+            matched = get_tag_index().tagged(conn, selected_tag_id)
+        else:
+            matched = None
+    except TagQueryError as e:
+        flash(str(e), 'danger')
+        matched = None
+
+    portfolios = []
+    if matched is not None:
+        total = matched.bit_count()
+        page = page_ids(matched, request.args.get('after'), request.args.get('before'), current_app.config['PAGE_SIZE'])
+        if page.items:
+            portfolios = repository.portfolio_titles(conn, page.items)
+
+    return render_template('search_by_tag.html', portfolios=portfolios, tags=tags, page=page, total=total,
+                           selected_tag_id=selected_tag_id, tag_query=tag_query)
+
+@main.route('/view_portfolio_by_tag/<int:portfolio_id>', methods=['GET', 'POST'])
+def view_portfolio_by_tag(portfolio_id):
+    if 'user_id' not in session:
+        flash('You need to be logged in to view this page.', 'danger')
+        return redirect(url_for('main.login'))
+
+    conn = get_db_connection(readonly=request.method == 'GET')
+    portfolio_row = repository.portfolio_version(conn, portfolio_id)
+    
+    if not portfolio_row:
+        flash('Portfolio not found.', 'danger')
+        return redirect(url_for('main.search_by_tag'))
+    
+    form = CommentForm()
+    if form.validate_on_submit():
+        comment_text = form.comment.data
+        rating = form.rating.data
+        repository.add_comment(conn, portfolio_id, session['user_id'], comment_text, rating)
+        conn.commit()
+        flash('Comment added!', 'success')
+        return redirect(url_for('main.view_portfolio_by_tag', portfolio_id=portfolio_id))
+
+    return render_portfolio_detail(conn, portfolio_row, form)
+
+@main.route('/export') # データのエクスポート（教師専用）
+def export():
+    if 'user_id' not in session or session.get('role') != 'teacher':
+        flash('You need to be logged in as a teacher to export data.', 'danger')
+        return redirect(url_for('main.login'))
+
+    kind = request.args.get('kind')
+    fmt = request.args.get('format', 'csv')
+    if kind not in KINDS or fmt not in FORMATS:
+        conn = get_db_connection(readonly=True)
+        return render_template('export.html', kinds=KINDS, formats=FORMATS, tags=get_tag_catalog().all(conn))
+
+    # 生成しながら送るので、学校全体のデータでもメモリ使用量は一定
+    chunks = stream_export(current_app._get_current_object(), kind, fmt, request.args.get('graduation_year') or None,
+                           request.args.get('tag') or None)
+    response = Response(chunks, content_type=content_type(fmt))
+    response.headers['Content-Disposition'] = f'attachment; filename={kind}.{fmt}'
+    return response
+
+@main.route('/duplicates') # 重複(写した可能性のある)ポートフォリオの一覧(教師専用)
+def duplicate_portfolios():
+    if 'user_id' not in session or session.get('role') != 'teacher':
+        flash('You need to be logged in as a teacher to view this page.', 'danger')
+        return redirect(url_for('main.login'))
+
+    conn = get_db_connection(readonly=True)
+    student_id = request.args.get('student', type=int)
+    student = repository.student(conn, student_id) if student_id is not None else None
+    if student_id is not None and not student:
+        abort(404)
+    pairs = duplicates.find(conn, current_app._get_current_object(), student_id)
+
+    return render_template('duplicates.html', pairs=pairs, student=student)
+
+def archive_connection(year):
+    # 卒業生のアーカイブは、教師が開いたときだけ読み込み用の接続にATTACHする
+    if year not in archive_years(current_app):
+        abort(404)
+    return attached(get_db_connection(readonly=True), year)
+
+@main.route('/archive') # 卒業生のアーカイブ(教師専用)
+@main.route('/archive/<int:year>')
+def archived_cohort(year=None):
+    if 'user_id' not in session or session.get('role') != 'teacher':
+        flash('You need to be logged in as a teacher to view this page.', 'danger')
+        return redirect(url_for('main.login'))
+
+    students = None
+    if year is not None:
+        with archive_connection(year) as conn:
+            students = repository.archived_students(conn)
+
+    return render_template('archive.html', years=archive_years(current_app), year=year, students=students)
+
+@main.route('/archive/<int:year>/students/<int:student_id>')
+def archived_student(year, student_id):
+    if 'user_id' not in session or session.get('role') != 'teacher':
+        flash('You need to be logged in as a teacher to view this page.', 'danger')
+        return redirect(url_for('main.login'))
+
+    with archive_connection(year) as conn:
+        student = repository.archived_student(conn, student_id)
+        portfolios = repository.archived_portfolios(conn, student_id)
+    if not student:
+        abort(404)
+
+    return render_template('archived_student.html', year=year, student=student, portfolios=portfolios)
+
+@main.route('/archive/<int:year>/portfolio/<int:portfolio_id>')
+def archived_portfolio(year, portfolio_id):
+    if 'user_id' not in session or session.get('role') != 'teacher':
+        flash('You need to be logged in as a teacher to view this page.', 'danger')
+        return redirect(url_for('main.login'))
+
+    with archive_connection(year) as conn:
+        portfolio_row = repository.archived_portfolio(conn, portfolio_id)
+        if not portfolio_row:
+            abort(404)
+        tags = repository.archived_tags(conn, portfolio_id)
+        comments = repository.archived_comments(conn, portfolio_id)
+        attachments = repository.archived_attachments(conn, portfolio_id)
+
+    return render_template('archived_portfolio.html', year=year, portfolio=portfolio_row, tags=tags,
+                           comments=comments, attachments=attachments)
+
+@main.route('/archive/<int:year>/attachments/<int:attachment_id>')
+def archived_attachment(year, attachment_id):
+    if session.get('role') != 'teacher':
+        abort(403)
+
+    with archive_connection(year) as conn:
+        row = repository.archived_attachment_file(conn, attachment_id)
+    if row is None:
+        abort(404)
+    return send_attachment(row)
@@ -0,0 +1,91 @@
+import time
+
+import click
+from flask import current_app
+
+import db
+from metrics import SKIP_ENVIRON
+
+
+# ワーカーの起動時に一度ずつ開くページ。{portfolio} などはデータベースにある値で埋める
+WARMUP_PAGES = {
+    None: ['/', '/login', '/register'],
+    'student': ['/portfolio', '/profile', '/api/v1/portfolios', '/api/v1/tags'],
+    'teacher': ['/teacher_dashboard', '/teacher_dashboard?search_query=研究', '/students_list',
+                '/students_list?sort=rating', '/search_by_tag', '/search_by_tag?tag_id={tag}',
+                '/view_portfolio/{student}', '/portfolio/{portfolio}', '/api/v1/students',
+                '/api/v1/portfolios/{portfolio}/comments'],
+}
+
+
+def _login_as(client, user):
+    with client.session_transaction() as session:
+        session['user_id'] = user['id']
+        session['role'] = user['role']
+
+
+def warmup(app):
+    # 新しいワーカーが最初のリクエストから普段どおりの速さで応答できるように、
+    # テンプレートのコンパイル・DB接続の確立・プロセス内キャッシュ(タグなど)の読み込み・
+    # よく使うSQLの準備を、リクエストを受け付ける前に済ませておく
+    started = time.perf_counter()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+    statements = {}
+
+    def capture(conn, sql, parameters, seconds):
+        if parameters is not None and sql.lstrip().upper().startswith(('SELECT', 'WITH')):
+            statements.setdefault(sql, parameters)
+
+    db.add_timing_hook(app, capture)
+    pages = 0
+    try:
+        conn = db.open_connection(app, readonly=True)
+        try:
+            values = {
+                'portfolio': conn.execute('SELECT MAX(id) FROM portfolio').fetchone()[0],
+                'student': conn.execute("SELECT MAX(id) FROM user WHERE role = 'student'").fetchone()[0],
+                'tag': conn.execute('SELECT MIN(id) FROM tags').fetchone()[0],
+            }
+            # データがまだないときは、そのIDを使うページを飛ばす
+            values = {key: value for key, value in values.items() if value is not None}
+            users = {role: conn.execute('SELECT id, role FROM user WHERE role = ? ORDER BY id LIMIT 1',
+                                        (role,)).fetchone() for role in ('student', 'teacher')}
+        finally:
+            conn.close()
+        # 既にアプリコンテキストがある(flask warmupから呼ばれた)ときも、
+        # ここで借りた接続がこのコンテキストの終わりにプールへ戻るように新しく作る
+        with app.app_context():
+            for role, urls in WARMUP_PAGES.items():
+                client = app.test_client()
+                if role is not None:
+                    if users[role] is None:
+                        continue
+                    _login_as(client, users[role])
+                for url in urls:
+                    try:
+                        url = url.format(**values)
+                    except KeyError:
+                        continue
+                    # 利用者のリクエストではないので、メトリクスには数えない
+                    client.get(url, environ_base={SKIP_ENVIRON: True}).close()
+                    pages += 1
+    finally:
+        db.remove_timing_hook(app, capture)
+
+    # ページを開いたときに使ったSELECTを、読み込み用プールの他の接続でも準備しておく
+    statements = list(statements.items())
+    read_connections = db.warm_pool(app, readonly=True, statements=statements)
+    write_connections = db.warm_pool(app)
+    return {'templates': len(app.jinja_env.list_templates()), 'pages': pages, 'statements': len(statements),
+            'connections': read_connections + write_connections, 'seconds': time.perf_counter() - started}
+
+
+@click.command('warmup')
+def warmup_command():
+    # ウォームアップにかかる時間と、準備した内容を表示する(gunicornではワーカーの起動時に自動で行う)
+    result = warmup(current_app._get_current_object())
+    click.echo(f"Compiled {result['templates']} templates, opened {result['pages']} pages, prepared "
+               f"{result['statements']} statements on {result['connections']} connections "
+               f"in {result['seconds'] * 1000:.0f} ms")
@@ -0,0 +1,4 @@
+# gunicorn から読み込むエントリーポイント: gunicorn -c gunicorn.conf.py wsgi:app
+from app import create_app
+
+app = create_app()